@@ -0,0 +1,112 @@
+import os
+import sys
+import json
+import time
+import traceback
+from pathlib import Path
+from datetime import datetime
+from contextlib import redirect_stdout, redirect_stderr
+from argparse import Namespace, ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from main import main, parse_args as parse_mission_args
+from src.utils.tools import get_config_env
+
+
+def parse_args() -> tuple[Namespace, list[str]]:
+    # No abbreviation: a mission argument like --config_path must not match --config_paths.
+    parser = ArgumentParser(description="Run many missions concurrently. Other arguments are given to each mission, see main.py --help.", allow_abbrev=False)
+
+    parser.add_argument('--config_paths', type=str, nargs="+", required=True, help="Config files of the missions.")
+    parser.add_argument('-j', '--jobs', type=int, default=max(1, (os.cpu_count() or 1) // 2), help="Number of missions run at the same time. Each mission also uses --workers processes.")
+    parser.add_argument('--batch_folder', type=str, default="batch_output", help="Folder of the batch report and of the log of each mission.")
+
+    return parser.parse_known_args()
+
+
+def run_mission(mission_name: str, mission_argv: list[str], log_path: Path) -> dict:
+    """ Run one mission in a worker process, its output goes to its log file. Never raises. """
+    start = time.perf_counter()
+    summary = {"mission": mission_name, "argv": mission_argv, "log": str(log_path), "started_at": datetime.now().isoformat()}
+
+    with open(log_path, "w") as log_file, redirect_stdout(log_file), redirect_stderr(log_file):
+        try:
+            args = parse_mission_args(mission_argv)
+            main(args)
+            summary["status"] = "ok"
+        except BaseException as error:
+            traceback.print_exc()
+            summary.update({"status": "error", "error": f"{type(error).__name__}: {error}"})
+
+    summary["wall_seconds"] = time.perf_counter() - start
+    return summary
+
+
+def main_batch(batch_args: Namespace, mission_args: list[str]) -> None:
+    batch_folder = Path(batch_args.batch_folder)
+    logs_folder = Path(batch_folder, "logs")
+    logs_folder.mkdir(exist_ok=True, parents=True)
+
+    # The config of each mission comes from --config_paths.
+    if any(arg == "--config_path" or arg.startswith("--config_path=") for arg in mission_args):
+        raise NameError("--config_path can't be given to every mission, list the config files in --config_paths")
+
+    # Each mission must write in its own output folder.
+    missions, output_folders = [], {}
+    for config_path in batch_args.config_paths:
+        output_folder = Path(get_config_env(config_path)["OUTPUT_DIR_PATH"]).resolve()
+        if output_folder in output_folders:
+            raise NameError(f"Missions {output_folders[output_folder]} and {config_path} share the output folder {output_folder}")
+        output_folders[output_folder] = config_path
+
+        # Fail before starting any mission on wrong arguments.
+        parse_mission_args(["--config_path", config_path, *mission_args])
+
+        mission_name = Path(config_path).stem
+        if any(mission["name"] == mission_name for mission in missions):
+            mission_name = f"{mission_name}_{len(missions)}"
+        missions.append({"name": mission_name, "config_path": config_path, "output_folder": output_folder})
+
+    print(f"\n\n-- Run {len(missions)} missions, {batch_args.jobs} at the same time.")
+    start = time.perf_counter()
+    summaries = []
+
+    # A fresh process by mission, nothing is shared between missions.
+    with ProcessPoolExecutor(max_workers=batch_args.jobs, max_tasks_per_child=1) as executor:
+        futures = {
+            executor.submit(run_mission, mission["name"], ["--config_path", mission["config_path"], *mission_args], Path(logs_folder, f"{mission['name']}.log")): mission
+            for mission in missions
+        }
+        for future in as_completed(futures):
+            mission = futures[future]
+            summary = future.result()
+            summary["output_folder"] = str(mission["output_folder"])
+
+            run_report_path = Path(mission["output_folder"], "run_report.json")
+            if run_report_path.exists():
+                with open(run_report_path) as run_report_file:
+                    summary["totals"] = json.load(run_report_file)["totals"]
+
+            summaries.append(summary)
+            print(f"[{summary['status']:>5}] {mission['name']} in {summary['wall_seconds']:.1f}s" + (f": {summary['error']}" if summary["status"] == "error" else ""))
+
+    summaries.sort(key=lambda summary: [mission["name"] for mission in missions].index(summary["mission"]))
+    report_path = Path(batch_folder, "batch_report.json")
+    with open(report_path, "w") as report_file:
+        json.dump({
+            "jobs": batch_args.jobs,
+            "mission_args": mission_args,
+            "wall_seconds": time.perf_counter() - start,
+            "missions_ok": sum(summary["status"] == "ok" for summary in summaries),
+            "missions_error": sum(summary["status"] == "error" for summary in summaries),
+            "missions": summaries
+        }, report_file, indent=4)
+
+    print(f"\n\n-- Batch report saved to: {report_path}")
+    if any(summary["status"] == "error" for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    batch_args, mission_args = parse_args()
+    main_batch(batch_args, mission_args)
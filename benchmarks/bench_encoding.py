@@ -0,0 +1,118 @@
+import sys
+import json
+import time
+import shutil
+import rasterio
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+from argparse import Namespace, ArgumentParser
+from rasterio.windows import Window
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from src.utils.TileEncoder import TileEncoder
+from benchmarks.synthetic_data import make_synthetic_mission
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Compare the throughput and size of tile formats, compression levels and encoding pools.")
+
+    parser.add_argument('--width', type=int, default=1600, help="Orthophoto width in pixels.")
+    parser.add_argument('--height', type=int, default=1200, help="Orthophoto height in pixels.")
+    parser.add_argument('--gsd_cm', type=float, default=1.0, help="Ground sample distance of the synthetic orthophoto.")
+    parser.add_argument('--tile_size', type=int, default=150, help="Tile size in pixels.")
+    parser.add_argument('--orthophoto', type=str, default=None, help="Read tiles from this orthophoto instead of a synthetic one.")
+    parser.add_argument('--png_levels', type=int, nargs="*", default=[1, 6, 9], help="Png zlib levels. 6 is the driver default.")
+    parser.add_argument('--webp_levels', type=int, nargs="*", default=[1, 75, 100], help="Lossless webp efforts from 1 to 100. 75 is the driver default.")
+    parser.add_argument('--no_npy', action="store_true", help="Don't benchmark raw npy tiles.")
+    parser.add_argument('--workers', type=int, nargs="+", default=[0, 2, 4], help="Encoding workers, 0 encodes in the calling thread.")
+    parser.add_argument('--pools', type=str, nargs="+", default=["thread", "process"], choices=["thread", "process"], help="Pools of encoding workers.")
+    parser.add_argument('--data_folder', type=str, default="benchmarks/data", help="Folder of synthetic missions, reused between runs.")
+    parser.add_argument('--results_folder', type=str, default="benchmarks/results", help="Folder of json reports.")
+
+    return parser.parse_args()
+
+
+def read_tiles(orthophoto_path: Path, tile_size: int) -> list[np.ndarray]:
+    """ Every full tile of the orthophoto, in memory so only encoding is timed. """
+    with rasterio.open(orthophoto_path) as src:
+        return [
+            src.read([1, 2, 3], window=Window(j, i, tile_size, tile_size))
+            for i in range(0, src.height - tile_size + 1, tile_size)
+            for j in range(0, src.width - tile_size + 1, tile_size)
+        ]
+
+
+def run_encoding(tiles: list[np.ndarray], tiles_folder: Path, encoding: dict) -> dict:
+    """ Encode every tile with one encoder setting and return its throughput and size. """
+    shutil.rmtree(tiles_folder, ignore_errors=True)
+    tiles_folder.mkdir(parents=True)
+
+    start = time.perf_counter()
+    with TileEncoder(**encoding) as encoder:
+        for k, tile in enumerate(tiles):
+            encoder.submit(Path(tiles_folder, f"tile_{k}{encoder.suffix}"), tile)
+        counters = encoder.close()
+    seconds = time.perf_counter() - start
+
+    megabytes = counters["bytes_written"] / 1024**2
+    return {
+        **encoding,
+        "seconds": seconds,
+        "tiles_per_second": len(tiles) / seconds,
+        "input_mb_per_second": sum(tile.nbytes for tile in tiles) / 1024**2 / seconds,
+        "output_mb": megabytes,
+        "kb_per_tile": megabytes * 1024 / len(tiles)
+    }
+
+
+def print_table(results: list[dict]) -> None:
+    """ Print a line by encoder setting. """
+    print(f"\n\n{'format':<8}{'level':>8}{'pool':>10}{'workers':>10}{'tiles/s':>12}{'in MB/s':>12}{'KB/tile':>12}")
+    for result in results:
+        level = "-" if result["compression_level"] is None else str(result["compression_level"])
+        pool = result["pool"] if result["workers"] else "-"
+        print(f"{result['tile_format']:<8}{level:>8}{pool:>10}{result['workers']:>10}{result['tiles_per_second']:>12.1f}{result['input_mb_per_second']:>12.1f}{result['kb_per_tile']:>12.1f}")
+
+
+def main(bench_args: Namespace) -> None:
+    if bench_args.orthophoto:
+        orthophoto_path = Path(bench_args.orthophoto)
+    else:
+        # Synthetic missions are generated once by size and reused, only the orthophoto is needed.
+        mission_folder = Path(bench_args.data_folder, f"mission_{bench_args.width}x{bench_args.height}_encoding_{bench_args.gsd_cm:g}cm")
+        orthophoto_path = Path(mission_folder, "drone", "odm_orthophoto", "odm_orthophoto.tif")
+        if not orthophoto_path.exists():
+            print(f"\n\n-- Generate synthetic mission {mission_folder}")
+            make_synthetic_mission(mission_folder, bench_args.width, bench_args.height, bench_args.gsd_cm, n_frames=10)
+
+    tiles = read_tiles(orthophoto_path, bench_args.tile_size)
+    print(f"\n\n-- Encode {len(tiles)} tiles of {bench_args.tile_size} pixels from {orthophoto_path}")
+
+    settings = [("png", level) for level in bench_args.png_levels] + [("webp", level) for level in bench_args.webp_levels]
+    if not bench_args.no_npy:
+        settings.append(("npy", None))
+
+    results = []
+    tiles_folder = Path(bench_args.data_folder, "encoding_tiles")
+    for tile_format, compression_level in settings:
+        for workers in bench_args.workers:
+            for pool in bench_args.pools if workers else ["thread"]:
+                encoding = {"tile_format": tile_format, "compression_level": compression_level, "workers": workers, "pool": pool}
+                results.append(run_encoding(tiles, tiles_folder, encoding))
+    shutil.rmtree(tiles_folder, ignore_errors=True)
+
+    print_table(results)
+
+    results_folder = Path(bench_args.results_folder)
+    results_folder.mkdir(exist_ok=True, parents=True)
+    report_path = Path(results_folder, f"bench_encoding_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w") as report_file:
+        json.dump({"args": vars(bench_args), "tiles": len(tiles), "results": results}, report_file, indent=4)
+    print(f"\nReport saved to: {report_path}")
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    main(bench_args)
@@ -0,0 +1,144 @@
+import sys
+import json
+import time
+import shutil
+import resource
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from argparse import Namespace, ArgumentParser
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from main import parse_args as parse_pipeline_args
+from src.utils.Orthophoto import Orthophoto
+from src.utils.ASVManager import ASVManager
+from src.utils.AnnotationMaker import AnnotationMaker
+from src.utils.tools import get_config_env
+from benchmarks.synthetic_data import make_synthetic_mission
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description="Time and memory profile each pipeline stage on synthetic missions of growing size.")
+
+    parser.add_argument('--scales', type=float, nargs="+", default=[1, 2, 4], help="Side length factors of the synthetic orthophoto. Frames grow with the area.")
+    parser.add_argument('--base_width', type=int, default=1600, help="Orthophoto width in pixels at scale 1.")
+    parser.add_argument('--base_height', type=int, default=1200, help="Orthophoto height in pixels at scale 1.")
+    parser.add_argument('--base_frames', type=int, default=2000, help="Number of ASV frames at scale 1.")
+    parser.add_argument('--gsd_cm', type=float, default=1.0, help="Ground sample distance of the synthetic orthophoto.")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of runs by scale, the best time is kept.")
+    parser.add_argument('--no_memory', action="store_true", help="Don't trace python allocations, tracing slows down python heavy stages.")
+    parser.add_argument('--data_folder', type=str, default="benchmarks/data", help="Folder of synthetic missions, reused between runs.")
+    parser.add_argument('--results_folder', type=str, default="benchmarks/results", help="Folder of json reports.")
+    parser.add_argument('--pipeline_args', type=str, default="", help="Extra pipeline arguments, e.g. \"-em png -w 4\".")
+
+    return parser.parse_args()
+
+
+def measure(stage: str, func: Callable[[], Any], trace_memory: bool, records: list[dict]) -> Any:
+    """ Run a stage and record its wall time, python peak memory and process max RSS. """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if trace_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+
+    records.append({
+        "stage": stage,
+        "seconds": seconds,
+        "python_peak_mb": peak_mb,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    })
+    return result
+
+
+def run_pipeline(config_path: Path, pipeline_args: list[str], trace_memory: bool) -> list[dict]:
+    """ Run the pipeline stage by stage, like main without stage cache, and return a record by stage. """
+    args = parse_pipeline_args(["--config_path", str(config_path), *pipeline_args])
+    records = []
+
+    # Stages are called directly, -c of main does not apply: each run starts from an empty output folder.
+    shutil.rmtree(get_config_env(args.config_path)["OUTPUT_DIR_PATH"], ignore_errors=True)
+
+    orthoManager = Orthophoto(args)
+    asvManager = ASVManager(args)
+    annotationMaker = AnnotationMaker(args)
+
+    bounds = measure("split_tif_into_tiles", orthoManager.split_tif_into_tiles, trace_memory, records)
+    tiles_bounds_df = measure("filter_tiles_based_on_manual_boundary", lambda: orthoManager.filter_tiles_based_on_manual_boundary(bounds), trace_memory, records)
+    if args.export_mode == "tif_png":
+        measure("convert_tif_to_png", lambda: orthoManager.convert_tif_to_png(tiles_bounds_df), trace_memory, records)
+
+    measure("filter_annotation_asv", asvManager.filter_annotation_asv, trace_memory, records)
+    annotations_tiles = measure("match_asv_annotations_with_tiles", lambda: asvManager.match_asv_annotations_with_tiles(tiles_bounds_df), trace_memory, records)
+    annotation_tiles_gdf = measure("compute_footprint", lambda: asvManager.compute_footprint(annotations_tiles), trace_memory, records)
+    annotation_tiles_gdf_filtered = measure("filter_tiles_enough_underwater_coverage", lambda: asvManager.filter_tiles_enough_underwater_coverage(annotation_tiles_gdf), trace_memory, records)
+
+    binary_annotation_df = measure("create_binary_annotations_for_tiles", lambda: annotationMaker.create_binary_annotations_for_tiles(annotation_tiles_gdf_filtered), trace_memory, records)
+    annotations_tiles_from_binary = measure("create_probability_annotations_for_tiles", lambda: annotationMaker.create_probability_annotations_for_tiles(annotation_tiles_gdf_filtered, binary_annotation_df), trace_memory, records)
+    unlabeled_folder = measure("move_images_by_annotations", lambda: annotationMaker.move_images_by_annotations(annotations_tiles_from_binary), trace_memory, records)
+    measure("create_unlabeled_csv", lambda: orthoManager.create_unlabeled_csv(unlabeled_folder, tiles_bounds_df), trace_memory, records)
+
+    for record in records:
+        record.update({"tiles": len(tiles_bounds_df), "matched_rows": len(annotations_tiles), "annotated_rows": len(annotation_tiles_gdf_filtered)})
+    return records
+
+
+def print_table(results: list[dict]) -> None:
+    """ Print seconds and python peak memory of each stage, one column by scale. """
+    scales = [result["scale"] for result in results]
+    stages = list(dict.fromkeys(record["stage"] for result in results for record in result["stages"]))
+
+    print(f"\n\n{'stage':<45}" + "".join(f"{f'x{scale:g} s':>12}{f'x{scale:g} MB':>12}" for scale in scales))
+    for stage in stages:
+        line = f"{stage:<45}"
+        for result in results:
+            record = next((record for record in result["stages"] if record["stage"] == stage), None)
+            seconds = f"{record['seconds']:.3f}" if record else "-"
+            peak_mb = f"{record['python_peak_mb']:.1f}" if record and record["python_peak_mb"] is not None else "-"
+            line += f"{seconds:>12}{peak_mb:>12}"
+        print(line)
+    print(f"{'total':<45}" + "".join(f"{sum(record['seconds'] for record in result['stages']):>12.3f}{'':>12}" for result in results))
+
+
+def main(bench_args: Namespace) -> None:
+    results = []
+    for scale in bench_args.scales:
+        width, height = int(bench_args.base_width * scale), int(bench_args.base_height * scale)
+        n_frames = int(bench_args.base_frames * scale**2)
+
+        # Synthetic missions are generated once by size and reused.
+        mission_folder = Path(bench_args.data_folder, f"mission_{width}x{height}_{n_frames}_{bench_args.gsd_cm:g}cm")
+        config_path = Path(mission_folder, "config.json")
+        if not config_path.exists():
+            print(f"\n\n-- Generate synthetic mission {mission_folder}")
+            config_path = make_synthetic_mission(mission_folder, width, height, bench_args.gsd_cm, n_frames)
+
+        best_records = None
+        for _ in range(bench_args.repeat):
+            records = run_pipeline(config_path, bench_args.pipeline_args.split(), not bench_args.no_memory)
+            if best_records is None or sum(r["seconds"] for r in records) < sum(r["seconds"] for r in best_records):
+                best_records = records
+
+        results.append({"scale": scale, "width": width, "height": height, "frames": n_frames, "stages": best_records})
+        shutil.rmtree(Path(mission_folder, "output"), ignore_errors=True)
+
+    print_table(results)
+
+    results_folder = Path(bench_args.results_folder)
+    results_folder.mkdir(exist_ok=True, parents=True)
+    report_path = Path(results_folder, f"bench_stages_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, "w") as report_file:
+        json.dump({"args": vars(bench_args), "results": results}, report_file, indent=4)
+    print(f"\nReport saved to: {report_path}")
+
+
+if __name__ == "__main__":
+    bench_args = parse_args()
+    main(bench_args)
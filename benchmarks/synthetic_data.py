@@ -0,0 +1,155 @@
+import json
+import rasterio
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pathlib import Path
+from argparse import ArgumentParser
+from pyproj import Transformer
+from shapely.geometry import Polygon
+from rasterio.transform import from_origin
+
+# Classes predicted on ASV frames.
+CLASSES = [
+    "Acropore_branched", "Acropore_digitised", "Acropore_sub_massive", "Acropore_tabular", "Algae_assembly", "Algae_drawn_up",
+    "Algae_limestone", "Algae_sodding", "Atra/Leucospilota", "Bleached_coral", "Blurred", "Dead_coral", "Fish", "Homo_sapiens",
+    "Human_object", "Living_coral", "Millepore", "No_acropore_encrusting", "No_acropore_foliaceous", "No_acropore_massive",
+    "No_acropore_solitary", "No_acropore_sub_massive", "Rock", "Sand", "Rubble", "Sea_cucumber", "Sea_urchins", "Sponge",
+    "Syringodium_isoetifolium", "Thalassodendron_ciliatum", "Useless"
+]
+
+# Upper left corner of the orthophoto, EPSG:32740 like Saint-Leu missions.
+ORIGIN_X, ORIGIN_Y, CRS = 320000.0, 7660000.0, "32740"
+
+
+def make_orthophoto(orthophoto_path: Path, width: int, height: int, gsd_cm: float, rng: np.random.Generator) -> tuple[float, float, float, float]:
+    """ Write a tiled RGBA GeoTIFF with blank margins and overviews. Returns the extent (min x, min y, max x, max y). """
+    resolution = gsd_cm / 100
+    transform = from_origin(ORIGIN_X, ORIGIN_Y, resolution, resolution)
+
+    with rasterio.open(
+        orthophoto_path, "w", driver="GTiff", width=width, height=height, count=4, dtype="uint8",
+        crs=f"EPSG:{CRS}", transform=transform, tiled=True, blockxsize=256, blockysize=256, compress="deflate"
+    ) as dst:
+        # Written by strips of rows to keep memory bounded on big orthophotos.
+        for row_off in range(0, height, 512):
+            rows, cols = np.mgrid[row_off:min(row_off + 512, height), 0:width]
+
+            # Valid area is a slanted band like a drone flight over the lagoon, black and transparent outside.
+            valid = (cols > width * 0.08 + rows * 0.05) & (cols < width * 0.95 - (height - rows) * 0.04) & (rows > height * 0.06) & (rows < height * 0.97)
+
+            # Smooth seabed texture: low frequency pattern plus noise.
+            pattern = (np.sin(cols / 37.0) + np.cos(rows / 53.0)) * 40
+            strip = np.zeros((4, *rows.shape), dtype=np.uint8)
+            for band, base in enumerate([90, 140, 160]):
+                strip[band] = np.clip(base + pattern + rng.normal(0, 15, rows.shape), 1, 254)
+            strip[3] = 255
+            strip[:, ~valid] = 0
+            dst.write(strip, window=rasterio.windows.Window(0, row_off, width, rows.shape[0]))
+
+        # A saturated patch, like sun glint, to exercise the white pixels threshold.
+        glint_row, glint_col = height // 2, width // 2
+        dst.write(np.full((3, max(1, height // 30), max(1, width // 5)), 255, dtype=np.uint8), indexes=[1, 2, 3],
+                  window=rasterio.windows.Window(glint_col, glint_row, max(1, width // 5), max(1, height // 30)))
+        dst.build_overviews([2, 4, 8, 16])
+
+    return ORIGIN_X, ORIGIN_Y - height * resolution, ORIGIN_X + width * resolution, ORIGIN_Y
+
+
+def make_asv_metadata(extent: tuple[float, float, float, float], n_frames: int, rng: np.random.Generator) -> pd.DataFrame:
+    """ ASV frames along back and forth transects with realistic attitude and spatially correlated class scores. """
+    min_x, min_y, max_x, max_y = extent
+
+    # Transects spaced by 1 meter, the ASV goes back and forth at constant speed.
+    n_transects = max(1, int((max_y - min_y) // 1.0))
+    frames_by_transect = int(np.ceil(n_frames / n_transects))
+    t = np.linspace(0, 1, frames_by_transect)
+    xs, ys, tracks = [], [], []
+    for k in range(n_transects):
+        forward = k % 2 == 0
+        xs.append(min_x - 0.5 + (max_x - min_x + 1) * (t if forward else 1 - t))
+        ys.append(np.full(frames_by_transect, min_y + 0.5 + k * 1.0))
+        tracks.append(np.full(frames_by_transect, 90.0 if forward else 270.0))
+    x = np.concatenate(xs)[:n_frames] + rng.normal(0, 0.1, n_frames)
+    y = np.concatenate(ys)[:n_frames] + rng.normal(0, 0.1, n_frames)
+    track = (np.concatenate(tracks)[:n_frames] + rng.normal(0, 5, n_frames)) % 360
+
+    lon, lat = Transformer.from_crs(f"EPSG:{CRS}", "EPSG:4326", always_xy=True).transform(x, y)
+
+    asv_metadata_df = pd.DataFrame({
+        "FileName": [f"frame_{i:07d}.jpg" for i in range(n_frames)],
+        "SubSecDateTimeOriginal": pd.date_range("2023-12-08 10:00", periods=n_frames, freq="500ms").strftime("%Y:%m:%d %H:%M:%S.%f").str[:-3],
+        "GPSTrack": track,
+        "GPSRoll": rng.normal(0, 3, n_frames),
+        "GPSPitch": rng.normal(0, 3, n_frames),
+        "GPSAltitude": rng.uniform(0.8, 2.5, n_frames),
+        "GPSLatitude": lat,
+        "GPSLongitude": lon
+    })
+
+    # Class scores follow smooth fields over the area, so neighbouring frames agree.
+    phases = rng.uniform(0, 2 * np.pi, (len(CLASSES), 2))
+    for k, class_name in enumerate(CLASSES):
+        field = 0.5 + 0.35 * np.sin(x / 3.0 + phases[k, 0]) * np.cos(y / 4.0 + phases[k, 1])
+        asv_metadata_df[class_name] = np.clip(field + rng.normal(0, 0.1, n_frames), 0, 1).round(4)
+
+    # Some frames have no attitude.
+    asv_metadata_df.loc[rng.choice(n_frames, max(1, n_frames // 200), replace=False), "GPSRoll"] = np.nan
+
+    return asv_metadata_df
+
+
+def make_synthetic_mission(root: Path, width: int = 1600, height: int = 1200, gsd_cm: float = 1.0, n_frames: int = 3000, seed: int = 0) -> Path:
+    """ Write a synthetic mission and its config file. Returns the config path.
+
+    Args:
+        root (Path): Folder of the mission, created if needed.
+        width (int): Orthophoto width in pixels.
+        height (int): Orthophoto height in pixels.
+        gsd_cm (float): Ground sample distance in centimeters.
+        n_frames (int): Number of ASV frames.
+        seed (int): Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    orthophoto_folder, report_folder = Path(root, "drone", "odm_orthophoto"), Path(root, "drone", "odm_report")
+    orthophoto_folder.mkdir(exist_ok=True, parents=True)
+    report_folder.mkdir(exist_ok=True, parents=True)
+
+    min_x, min_y, max_x, max_y = make_orthophoto(Path(orthophoto_folder, "odm_orthophoto.tif"), width, height, gsd_cm, rng)
+
+    with open(Path(report_folder, "stats.json"), "w") as stats_file:
+        json.dump({"odm_processing_statistics": {"average_gsd": gsd_cm}}, stats_file)
+
+    # Manual boundary slightly inside the orthophoto extent.
+    margin_x, margin_y = (max_x - min_x) * 0.03, (max_y - min_y) * 0.03
+    boundary = Polygon([(min_x + margin_x, min_y + margin_y), (max_x - margin_x, min_y + 2 * margin_y), (max_x - 2 * margin_x, max_y - margin_y), (min_x + 2 * margin_x, max_y - 2 * margin_y)])
+    boundary_path = Path(root, "boundary.geojson")
+    gpd.GeoDataFrame(geometry=[boundary], crs=f"EPSG:{CRS}").to_file(boundary_path, driver="GeoJSON")
+
+    asv_metadata_path = Path(root, "asv_metadata.csv")
+    make_asv_metadata((min_x, min_y, max_x, max_y), n_frames, rng).to_csv(asv_metadata_path, index=False)
+
+    config_path = Path(root, "config.json")
+    with open(config_path, "w") as config_file:
+        json.dump({
+            "ASV_CSV_METADATA_PATH": str(asv_metadata_path),
+            "DRONE_PATH": str(Path(root, "drone")),
+            "MANUEL_BOUNDARY_PATH": str(boundary_path),
+            "OUTPUT_DIR_PATH": str(Path(root, "output"))
+        }, config_file, indent=4)
+
+    return config_path
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generate a synthetic mission: orthophoto, stats.json, manual boundary, ASV metadata and config.")
+    parser.add_argument('root', type=str, help="Folder of the mission.")
+    parser.add_argument('--width', type=int, default=1600, help="Orthophoto width in pixels.")
+    parser.add_argument('--height', type=int, default=1200, help="Orthophoto height in pixels.")
+    parser.add_argument('--gsd_cm', type=float, default=1.0, help="Ground sample distance in centimeters.")
+    parser.add_argument('--frames', type=int, default=3000, help="Number of ASV frames.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+    args = parser.parse_args()
+
+    config_path = make_synthetic_mission(Path(args.root), args.width, args.height, args.gsd_cm, args.frames, args.seed)
+    print(f"Synthetic mission config: {config_path}")
@@ -1,17 +1,25 @@
 import shutil
+import pandas as pd
+import geopandas as gpd
 from pathlib import Path
 from argparse import Namespace, ArgumentParser
 
 from src.utils.Orthophoto import Orthophoto
 from src.utils.ASVManager import ASVManager
 from src.utils.AnnotationMaker import AnnotationMaker
+from src.utils.StageCache import StageCache
+from src.utils.RunReport import RunReport
+from src.utils.RunPlanner import RunPlanner
+from src.utils.BaseManager import BaseManager, SINGLE_FILE_EXPORT_MODES
+from src.utils.TileEncoder import TILE_FORMATS, COMPRESSION_LEVELS
+from src.utils.tools import get_config_env
 
-def parse_args() -> Namespace:
+def parse_args(argv: list[str] | None = None) -> Namespace:
     parser = ArgumentParser(description="Split UAV orthophoto to tiles and upscale ASV predictions to UAV annotations.")
 
     # Default parameters
     parser.add_argument('-crs', '--matching_crs', type=str, default="32740", help="Default CRS of the project.")
-    parser.add_argument('-tsm', '--tiles_size_meters', type=float, default=1.5, help='Tile size in meters')
+    parser.add_argument('-tsm', '--tiles_size_meters', type=float, nargs="+", default=[1.5], help='Tile size in meters. With many sizes, the orthophoto is read once and each size is written in OUTPUT_DIR_PATH/tiles_<size>m.')
     parser.add_argument('-ft', '--footprint_threshold', type=float, default=1.0, help='Footprint threshold to keep image. Default: Keep tiles with 100% coverage')
     parser.add_argument('--fov_x', type=float, default=94.4, help='ASV Vamera FOV X')
     parser.add_argument('--fov_y', type=float, default=122.6, help='ASV Vamera FOV Y')
@@ -24,26 +32,188 @@ def parse_args() -> Namespace:
     # Global options.
     parser.add_argument('--config_path', default="config/config_stleu.json", help="Path to config.json file.")
     parser.add_argument('-c', '--clear_all', action="store_true", help="Clear all processed data.")
+    parser.add_argument('--no_cache', action="store_true", help="Recompute every stage even if its inputs and arguments are unchanged.")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="Number of worker processes used to split the orthophoto. Default: 1 (serial)")
+    parser.add_argument('--prescreen', action="store_true", help="Skip tiles without valid pixels in the orthophoto mask/alpha band, read at overview resolution, before reading them.")
+    parser.add_argument('--strip_memory_mb', type=float, default=256, help="Memory budget of one strip of tile rows read from the orthophoto, by worker.")
+    parser.add_argument('-em', '--export_mode', type=str, default="tif_png", choices=["tif_png", "png", "vrt", "cog"], help="tif_png: write GeoTIFF tiles then convert them to png. png: encode png tiles directly from memory. vrt, cog: no file by tile, write a VRT on the orthophoto or a Cloud-Optimized GeoTIFF and a tile index of windows.")
+    parser.add_argument('--world_file', action="store_true", help="With png export mode, write a world file next to each tile, .pgw for png and .wpw for webp.")
+    parser.add_argument('--tile_format', type=str, default="png", choices=list(TILE_FORMATS), help="Format of tile files. png, webp: lossless images. npy: raw (bands, height, width) arrays, fastest to write and load.")
+    parser.add_argument('--compression_level', type=int, default=None, help="png: zlib level from 1 (fastest) to 9. webp: lossless effort from 1 (fastest) to 100. Default: driver default.")
+    parser.add_argument('--encoding_workers', type=int, default=0, help="Number of workers encoding tile files, fed by a bounded queue. Default: 0, tiles are encoded by the reader.")
+    parser.add_argument('--encoding_pool', type=str, default="thread", choices=["thread", "process"], help="Pool of encoding workers. GDAL encoders release the GIL, threads avoid copying tiles between processes.")
+    parser.add_argument('--encoding_queue', type=int, default=None, help="Maximum number of tiles waiting to be encoded. Default: 4 by encoding worker.")
+    parser.add_argument('-if', '--intermediate_format', type=str, default="csv", choices=["csv", "parquet"], help="csv: intermediate tables as csv/GeoJSON with WKT geometries. parquet: GeoParquet with WKB geometries and typed columns.")
+    parser.add_argument('--footprint_thresholds', type=float, nargs="+", default=None, help="Also write annotations for each footprint threshold in OUTPUT_DIR_PATH/footprint_sweep, from a single coverage computation.")
+    parser.add_argument('--asv_chunksize', type=int, default=100_000, help="Number of ASV metadata rows parsed at once.")
+    parser.add_argument('--threshold_sets', type=str, default=None, help="Path to a json file of threshold sets, {name: {class: threshold}}. Write binary annotations for each set in a single pass.")
+    parser.add_argument('--route_tiles', action="store_true", help="Plan annotated tiles from geometry before reading pixels and export each tile straight to the annotated or unlabeled folder.")
+    parser.add_argument('--unlabeled', type=str, default="write", choices=["write", "skip", "lazy"], help="With --route_tiles. write: export unlabeled tiles. skip: don't export them. lazy: save them in a plan exported later with --export_unlabeled_plan.")
+    parser.add_argument('--export_unlabeled_plan', action="store_true", help="Export the unlabeled tiles planned by a previous run with --unlabeled lazy, then exit.")
+    parser.add_argument('--profile_stages', type=str, nargs="*", default=[], help="Run these stages under cProfile, e.g. split_tif_into_tiles, or all. Profiles are saved in OUTPUT_DIR_PATH/profiles.")
+    parser.add_argument('--plan', action="store_true", help="Estimate tile counts, annotated tiles, work and output bytes from geometry only, without reading pixels, then exit. Saved in OUTPUT_DIR_PATH/run_plan.json.")
+    parser.add_argument('--gdal_cache_mb', type=int, default=None, help="GDAL block cache size in MB. Default: GDAL default.")
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.unlabeled != "write" and not args.route_tiles:
+        parser.error("--unlabeled skip and lazy need --route_tiles")
+    if args.route_tiles and args.export_mode in SINGLE_FILE_EXPORT_MODES:
+        parser.error("--route_tiles routes tile files to folders, it can't be used with a single file export mode")
+    if args.compression_level is not None and args.compression_level not in COMPRESSION_LEVELS[args.tile_format]:
+        parser.error(f"--compression_level {args.compression_level} is not valid for --tile_format {args.tile_format}")
+    if args.world_file and TILE_FORMATS[args.tile_format]["world_file_suffix"] is None:
+        parser.error(f"--world_file can't be used with --tile_format {args.tile_format}")
+    if args.encoding_workers < 0 or (args.encoding_queue is not None and args.encoding_queue < 1):
+        parser.error("--encoding_workers must be positive and --encoding_queue at least 1")
+    if args.plan and (args.clear_all or args.export_unlabeled_plan):
+        parser.error("--plan doesn't run the pipeline, it can't be used with --clear_all or --export_unlabeled_plan")
+    if len(set(args.tiles_size_meters)) != len(args.tiles_size_meters):
+        parser.error("--tiles_size_meters are not unique")
+    if len(args.tiles_size_meters) > 1 and (args.route_tiles or args.export_unlabeled_plan):
+        parser.error("Many --tiles_size_meters can't be used with --route_tiles or --export_unlabeled_plan")
+
+    # A single tile size is written in OUTPUT_DIR_PATH, managers of a multi-scale run get their own args.
+    if len(args.tiles_size_meters) == 1:
+        args.tiles_size_meters = args.tiles_size_meters[0]
+    args.scale_folder = None
+
+    return args
 
 
 def main(args: Namespace) -> None:
 
+    # Dry run, the report of the previous run is kept.
+    if args.plan:
+        sizes = args.tiles_size_meters if isinstance(args.tiles_size_meters, list) else [args.tiles_size_meters]
+        RunPlanner([scale_args(args, size) for size in sizes] if len(sizes) > 1 else [args]).plan()
+        return
 
     # Setup.
-    orthoManager = Orthophoto(args)
-    asvManager = ASVManager(args)
-    annotationMaker = AnnotationMaker(args)
+    if args.clear_all:
+        BaseManager.clear_output(args)
+
+    # Managers share the run report, saved even if a stage fails.
+    report = RunReport(Path(get_config_env(args.config_path)["OUTPUT_DIR_PATH"]), args.profile_stages)
+    report.metadata["args"] = vars(args)
+
+    try:
+        if isinstance(args.tiles_size_meters, list):
+            run_multiscale_stages(args, report)
+        else:
+            orthoManager = Orthophoto(args, report)
+            asvManager = ASVManager(args, report)
+            annotationMaker = AnnotationMaker(args, report)
+
+            # Stages are skipped when their inputs, arguments and upstream stages are unchanged.
+            cache = StageCache(orthoManager.output_folder, enabled=not args.no_cache, report=report)
+            run_stages(args, orthoManager, asvManager, annotationMaker, cache)
+    finally:
+        print("\n\n-- Run report saved to:", report.save())
+
+
+def run_stages(args: Namespace, orthoManager: Orthophoto, asvManager: ASVManager, annotationMaker: AnnotationMaker, cache: StageCache) -> None:
+    if args.export_unlabeled_plan:
+        orthoManager.export_unlabeled_plan()
+        return
+
+    if args.route_tiles:
+        # Annotated tiles only depend on geometry, they are known before any pixel is read.
+        tiles_plan_df = cache.run("grid", *orthoManager.grid_signature(), [], orthoManager.plan_tiles, orthoManager.plan_tiles)
+
+        # Annotations of planned tiles are kept apart, the tiles stage routes tiles with them.
+        annotation_filtered_gdf = cache.run("asv", *asvManager.stage_signature(), ["grid"],
+                                            lambda: asvManager.compute_annotations(tiles_plan_df, "annotation_tiles_planned"),
+                                            lambda: asvManager.load_annotations("annotation_tiles_planned"))
+
+        tiles_bounds_df = cache.run("tiles", *orthoManager.stage_signature(), ["asv"],
+                                    lambda: orthoManager.setup_routed_tiles(tiles_plan_df, annotation_filtered_gdf["FileName"].unique()), orthoManager.load_ortho_tiles)
+        annotation_filtered_gdf = asvManager.filter_annotations_on_exported_tiles(annotation_filtered_gdf, tiles_bounds_df)
+        asvManager.write_annotations(annotation_filtered_gdf)
+
+        unlabeled_folder = cache.run("annotations", {}, {}, ["tiles"],
+                                     lambda: annotationMaker.create_and_compute_annotations(annotation_filtered_gdf), annotationMaker.load_annotations)
+
+        if args.unlabeled == "write":
+            orthoManager.create_unlabeled_csv(unlabeled_folder, tiles_bounds_df)
+
+        run_sweeps(args, asvManager, annotationMaker, cache, tiles_bounds_df, annotation_filtered_gdf)
+    else:
+        # Split tif into tiles and filter on manual boundary
+        tiles_bounds_df = cache.run("tiles", *orthoManager.stage_signature(), [],
+                                    orthoManager.setup_ortho_tiles, orthoManager.load_ortho_tiles)
+
+        run_annotation_stages(args, orthoManager, asvManager, annotationMaker, cache, tiles_bounds_df)
+
+
+def scale_args(args: Namespace, tiles_size_meters: float) -> Namespace:
+    """ Args of the managers of one tile size of a multi-scale run. """
+    return Namespace(**{**vars(args), "tiles_size_meters": tiles_size_meters, "scale_folder": f"tiles_{tiles_size_meters:g}m"})
+
+
+def run_multiscale_stages(args: Namespace, report: RunReport) -> None:
+    """ Run the stages for each tile size, each one in its own output folder and with its own stage cache.
+
+    Tiles of every size are cut from one read of the orthophoto, ASV frames are loaded once and their footprints
+    are computed once for all tile grids.
+    """
+    scales_args = [scale_args(args, tiles_size_meters) for tiles_size_meters in args.tiles_size_meters]
+    orthoManagers = [Orthophoto(scale, report) for scale in scales_args]
+    asvManagers = [ASVManager(scale, report) for scale in scales_args]
+    annotationMakers = [AnnotationMaker(scale, report) for scale in scales_args]
+    caches = [StageCache(orthoManager.output_folder, enabled=not args.no_cache, report=report) for orthoManager in orthoManagers]
+
+    # Tiles stage of every size with unchanged inputs is loaded, the others are computed together.
+    tiles_bounds_dfs = [
+        orthoManager.load_ortho_tiles() if cache.is_unchanged("tiles", *orthoManager.stage_signature(), []) else None
+        for orthoManager, cache in zip(orthoManagers, caches)
+    ]
+    pending = [k for k, tiles_bounds_df in enumerate(tiles_bounds_dfs) if tiles_bounds_df is None]
+    print(f"\n\n-- Tiles of {len(tiles_bounds_dfs) - len(pending)} / {len(tiles_bounds_dfs)} sizes unchanged, loaded from previous run.")
+    if pending:
+        with report.stage("tiles"):
+            for k in pending:
+                caches[k].invalidate("tiles")
+            for k, tiles_bounds_df in zip(pending, Orthophoto.setup_multiscale_ortho_tiles([orthoManagers[k] for k in pending])):
+                tiles_bounds_dfs[k] = tiles_bounds_df
+                caches[k].record("tiles")
+
+    for k, scale in enumerate(scales_args):
+        if k > 0:
+            asvManagers[k].share_frames(asvManagers[k - 1])
+        with report.stage(scale.scale_folder):
+            run_annotation_stages(scale, orthoManagers[k], asvManagers[k], annotationMakers[k], caches[k], tiles_bounds_dfs[k])
+
+
+def run_annotation_stages(args: Namespace, orthoManager: Orthophoto, asvManager: ASVManager, annotationMaker: AnnotationMaker, cache: StageCache, tiles_bounds_df: pd.DataFrame) -> None:
+    """ Stages after the tiles stage. """
+    annotation_filtered_gdf = cache.run("asv", *asvManager.stage_signature(), ["tiles"],
+                                        lambda: asvManager.compute_annotations(tiles_bounds_df), asvManager.load_annotations)
+
+    unlabeled_folder = cache.run("annotations", {}, {}, ["asv"],
+                                 lambda: annotationMaker.create_and_compute_annotations(annotation_filtered_gdf), annotationMaker.load_annotations)
+
+    if args.export_mode in SINGLE_FILE_EXPORT_MODES:
+        # Tiles are never moved, the tile index tells annotated and unlabeled tiles apart.
+        tiles_index_df = orthoManager.write_tiles_index(tiles_bounds_df, annotation_filtered_gdf["FileName"].unique())
+        if args.unlabeled == "write":
+            orthoManager.create_unlabeled_csv(unlabeled_folder, tiles_bounds_df, tiles_index_df.loc[~tiles_index_df["annotated"], "tile_png"].unique())
+    elif args.unlabeled == "write":
+        orthoManager.create_unlabeled_csv(unlabeled_folder, tiles_bounds_df)
 
-    # Split tif into tiles and filter on manual boundary
-    tiles_bounds_df = orthoManager.setup_ortho_tiles()
+    run_sweeps(args, asvManager, annotationMaker, cache, tiles_bounds_df, annotation_filtered_gdf)
 
-    annotation_filtered_gdf = asvManager.compute_annotations(tiles_bounds_df)
 
-    unlabeled_folder = annotationMaker.create_and_compute_annotations(annotation_filtered_gdf)
+def run_sweeps(args: Namespace, asvManager: ASVManager, annotationMaker: AnnotationMaker, cache: StageCache, tiles_bounds_df: pd.DataFrame, annotation_filtered_gdf: gpd.GeoDataFrame) -> None:
+    """ Sweeps reuse the tiles and footprints of the previous stages. """
+    if args.threshold_sets:
+        annotationMaker.create_binary_annotations_sweep(annotation_filtered_gdf, Path(args.threshold_sets))
 
-    orthoManager.create_unlabeled_csv(unlabeled_folder, tiles_bounds_df)
+    if args.footprint_thresholds:
+        inputs, params = asvManager.stage_signature()
+        params["footprint_thresholds"] = args.footprint_thresholds
+        cache.run("footprint_sweep", inputs, params, ["tiles"],
+                  lambda: annotationMaker.create_footprint_sweep(asvManager.compute_annotations_sweep(tiles_bounds_df, args.footprint_thresholds), args.footprint_thresholds),
+                  lambda: annotationMaker.load_footprint_sweep(args.footprint_thresholds))
 
 if __name__ == "__main__":
     args = parse_args()
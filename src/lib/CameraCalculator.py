@@ -41,6 +41,7 @@ class CameraCalculator:
         '''Get corners of the polygon captured by the camera on the ground. 
         The calculations are performed in the axes origin (0, 0, altitude)
         and the points are not yet translated to camera's X-Y coordinates.
+        Thin wrapper over getBoundingPolygons for a single pose.
         Parameters:
             FOVh (float): Horizontal field of view in radians
             FOVv (float): Vertical field of view in radians
@@ -51,178 +52,88 @@ class CameraCalculator:
         Returns:
             vector3d.vector.Vector: Array with 4 points defining a polygon
         '''
-        # import ipdb; ipdb.set_trace()
-        ray11 = CameraCalculator.ray1(FOVh, FOVv)
-        ray22 = CameraCalculator.ray2(FOVh, FOVv)
-        ray33 = CameraCalculator.ray3(FOVh, FOVv)
-        ray44 = CameraCalculator.ray4(FOVh, FOVv)
+        corners = CameraCalculator.getBoundingPolygons(FOVh, FOVv, [altitude], [roll], [pitch], [heading])[0]
+        return [Vector(float(x), float(y), float(z)) for x, y, z in corners]
 
-        rotatedVectors = CameraCalculator.rotateRays(
-                ray11, ray22, ray33, ray44, roll, pitch, heading)
-        
-        origin = Vector(0, 0, altitude)
-        intersections = CameraCalculator.getRayGroundIntersections(rotatedVectors, origin)
-
-        return intersections
-
-
-    # Ray-vectors defining the the camera's field of view. FOVh and FOVv are interchangeable
-    # depending on the camera's orientation
     @staticmethod
-    def ray1(FOVh, FOVv):
-        '''
-        tasto
+    def getBoundingPolygons(FOVh, FOVv, altitude, roll, pitch, heading):
+        '''Batched version of getBoundingPolygon.
+        All poses are rotated and intersected with the ground in one vectorized pass.
         Parameters:
             FOVh (float): Horizontal field of view in radians
             FOVv (float): Vertical field of view in radians
+            altitude (array-like): (N,) altitudes of the camera in meters
+            roll (array-like): (N,) rolls of the camera (x axis) in radians
+            pitch (array-like): (N,) pitches of the camera (y axis) in radians
+            heading (array-like): (N,) headings of the camera (z axis) in radians
         Returns:
-            vector3d.vector.Vector: normalised vector
+            numpy.ndarray: (N, 4, 3) array with the 4 corners (x, y, z) of each polygon
         '''
-        pass
-        ray = Vector(math.tan(FOVv/2), math.tan(FOVh/2), -1)
-        return ray.normalize()
+        altitude = np.asarray(altitude, dtype=np.float64)
+        rays = CameraCalculator.rays(FOVh, FOVv)
+        rotationMatrices = CameraCalculator.rotationMatrices(roll, pitch, heading)
 
-    @staticmethod
-    def ray2(FOVh, FOVv):
-        '''
-        Parameters:
-            FOVh (float): Horizontal field of view in radians
-            FOVv (float): Vertical field of view in radians
-        Returns:
-            vector3d.vector.Vector: normalised vector
-        '''
-        ray = Vector(math.tan(FOVv/2), -math.tan(FOVh/2), -1)
-        return ray.normalize()
+        # (N, 3, 3) x (4, 3) -> (N, 4, 3)
+        rotatedRays = np.einsum("nij,kj->nki", rotationMatrices, rays)
 
-    @staticmethod
-    def ray3(FOVh, FOVv):
-        '''
-        Parameters:
-            FOVh (float): Horizontal field of view in radians
-            FOVv (float): Vertical field of view in radians
-        Returns:
-            vector3d.vector.Vector: normalised vector
-        '''
-        ray = Vector(-math.tan(FOVv/2), -math.tan(FOVh/2), -1)
-        return ray.normalize()
+        # P = origin + ray * t with origin = (0, 0, altitude) and ground plane z = 0.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = -altitude[:, np.newaxis] / rotatedRays[:, :, 2]
+
+        intersections = rotatedRays * t[:, :, np.newaxis]
+        intersections[:, :, 2] += altitude[:, np.newaxis]
+        return intersections
 
     @staticmethod
-    def ray4(FOVh, FOVv):
-        '''
+    def rays(FOVh, FOVv):
+        '''Normalised ray-vectors ray1 to ray4 stacked in a (4, 3) array.
         Parameters:
             FOVh (float): Horizontal field of view in radians
             FOVv (float): Vertical field of view in radians
         Returns:
-            vector3d.vector.Vector: normalised vector
+            numpy.ndarray: (4, 3) array of normalised vectors
         '''
-        ray = Vector(-math.tan(FOVv/2), math.tan(FOVh/2), -1)
-        return ray.normalize()
-
-    @staticmethod
-    def rotateRays(ray1, ray2, ray3, ray4, roll, pitch, yaw):
-        """Rotates the four ray-vectors around all 3 axes
-        Parameters:
-            ray1 (vector3d.vector.Vector): First ray-vector
-            ray2 (vector3d.vector.Vector): Second ray-vector
-            ray3 (vector3d.vector.Vector): Third ray-vector
-            ray4 (vector3d.vector.Vector): Fourth ray-vector
-            roll float: Roll rotation
-            pitch float: Pitch rotation
-            yaw float: Yaw rotation
-        Returns:
-            Returns new rotated ray-vectors
-        """
-        sinAlpha = math.sin(yaw)
-        sinBeta = math.sin(pitch)
-        sinGamma = math.sin(roll)
-        cosAlpha = math.cos(yaw)
-        cosBeta = math.cos(pitch)
-        cosGamma = math.cos(roll)
-        m00 = cosAlpha * cosBeta
-        m01 = cosAlpha * sinBeta * sinGamma - sinAlpha * cosGamma
-        m02 = cosAlpha * sinBeta * cosGamma + sinAlpha * sinGamma
-        m10 = sinAlpha * cosBeta
-        m11 = sinAlpha * sinBeta * sinGamma + cosAlpha * cosGamma
-        m12 = sinAlpha * sinBeta * cosGamma - cosAlpha * sinGamma
-        m20 = -sinBeta
-        m21 = cosBeta * sinGamma
-        m22 = cosBeta * cosGamma
-        
-        # Matrix rotationMatrix = new Matrix(new double[][]{{m00, m01, m02}, {m10, m11, m12}, {m20, m21, m22}})
-        rotationMatrix = np.array([[m00, m01, m02], [m10, m11, m12], [m20, m21, m22]])
-
-        # Matrix ray1Matrix = new Matrix(new double[][]{{ray1.x}, {ray1.y}, {ray1.z}})
-        # Matrix ray2Matrix = new Matrix(new double[][]{{ray2.x}, {ray2.y}, {ray2.z}})
-        # Matrix ray3Matrix = new Matrix(new double[][]{{ray3.x}, {ray3.y}, {ray3.z}})
-        # Matrix ray4Matrix = new Matrix(new double[][]{{ray4.x}, {ray4.y}, {ray4.z}})
-        ray1Matrix = np.array([[ray1.x], [ray1.y], [ray1.z]])
-        ray2Matrix = np.array([[ray2.x], [ray2.y], [ray2.z]])
-        ray3Matrix = np.array([[ray3.x], [ray3.y], [ray3.z]])
-        ray4Matrix = np.array([[ray4.x], [ray4.y], [ray4.z]])
-        
-        res1 = rotationMatrix.dot(ray1Matrix)
-        res2 = rotationMatrix.dot(ray2Matrix)
-        res3 = rotationMatrix.dot(ray3Matrix)
-        res4 = rotationMatrix.dot(ray4Matrix)
-        
-        rotatedRay1 = Vector(res1[0, 0], res1[1, 0], res1[2, 0])
-        rotatedRay2 = Vector(res2[0, 0], res2[1, 0], res2[2, 0])
-        rotatedRay3 = Vector(res3[0, 0], res3[1, 0], res3[2, 0])
-        rotatedRay4 = Vector(res4[0, 0], res4[1, 0], res4[2, 0])
-        rayArray = [rotatedRay1, rotatedRay2, rotatedRay3, rotatedRay4]
-        
-        return rayArray
+        tanV, tanH = math.tan(FOVv/2), math.tan(FOVh/2)
+        rays = np.array([
+            [tanV, tanH, -1],
+            [tanV, -tanH, -1],
+            [-tanV, -tanH, -1],
+            [-tanV, tanH, -1]
+        ], dtype=np.float64)
+        return rays / np.linalg.norm(rays, axis=1, keepdims=True)
 
     @staticmethod
-    def getRayGroundIntersections(rays, origin):
-        """
-        Finds the intersections of the camera's ray-vectors 
-        and the ground approximated by a horizontal plane
+    def rotationMatrices(roll, pitch, yaw):
+        '''Rotation matrices around all 3 axes, built by broadcasting.
+        Same matrix as the rotation of the java rotateRays for each pose.
         Parameters:
-            rays (vector3d.vector.Vector[]): Array of 4 ray-vectors
-            origin (vector3d.vector.Vector): Position of the camera. The computation were developed 
-                                            assuming the camera was at the axes origin (0, 0, altitude) and the 
-                                            results translated by the camera's real position afterwards.
+            roll (array-like): (N,) roll rotations
+            pitch (array-like): (N,) pitch rotations
+            yaw (array-like): (N,) yaw rotations
         Returns:
-            vector3d.vector.Vector
-        """
-        # Vector3d [] intersections = new Vector3d[rays.length];
-        # for (int i = 0; i < rays.length; i ++) {
-        #     intersections[i] = CameraCalculator.findRayGroundIntersection(rays[i], origin);
-        # }
-        # return intersections
+            numpy.ndarray: (N, 3, 3) rotation matrices
+        '''
+        roll = np.asarray(roll, dtype=np.float64)
+        pitch = np.asarray(pitch, dtype=np.float64)
+        yaw = np.asarray(yaw, dtype=np.float64)
+
+        sinAlpha, cosAlpha = np.sin(yaw), np.cos(yaw)
+        sinBeta, cosBeta = np.sin(pitch), np.cos(pitch)
+        sinGamma, cosGamma = np.sin(roll), np.cos(roll)
+
+        rotationMatrices = np.empty(roll.shape + (3, 3), dtype=np.float64)
+        rotationMatrices[..., 0, 0] = cosAlpha * cosBeta
+        rotationMatrices[..., 0, 1] = cosAlpha * sinBeta * sinGamma - sinAlpha * cosGamma
+        rotationMatrices[..., 0, 2] = cosAlpha * sinBeta * cosGamma + sinAlpha * sinGamma
+        rotationMatrices[..., 1, 0] = sinAlpha * cosBeta
+        rotationMatrices[..., 1, 1] = sinAlpha * sinBeta * sinGamma + cosAlpha * cosGamma
+        rotationMatrices[..., 1, 2] = sinAlpha * sinBeta * cosGamma - cosAlpha * sinGamma
+        rotationMatrices[..., 2, 0] = -sinBeta
+        rotationMatrices[..., 2, 1] = cosBeta * sinGamma
+        rotationMatrices[..., 2, 2] = cosBeta * cosGamma
+        return rotationMatrices
 
-        # 1to1 translation without python syntax optimisation
-        intersections = []
-        for i in range(len(rays)):
-            intersections.append( CameraCalculator.findRayGroundIntersection(rays[i], origin) )
-        return intersections
 
-    @staticmethod
-    def findRayGroundIntersection(ray, origin):
-        """
-        Finds a ray-vector's intersection with the ground approximated by a planeç
-        Parameters:
-            ray (vector3d.vector.Vector): Ray-vector
-            origin (vector3d.vector.Vector): Camera's position
-        Returns:
-            vector3d.vector.Vector
-        """
-        # Parametric form of an equation
-        # P = origin + vector * t
-        x = Vector(origin.x,ray.x)
-        y = Vector(origin.y,ray.y)
-        z = Vector(origin.z,ray.z)
-        
-        # Equation of the horizontal plane (ground)
-        # -z = 0
-        
-        # Calculate t by substituting z
-        t = - (z.x / z.y)
-        
-        # Substitute t in the original parametric equations to get points of intersection
-        return Vector(x.x + x.y * t, y.x + y.y * t, z.x + z.y * t)
-    
 #################################################################
 #################################################################
 #################################################################
\ No newline at end of file
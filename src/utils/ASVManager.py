@@ -1,105 +1,194 @@
+import shapely
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import geopandas as gpd
 from pathlib import Path
 from argparse import Namespace
-from shapely.ops import unary_union
 
-from .tools import calculate_footprint
+from .tools import calculate_footprints, read_intermediate, write_intermediate
 from .BaseManager import BaseManager
+from .ASVMetadata import ASVMetadata
+from .RunReport import RunReport, report_stage
+
+# Geometry columns of annotation tiles, tile_bounds is the primary geometry.
+ANNOTATION_TILES_GEOMETRY_COLUMNS = ["tile_bounds", "geometry", "UnderwaterImageFootprint", "Intersection"]
 
 class ASVManager(BaseManager):
 
-    def __init__(self, args: Namespace) -> None:
-        BaseManager.__init__(self, args)
+    def __init__(self, args: Namespace, report: RunReport | None = None, dry_run: bool = False) -> None:
+        BaseManager.__init__(self, args, report, dry_run)
         
         self.annotations_plancha_filtered = gpd.GeoDataFrame()
+        self.footprints_by_frame = pd.Series(dtype=object)
+        # Annotation rows by footprint threshold of the sweep, filtered with the coverage of the asv stage.
+        self.annotations_sweep: dict[float, gpd.GeoDataFrame] = {}
+        self.asv_metadata_path = Path(self.config_env["ASV_CSV_METADATA_PATH"])
 
-    def compute_annotations(self, tiles_bounds: pd.DataFrame) -> gpd.GeoDataFrame:
-        self.filter_annotation_asv()
+    def load_annotations(self, name: str = "annotation_tiles") -> gpd.GeoDataFrame | None:
+        """ Annotation tiles of a previous run, None if missing. """
+        return read_intermediate(self.intermediate_path(name), ANNOTATION_TILES_GEOMETRY_COLUMNS, crs=self.args.matching_crs)
+
+    def write_annotations(self, annotation_tiles_gdf: gpd.GeoDataFrame, name: str = "annotation_tiles") -> None:
+        """ Save annotation tiles as an intermediate file. """
+        write_intermediate(annotation_tiles_gdf, self.intermediate_path(name), ANNOTATION_TILES_GEOMETRY_COLUMNS, self.args.matching_crs)
+
+    def stage_signature(self) -> tuple[dict[str, Path], dict]:
+        """ Input files and arguments the annotation tiles depend on. """
+        inputs = {
+            "asv_metadata": self.asv_metadata_path,
+            "manual_boundary": Path(self.config_env["MANUEL_BOUNDARY_PATH"])
+        }
+        params = {arg: getattr(self.args, arg) for arg in ["matching_crs", "fov_x", "fov_y", "footprint_threshold"]}
+        return inputs, params
+
+    def share_frames(self, asvManager: "ASVManager") -> None:
+        """ Reuse the frames and footprints loaded by the manager of another tile size. """
+        self.annotations_plancha_filtered = asvManager.annotations_plancha_filtered
+        self.footprints_by_frame = asvManager.footprints_by_frame
+
+    @report_stage
+    def compute_annotations(self, tiles_bounds: pd.DataFrame, name: str = "annotation_tiles") -> gpd.GeoDataFrame:
+        # Frames can be shared by the manager of another tile size.
+        if self.annotations_plancha_filtered.empty:
+            self.filter_annotation_asv()
         annotations_tiles = self.match_asv_annotations_with_tiles(tiles_bounds)
         annotation_tiles_gdf = self.compute_footprint(annotations_tiles)
 
-        annotation_tiles_gdf_filtered = self.filter_tiles_enough_underwater_coverage(annotation_tiles_gdf)
-        annotation_tiles_gdf_filtered.to_csv(Path(self.output_folder, "annotation_tiles.csv"), index=False)
+        annotation_tiles_gdf_filtered = self.filter_tiles_enough_underwater_coverage(annotation_tiles_gdf, self.args.footprint_thresholds)
+        self.write_annotations(annotation_tiles_gdf_filtered, name)
         return annotation_tiles_gdf_filtered
 
-    def filter_tiles_enough_underwater_coverage(self, annotation_tiles_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    @report_stage
+    def annotate_tiles(self, tiles_bounds: pd.DataFrame) -> gpd.GeoDataFrame:
+        """ Annotation tiles with enough underwater coverage, like compute_annotations but nothing is written. """
+        if self.annotations_plancha_filtered.empty:
+            self.load_frames_in_boundary()
+        annotations_tiles = self.match_asv_annotations_with_tiles(tiles_bounds)
+        annotation_tiles_gdf = self.compute_footprint(annotations_tiles)
+        return self.filter_tiles_enough_underwater_coverage(annotation_tiles_gdf)
+
+    @report_stage
+    def filter_annotations_on_exported_tiles(self, annotation_tiles_gdf: gpd.GeoDataFrame, tiles_bounds: pd.DataFrame) -> gpd.GeoDataFrame:
+        """ Drop annotations of planned tiles which were not exported, rejected by pixels thresholds. """
+        exported_tiles_bounds = shapely.to_wkb(tiles_bounds["bounds_polygon"].to_numpy())
+        is_exported = np.isin(shapely.to_wkb(annotation_tiles_gdf["tile_bounds"].to_numpy()), exported_tiles_bounds)
+        print(f"Annotated tiles rejected at export: {annotation_tiles_gdf.loc[~is_exported, 'FileName'].nunique()}")
+        return annotation_tiles_gdf[is_exported].copy()
+
+    @report_stage
+    def compute_annotations_sweep(self, tiles_bounds: pd.DataFrame, footprint_thresholds: list[float]) -> list[gpd.GeoDataFrame]:
+        """ Annotation tiles for each footprint threshold, tiles coverage is computed once for all thresholds. """
+        # Coverage computed by the asv stage of the same run is reused.
+        if all(footprint_threshold in self.annotations_sweep for footprint_threshold in footprint_thresholds):
+            annotations_sweep = [self.annotations_sweep[footprint_threshold] for footprint_threshold in footprint_thresholds]
+            # With --route_tiles the asv stage annotates planned tiles, tiles rejected at export are dropped.
+            if self.args.route_tiles:
+                annotations_sweep = [self.filter_annotations_on_exported_tiles(annotation_tiles_gdf, tiles_bounds) for annotation_tiles_gdf in annotations_sweep]
+            return annotations_sweep
+
+        # Frames can be loaded by the asv stage of the same run.
+        if self.annotations_plancha_filtered.empty:
+            self.filter_annotation_asv()
+        annotations_tiles = self.match_asv_annotations_with_tiles(tiles_bounds)
+        annotation_tiles_gdf = self.compute_footprint(annotations_tiles)
+
+        return self.filter_tiles_by_coverage(annotation_tiles_gdf, footprint_thresholds)
+
+    @report_stage
+    def filter_tiles_enough_underwater_coverage(self, annotation_tiles_gdf: gpd.GeoDataFrame, sweep_thresholds: list[float] | None = None) -> gpd.GeoDataFrame:
+        """ Annotation rows of tiles above the footprint threshold. Rows above each sweep threshold are kept in annotations_sweep. """
         print("\n\n-- func: Filter tiles with enough underwater coverage.")
-        
-        merged_footprints = annotation_tiles_gdf.groupby('FileName')['UnderwaterImageFootprint'].apply(unary_union).reset_index()
-        merged_footprints_gdf = gpd.GeoDataFrame(merged_footprints, geometry='UnderwaterImageFootprint')
-        merged_footprints_gdf.set_geometry('UnderwaterImageFootprint', inplace=True)
-        annotation_tiles_gdf.set_geometry('tile_bounds', inplace=True)
-        # Join the original gdf with the merged_footprints_gdf on FileName to get tile_bounds
-        merged_data = annotation_tiles_gdf.drop('UnderwaterImageFootprint', axis=1).merge(merged_footprints_gdf, on='FileName').copy()
-        # Calculate the intersection with the tile_bounds for each row
-        # Calculate the intersection
-        merged_data['Intersection'] = merged_data.apply(
-            lambda row: row['tile_bounds'].intersection(row['UnderwaterImageFootprint']), axis=1
-        )
-        # Calculate the area of the intersection polygon
-        # Note: This assumes that the geometries are in a CRS that uses meters for distance measurements.
-        # If they are in a geographic CRS (lat/lon), you will need to project them to a suitable projected CRS before calculating the area.
-        merged_data['IntersectionArea'] = merged_data['Intersection'].apply(lambda x: x.area)
-        merged_data['TileArea'] = merged_data['tile_bounds'].apply(lambda x: x.area)
-        tiles_above_threshold = merged_data[merged_data['IntersectionArea']/merged_data['TileArea'] >= self.args.footprint_threshold]
-        tiles_above_threshold = tiles_above_threshold.set_geometry('tile_bounds')
-        # filter annotation_tiles_gdf on the basis of images that are in tiles_above_threshold
-        annotation_tiles_gdf_filtered = annotation_tiles_gdf[annotation_tiles_gdf['FileName'].isin(tiles_above_threshold['FileName'])].copy()
-        # Calculate the intersection with the tile_bounds for each row
-        annotation_tiles_gdf_filtered['Intersection'] = annotation_tiles_gdf_filtered.apply(
-            lambda row: row['tile_bounds'].intersection(row['UnderwaterImageFootprint']) if row['tile_bounds'] is not None and row['UnderwaterImageFootprint'] is not None else None, axis=1
-        )
-        # Calculate the area of the intersection polygon
+        footprint_thresholds = list(dict.fromkeys([self.args.footprint_threshold, *(sweep_thresholds or [])]))
+        annotations_by_threshold = dict(zip(footprint_thresholds, self.filter_tiles_by_coverage(annotation_tiles_gdf, footprint_thresholds)))
+        self.annotations_sweep = annotations_by_threshold if sweep_thresholds else {}
+        return annotations_by_threshold[self.args.footprint_threshold]
+
+    def filter_tiles_by_coverage(self, annotation_tiles_gdf: gpd.GeoDataFrame, footprint_thresholds: list[float]) -> list[gpd.GeoDataFrame]:
+        """ Annotation rows of tiles whose footprints cover at least each threshold of their area.
+
+        The union of footprints by tile and the intersections by row are computed once, each threshold only selects rows.
+        """
+        tiles_names = annotation_tiles_gdf['FileName'].to_numpy()
+        tiles_bounds = np.asarray(annotation_tiles_gdf['tile_bounds'].to_numpy(), dtype=object)
+        footprints = np.asarray(annotation_tiles_gdf['UnderwaterImageFootprint'].to_numpy(), dtype=object)
+
+        # Union of the footprints of each tile, then one intersection by tile.
         # Note: This assumes that the geometries are in a CRS that uses meters for distance measurements.
-        # If they are in a geographic CRS (lat/lon), you will need to project them to a suitable projected CRS before calculating the area.
-        #annotation_tiles_gdf['IntersectionArea'] = annotation_tiles_gdf['Intersection'].apply(lambda x: x.area if x is not None else None)
-        annotation_tiles_gdf_filtered['TileArea'] = annotation_tiles_gdf_filtered['tile_bounds'].apply(lambda x: x.area if x is not None else None)
-        annotation_tiles_gdf_filtered['UnderwaterImageArea'] = annotation_tiles_gdf_filtered['UnderwaterImageFootprint'].apply(lambda x: x.area if x is not None else None)
-        annotation_tiles_gdf_filtered['IntersectionArea'] = annotation_tiles_gdf_filtered['Intersection'].apply(lambda x: x.area if x is not None else None)
+        merged_footprints = gpd.GeoDataFrame({'FileName': tiles_names}, geometry=footprints).dissolve(by='FileName')
+        merged_tiles_bounds = pd.Series(tiles_bounds, index=tiles_names).groupby(level=0).first().reindex(merged_footprints.index).to_numpy()
+
+        coverage_area = shapely.area(shapely.intersection(merged_tiles_bounds, merged_footprints.geometry.to_numpy()))
+        coverage_ratio = coverage_area / shapely.area(merged_tiles_bounds)
+        rows_coverage_ratio = pd.Series(coverage_ratio, index=merged_footprints.index).reindex(tiles_names).to_numpy()
+
+        # Rows kept by the lowest threshold are kept by no other threshold.
+        is_above_min_threshold = rows_coverage_ratio >= min(footprint_thresholds)
+        annotation_tiles_gdf_filtered = annotation_tiles_gdf[is_above_min_threshold].copy()
+        rows_coverage_ratio = rows_coverage_ratio[is_above_min_threshold]
+        tiles_bounds, footprints = tiles_bounds[is_above_min_threshold], footprints[is_above_min_threshold]
+
+        # Calculate the intersection with the tile_bounds for each row, None if one of them is None.
+        intersections = shapely.intersection(tiles_bounds, footprints)
+        annotation_tiles_gdf_filtered['Intersection'] = intersections
+        annotation_tiles_gdf_filtered['TileArea'] = shapely.area(tiles_bounds)
+        annotation_tiles_gdf_filtered['UnderwaterImageArea'] = shapely.area(footprints)
+        annotation_tiles_gdf_filtered['IntersectionArea'] = shapely.area(intersections)
+
         # set the correct geometry for tiles
         annotation_tiles_gdf_filtered = annotation_tiles_gdf_filtered.set_geometry('tile_bounds')
 
-        return annotation_tiles_gdf_filtered
+        annotation_tiles_by_threshold = []
+        for footprint_threshold in footprint_thresholds:
+            tiles_above_threshold = np.count_nonzero(coverage_ratio >= footprint_threshold)
+            print(f"Tiles with at least {footprint_threshold:g} underwater coverage: {tiles_above_threshold} / {len(coverage_ratio)}")
+            # Counters are by threshold, a sweep would add up the tiles of every threshold.
+            self.report.count(f"tiles_enough_coverage_{footprint_threshold:g}", tiles_above_threshold)
+            self.report.count(f"tiles_not_enough_coverage_{footprint_threshold:g}", len(coverage_ratio) - tiles_above_threshold)
 
+            is_above_threshold = rows_coverage_ratio >= footprint_threshold
+            annotation_tiles_by_threshold.append(annotation_tiles_gdf_filtered if is_above_threshold.all() else annotation_tiles_gdf_filtered[is_above_threshold].copy())
 
+        return annotation_tiles_by_threshold
+
+
+    @report_stage
     def compute_footprint(self, annotation_tiles: pd.DataFrame) -> gpd.GeoDataFrame:
         print("\n\n-- Compute footprint for each ASV frame.")
-        if not self.asv_metadata_path.exists() or not self.asv_metadata_path.is_file():
-            raise NameError(f"Orthophoto not found at path: {self.asv_metadata_path}")
-        
-        asv_metadata_df = pd.read_csv(self.asv_metadata_path)
-        
-        frames_to_compute = list(set(annotation_tiles["PlanchaFileName"].to_list()))
 
-        sub_asv_metadata_df = asv_metadata_df[asv_metadata_df["FileName"].isin(frames_to_compute)]
+        # Matched frames are inside the manual boundary, their metadata is already loaded.
+        # Footprints of frames matched by a previous grid are kept.
+        frames_to_compute = annotation_tiles["PlanchaFileName"].unique()
+        frames_to_compute = frames_to_compute[~pd.Index(frames_to_compute).isin(self.footprints_by_frame.index)]
 
-        sub_asv_metadata_df["footprint"] = sub_asv_metadata_df.apply(lambda row: calculate_footprint(row, self.args.fov_x, self.args.fov_y, self.args.matching_crs), axis=1)
+        sub_asv_metadata_df = self.annotations_plancha_filtered[self.annotations_plancha_filtered["FileName"].isin(frames_to_compute)].drop_duplicates("FileName")
 
-        sub_asv_metadata_gdf = gpd.GeoDataFrame(sub_asv_metadata_df, geometry='footprint').set_index("FileName")
+        self.report.count("frames_footprinted", len(sub_asv_metadata_df))
+        if len(sub_asv_metadata_df):
+            self.footprints_by_frame = pd.concat([self.footprints_by_frame, pd.Series(
+                calculate_footprints(sub_asv_metadata_df, self.args.fov_x, self.args.fov_y, self.args.matching_crs),
+                index=sub_asv_metadata_df["FileName"].to_numpy()
+            )])
 
-        # Prepare an empty list to hold the footprints
-        footprints = [sub_asv_metadata_gdf.loc[row['PlanchaFileName']]['footprint'] if row['PlanchaFileName'] in sub_asv_metadata_gdf.index else None for idx, row in tqdm(annotation_tiles.iterrows(), total=len(annotation_tiles))]
+        # Lookup the footprint of each matched frame, None when the frame is unknown.
+        footprints = self.footprints_by_frame.reindex(annotation_tiles["PlanchaFileName"]).to_numpy(dtype=object, copy=True)
+        footprints[pd.isna(footprints)] = None
 
         annotation_tiles_gdf = gpd.GeoDataFrame(annotation_tiles, geometry='geometry', crs=self.args.matching_crs)
-        annotation_tiles_gdf['UnderwaterImageFootprint'] = footprints
+        annotation_tiles_gdf['UnderwaterImageFootprint'] = list(footprints)
         
         return annotation_tiles_gdf
 
 
+    @report_stage
     def filter_annotation_asv(self) -> None:
         print("\n\n-- func: Load and filter asv annotations.")
 
-        self.asv_metadata_path = Path(self.config_env["ASV_CSV_METADATA_PATH"])
-        if not self.asv_metadata_path.exists() or not self.asv_metadata_path.is_file():
-            raise NameError(f"Orthophoto not found at path: {self.asv_metadata_path}")
-        
-        asv_metadata_df = pd.read_csv(self.asv_metadata_path)
+        self.load_frames_in_boundary()
+        write_intermediate(self.annotations_plancha_filtered, self.intermediate_path("annotation_plancha_filtered", ".geojson"), ["geometry"], self.args.matching_crs)
 
-        asv_metadata_gdf = gpd.GeoDataFrame(asv_metadata_df, geometry=gpd.points_from_xy(asv_metadata_df.GPSLongitude, asv_metadata_df.GPSLatitude, crs="EPSG:4326"))
-        asv_metadata_gdf.to_crs(self.args.matching_crs, inplace=True)
 
+    def load_frames_in_boundary(self) -> None:
+        """ Load the ASV frames inside the manual boundary, nothing is written. """
         manual_boundary_path = Path(self.config_env["MANUEL_BOUNDARY_PATH"])
         if not manual_boundary_path.exists():
             raise NameError(f"Manual boundary file not found at path {manual_boundary_path}")
@@ -109,29 +198,37 @@ class ASVManager(BaseManager):
         # Assuming there's only one polygon in the GeoJSON
         polygon = polygon_df.geometry.iloc[0]
 
-        self.annotations_plancha_filtered = asv_metadata_gdf[asv_metadata_gdf.geometry.within(polygon)]
+        # Csv is parsed by chunks, or read from its Parquet cache, and only frames inside the polygon are kept.
+        asv_metadata = ASVMetadata(self.asv_metadata_path, self.args.asv_chunksize, write_cache=not self.dry_run)
+        asv_metadata_df = asv_metadata.load_within(polygon, self.args.matching_crs)
+        self.report.count("frames_read", asv_metadata.rows_read)
+        self.report.count("frames_in_boundary", len(asv_metadata_df))
 
-        self.annotations_plancha_filtered.to_file(Path(self.output_folder, "annotation_plancha_filtered.geojson"), driver='GeoJSON')
+        points = gpd.points_from_xy(asv_metadata_df.pop("x"), asv_metadata_df.pop("y"), crs=self.args.matching_crs)
+        self.annotations_plancha_filtered = gpd.GeoDataFrame(asv_metadata_df, geometry=points)
     
 
+    @report_stage
     def match_asv_annotations_with_tiles(self, tiles_bounds: pd.DataFrame) -> pd.DataFrame:
         print("\n\n-- func: Match asv annotations position with tiles bounds.")
 
-        annotation_tiles = pd.DataFrame()
-        for i, row in tqdm(tiles_bounds.iterrows(), total=len(tiles_bounds)):
-            annotations_clipped = self.annotations_plancha_filtered[self.annotations_plancha_filtered.within(row["bounds_polygon"])].copy()
- 
-            if len(annotations_clipped) <= 0: continue
+        # Frames without attitude cannot have a footprint.
+        annotations_plancha = self.annotations_plancha_filtered.dropna(subset=['GPSRoll', 'GPSPitch', 'GPSTrack'])
 
-            annotations_clipped["PlanchaFileName"] = annotations_clipped.apply(lambda row: row["FileName"], axis=1)
-            annotations_clipped["FileName"] = row["tile_png"]
+        # Index tiles once and query all points at the same time. Tiles can overlap, so a point can match many tiles.
+        tiles_polygons = tiles_bounds["bounds_polygon"].to_numpy()
+        tree = shapely.STRtree(tiles_polygons)
+        point_idx, tile_idx = tree.query(annotations_plancha.geometry.values, predicate="within")
 
-            annotations_clipped["tile_bounds"] = row["bounds_polygon"]
-            annotation_tiles = pd.concat([annotation_tiles, annotations_clipped])
-        
-        annotation_tiles = annotation_tiles.dropna(subset=['GPSRoll'])
-        annotation_tiles = annotation_tiles.dropna(subset=['GPSPitch'])
-        annotation_tiles = annotation_tiles.dropna(subset=['GPSTrack'])
+        # Keep tiles order then points order.
+        order = np.lexsort((point_idx, tile_idx))
+        point_idx, tile_idx = point_idx[order], tile_idx[order]
+
+        annotation_tiles = annotations_plancha.iloc[point_idx].copy()
+        annotation_tiles["PlanchaFileName"] = annotation_tiles["FileName"]
+        annotation_tiles["FileName"] = tiles_bounds["tile_png"].to_numpy()[tile_idx]
+        annotation_tiles["tile_bounds"] = tiles_polygons[tile_idx]
+        self.report.count("annotation_rows_matched", len(annotation_tiles))
 
         # annotation_tiles.to_csv(Path(self.output_folder, "annotation_tiles.csv"), index=False)
 
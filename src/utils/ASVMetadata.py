@@ -0,0 +1,138 @@
+import os
+import json
+import shapely
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from pathlib import Path
+from typing import Iterator
+from shapely.geometry import Polygon
+
+from .tools import get_transformer
+
+# Columns of the ASV csv which are not class probabilities.
+METADATA_DTYPES = {
+    "FileName": "string",
+    "SubSecDateTimeOriginal": "string",
+    "GPSTrack": "float64",
+    "GPSRoll": "float64",
+    "GPSPitch": "float64",
+    "GPSAltitude": "float64",
+    "GPSLatitude": "float64",
+    "GPSLongitude": "float64",
+}
+
+# Class probabilities don't need double precision.
+CLASS_DTYPE = "float32"
+
+
+class ASVMetadata:
+    """ Columnar access to the ASV metadata csv.
+
+    The csv is parsed once, in chunks, with explicit dtypes. Each parsed chunk is appended to a Parquet
+    cache next to the csv, keyed on the csv size and mtime, so later runs read the cache instead
+    of parsing the csv again, unless write_cache is False. Frames are filtered chunk by chunk so the full csv is never held in memory.
+    """
+
+    CACHE_METADATA_KEY = b"drone_upscaling_source_csv"
+
+    def __init__(self, csv_path: Path, chunksize: int = 100_000, write_cache: bool = True) -> None:
+        self.csv_path = csv_path
+        self.write_cache = write_cache
+        self.cache_path = csv_path.with_suffix(".parquet")
+        self.chunksize = chunksize
+        self.rows_read = 0
+
+        if not self.csv_path.exists() or not self.csv_path.is_file():
+            raise NameError(f"ASV metadata file not found at path: {self.csv_path}")
+
+
+    def source_signature(self) -> dict:
+        """ Size and mtime of the csv, stored in the cache to detect a modified csv. """
+        stat = self.csv_path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+    def has_valid_cache(self) -> bool:
+        """ True if the Parquet cache exists and was built from the current csv. """
+        if not self.cache_path.exists(): return False
+        try:
+            schema_metadata = pq.read_schema(self.cache_path).metadata or {}
+        except (OSError, pa.ArrowInvalid):
+            return False
+        return schema_metadata.get(self.CACHE_METADATA_KEY) == json.dumps(self.source_signature()).encode()
+
+
+    def csv_dtypes(self) -> dict[str, str]:
+        """ Explicit dtypes of the csv columns, inferred on the first chunk for columns which are not metadata.
+
+        Numeric columns are class probabilities, downcast to CLASS_DTYPE. Other columns are kept as text.
+        """
+        sample = pd.read_csv(self.csv_path, nrows=self.chunksize, dtype=METADATA_DTYPES)
+        return {
+            column: METADATA_DTYPES.get(column, CLASS_DTYPE if pd.api.types.is_numeric_dtype(sample[column]) else "string")
+            for column in sample.columns
+        }
+
+
+    def iter_chunks(self, columns: list[str] | None = None) -> Iterator[pd.DataFrame]:
+        """ Yield the metadata by chunks, from the Parquet cache if valid, else from the csv while building the cache. """
+        if self.has_valid_cache():
+            parquet_file = pq.ParquetFile(self.cache_path, memory_map=True)
+            for batch in parquet_file.iter_batches(batch_size=self.chunksize, columns=columns):
+                yield batch.to_pandas()
+            return
+
+        # Missions sharing the csv can build the cache at the same time, each one writes its own file.
+        tmp_path = self.cache_path.with_suffix(f".parquet.{os.getpid()}.tmp")
+        schema_metadata = {self.CACHE_METADATA_KEY: json.dumps(self.source_signature()).encode()}
+        writer, write_cache, is_complete = None, self.write_cache, False
+        try:
+            for chunk in pd.read_csv(self.csv_path, dtype=self.csv_dtypes(), chunksize=self.chunksize):
+                if write_cache:
+                    try:
+                        if writer is None:
+                            schema = pa.Schema.from_pandas(chunk, preserve_index=False).with_metadata(schema_metadata)
+                            writer = pq.ParquetWriter(tmp_path, schema)
+                        writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+                    except OSError as error:
+                        # Read only folder for example, continue without cache.
+                        print(f"[WARNING] Cannot write ASV metadata cache {self.cache_path}: {error}")
+                        write_cache = False
+                yield chunk if columns is None else chunk[columns]
+            is_complete = True
+        finally:
+            if writer is not None:
+                writer.close()
+
+            # A consumer stopping early or an error leaves a partial file, only a complete cache is renamed.
+            if is_complete and write_cache and writer is not None:
+                tmp_path.replace(self.cache_path)
+            else:
+                tmp_path.unlink(missing_ok=True)
+
+
+    def load_within(self, polygon: Polygon, crs: str) -> pd.DataFrame:
+        """ Frames whose position, projected to crs, is strictly inside polygon. Also set x and y columns in crs. """
+        shapely.prepare(polygon)
+        min_x, min_y, max_x, max_y = polygon.bounds
+        transformer = get_transformer("epsg:4326", f"epsg:{crs}")
+
+        kept_chunks = []
+        for chunk in tqdm(self.iter_chunks(), desc="Reading ASV metadata", unit="chunk"):
+            self.rows_read += len(chunk)
+            x, y = transformer.transform(chunk["GPSLongitude"].to_numpy(), chunk["GPSLatitude"].to_numpy())
+
+            # Cheap bounding box test, then the exact test on the remaining frames.
+            is_candidate = np.flatnonzero((x > min_x) & (x < max_x) & (y > min_y) & (y < max_y))
+            is_inside = is_candidate[shapely.contains_xy(polygon, x[is_candidate], y[is_candidate])]
+
+            kept_chunk = chunk.iloc[is_inside].copy()
+            kept_chunk["x"], kept_chunk["y"] = x[is_inside], y[is_inside]
+            kept_chunks.append(kept_chunk)
+
+        if not kept_chunks:
+            return pd.DataFrame(columns=list(self.csv_dtypes()) + ["x", "y"])
+        return pd.concat(kept_chunks, ignore_index=True)
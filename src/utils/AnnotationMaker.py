@@ -1,152 +1,287 @@
 from argparse import Namespace
+import json
 import shutil
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import geopandas as gpd
 from pathlib import Path
-from pyproj import Transformer
 
-from .BaseManager import BaseManager
-from .tools import calculate_probability_from_binary_fine_scale, calculate_probability_from_probs_fine_scale
+from .BaseManager import BaseManager, SINGLE_FILE_EXPORT_MODES
+from .RunReport import RunReport, report_stage
+from .TileEncoder import TILE_FORMATS
+from .tools import aggregate_probabilities_fine_scale, calculate_probabilities_fine_scale, get_transformer
+
+# https://huggingface.co/lombardata/DinoVdeau-large-2024_04_03-with_data_aug_batch-size32_epochs150_freeze/blob/main/threshold.json
+THRESHOLD_CLASSES = {"Acropore_branched": 0.351, "Acropore_digitised": 0.349, "Acropore_sub_massive": 0.123, "Acropore_tabular": 0.415, "Algae_assembly": 0.434, "Algae_drawn_up": 0.193, "Algae_limestone": 0.346, "Algae_sodding": 0.41, "Atra/Leucospilota": 0.586, "Bleached_coral": 0.408, "Blurred": 0.3, "Dead_coral": 0.407, "Fish": 0.466, "Homo_sapiens": 0.402, "Human_object": 0.343, "Living_coral": 0.208, "Millepore": 0.292, "No_acropore_encrusting": 0.227, "No_acropore_foliaceous": 0.462, "No_acropore_massive": 0.333, "No_acropore_solitary": 0.415, "No_acropore_sub_massive": 0.377, "Rock": 0.476, "Sand": 0.548, "Rubble": 0.417, "Sea_cucumber": 0.357, "Sea_urchins": 0.335, "Sponge": 0.152, "Syringodium_isoetifolium": 0.476, "Thalassodendron_ciliatum": 0.209, "Useless": 0.315}
+
+# Columns of annotation tiles which are not classes.
+NON_CLASS_COLUMNS = ['FileName', 'SubSecDateTimeOriginal','GPSTrack', 'GPSRoll', 'GPSPitch', 'GPSAltitude', 'GPSLatitude','GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds','UnderwaterImageFootprint', 'Intersection', 'TileArea','UnderwaterImageArea', 'IntersectionArea']
+
+# Algae classes merged in a single Algae class.
+ALGAE_COLUMNS = ['Algae_assembly', 'Algae_limestone', 'Algae_sodding', 'Algae_drawn_up']
 
 class AnnotationMaker(BaseManager):
 
-    def __init__(self, args: Namespace) -> None:
-        super().__init__(args)
+    def __init__(self, args: Namespace, report: RunReport | None = None, dry_run: bool = False) -> None:
+        super().__init__(args, report, dry_run)
+
+    def load_annotations(self) -> Path | None:
+        """ Unlabeled folder of a previous run, None if outputs are missing. """
+        outputs = [
+            Path(self.output_folder, "annotations_tiles_from_probs_fine_scale.csv"),
+            Path(self.output_folder, "annotations_tiles_from_binary_fine_scale.csv")
+        ]
+        if self.args.export_mode not in SINGLE_FILE_EXPORT_MODES:
+            outputs.append(self.unlabeled_folder)
+        if not all(output.exists() for output in outputs):
+            return None
+        return self.unlabeled_folder
+
 
+    @report_stage
     def create_and_compute_annotations(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame) -> Path: 
 
         binary_annotation_df = self.create_binary_annotations_for_tiles(annotation_tiles_gdf_filtered)
         annotations_tiles_from_binary_fine_scale = self.create_probability_annotations_for_tiles(annotation_tiles_gdf_filtered, binary_annotation_df)
+        # Routed tiles are already in their final folder, tiles of a single file are never moved.
+        if self.args.route_tiles or self.args.export_mode in SINGLE_FILE_EXPORT_MODES:
+            return self.unlabeled_folder
+
         unlabeled_folder = self.move_images_by_annotations(annotations_tiles_from_binary_fine_scale)
         return unlabeled_folder
     
 
+    @report_stage
     def move_images_by_annotations(self, df_anno) -> Path:
         print("\n\n-- func: Copy images into annotated and unlabeled folder.")
         
-        annotated_dir = Path(self.output_folder, 'annotated_images_png')
+        annotated_dir = self.annotated_folder
         annotated_dir.mkdir(exist_ok=True, parents=True)
 
-        unlabeled_dir = Path(self.output_folder, "unlabeled_images_png")
+        unlabeled_dir = self.unlabeled_folder
         unlabeled_dir.mkdir(exist_ok=True, parents=True)
 
         df_anno.set_index("FileName", inplace=True)
 
-        for file_png in tqdm(self.tiles_png_folder.iterdir()):
-            if not file_png.is_file() or file_png.suffix.lower() != ".png": continue
+        # Tiles already sorted by a previous run are sorted again.
+        tiles_png = [file_png for folder in [self.tiles_png_folder, annotated_dir, unlabeled_dir] for file_png in folder.iterdir()]
+
+        for file_png in tqdm(tiles_png):
+            if not file_png.is_file() or file_png.suffix.lower() != self.tile_suffix: continue
 
             output_path = Path(annotated_dir, file_png.name) if file_png.stem in df_anno.index else Path(unlabeled_dir, file_png.name)
+            if output_path == file_png: continue
 
             shutil.move(file_png, output_path)
+            self.report.count("tiles_moved")
+
+            # Keep the world file next to its tile.
+            world_file_suffix = TILE_FORMATS[self.args.tile_format]["world_file_suffix"]
+            if world_file_suffix and file_png.with_suffix(world_file_suffix).exists():
+                shutil.move(file_png.with_suffix(world_file_suffix), output_path.with_suffix(world_file_suffix))
 
         self.tiles_png_folder.rmdir()
         return unlabeled_dir
 
 
+    @report_stage
     def create_binary_annotations_for_tiles(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame):
         print("\n\n-- func: Create binary annotations.")
-        # https://huggingface.co/lombardata/DinoVdeau-large-2024_04_03-with_data_aug_batch-size32_epochs150_freeze/blob/main/threshold.json
-        threshold_classes = {"Acropore_branched": 0.351, "Acropore_digitised": 0.349, "Acropore_sub_massive": 0.123, "Acropore_tabular": 0.415, "Algae_assembly": 0.434, "Algae_drawn_up": 0.193, "Algae_limestone": 0.346, "Algae_sodding": 0.41, "Atra/Leucospilota": 0.586, "Bleached_coral": 0.408, "Blurred": 0.3, "Dead_coral": 0.407, "Fish": 0.466, "Homo_sapiens": 0.402, "Human_object": 0.343, "Living_coral": 0.208, "Millepore": 0.292, "No_acropore_encrusting": 0.227, "No_acropore_foliaceous": 0.462, "No_acropore_massive": 0.333, "No_acropore_solitary": 0.415, "No_acropore_sub_massive": 0.377, "Rock": 0.476, "Sand": 0.548, "Rubble": 0.417, "Sea_cucumber": 0.357, "Sea_urchins": 0.335, "Sponge": 0.152, "Syringodium_isoetifolium": 0.476, "Thalassodendron_ciliatum": 0.209, "Useless": 0.315}
 
         # create a dataframe like annotation_tiles_gdf_filtered but with binary values (True, False) based on threshold_classes
         binary_annotation_df = annotation_tiles_gdf_filtered.copy()
-        for class_name, threshold in threshold_classes.items():
+        for class_name, threshold in THRESHOLD_CLASSES.items():
             binary_annotation_df[class_name] = binary_annotation_df[class_name] > threshold
 
-        class_columns = []
-
-        # define class columns, all columns except FileName, 'SubSecDateTimeOriginal','GPSTrack', 'GPSRoll', 'GPSPitch', 'GPSAltitude', 'GPSLatitude','GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds','UnderwaterImageFootprint', 'Intersection', 'TileArea','UnderwaterImageArea', 'IntersectionArea',
-        class_columns = [col for col in binary_annotation_df.columns if col not in ['FileName', 'SubSecDateTimeOriginal','GPSTrack', 'GPSRoll', 'GPSPitch', 'GPSAltitude', 'GPSLatitude','GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds','UnderwaterImageFootprint', 'Intersection', 'TileArea','UnderwaterImageArea', 'IntersectionArea']]
-        # Define the algae columns
-        algae_columns = ['Algae_assembly', 'Algae_limestone', 'Algae_sodding', 'Algae_drawn_up']
         # Create the new Algae column
-        binary_annotation_df['Algae'] = binary_annotation_df[algae_columns].any(axis=1)
-        for algae_class in algae_columns :
-            if algae_class in class_columns :
-                class_columns.remove(algae_class)
-        class_columns.append('Algae')
-
-        binary_annotation_df = binary_annotation_df.drop(columns=algae_columns)
+        binary_annotation_df['Algae'] = binary_annotation_df[ALGAE_COLUMNS].any(axis=1)
+        binary_annotation_df = binary_annotation_df.drop(columns=ALGAE_COLUMNS)
 
         return binary_annotation_df
     
 
+    @report_stage
     def create_probability_annotations_for_tiles(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame, binary_annotation_df):
         print("\n\n-- func: Create probability annotations.")
-        
-        classes = []
-        # define class columns, all columns except FileName, 'SubSecDateTimeOriginal','GPSTrack', 'GPSRoll', 'GPSPitch', 'GPSAltitude', 'GPSLatitude','GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds','UnderwaterImageFootprint', 'Intersection', 'TileArea','UnderwaterImageArea', 'IntersectionArea',
-        classes = [col for col in annotation_tiles_gdf_filtered.columns if col not in ['FileName', 'SubSecDateTimeOriginal','GPSTrack', 'GPSRoll', 'GPSPitch', 'GPSAltitude', 'GPSLatitude','GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds','UnderwaterImageFootprint', 'Intersection', 'TileArea','UnderwaterImageArea', 'IntersectionArea']]
-        # Define the algae columns
-        algae_columns = ['Algae_assembly', 'Algae_limestone', 'Algae_sodding', 'Algae_drawn_up']
+
+        annotations_tiles_from_probs_fine_scale, annotations_tiles_from_binary_fine_scale = self.compute_tiles_annotations(annotation_tiles_gdf_filtered, binary_annotation_df)
+
+        # Merging centroid information
+        centroids_df = self.get_tiles_centroids(annotation_tiles_gdf_filtered)
+        annotations_tiles_from_probs_fine_scale = pd.merge(annotations_tiles_from_probs_fine_scale, centroids_df, on='FileName', how='left')
+        annotations_tiles_from_binary_fine_scale = pd.merge(annotations_tiles_from_binary_fine_scale, centroids_df, on='FileName', how='left')
+
+        annotations_tiles_from_probs_fine_scale_path = Path(self.output_folder, "annotations_tiles_from_probs_fine_scale.csv")
+        annotations_tiles_from_binary_fine_scale_path = Path(self.output_folder, "annotations_tiles_from_binary_fine_scale.csv")
+        annotations_tiles_from_probs_fine_scale.to_csv(annotations_tiles_from_probs_fine_scale_path, index=False)
+        annotations_tiles_from_binary_fine_scale.to_csv(annotations_tiles_from_binary_fine_scale_path, index=False)
+        self.report.count("tiles_annotated", len(annotations_tiles_from_probs_fine_scale))
+
+        return annotations_tiles_from_binary_fine_scale
+
+
+    def compute_tiles_annotations(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame, binary_annotation_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """ Probability and binary fine scale annotations of each tile, FileName then classes in alphabetic order. Nothing is written. """
+        classes = self.get_classes(annotation_tiles_gdf_filtered)
+
         # Create the new Algae column
-        annotation_tiles_gdf_filtered['Algae'] = annotation_tiles_gdf_filtered[algae_columns].max(axis=1)
-        for algae_class in algae_columns :
-            if algae_class in classes :
-                classes.remove(algae_class)
-        classes.append('Algae')
+        annotation_tiles_gdf_filtered['Algae'] = annotation_tiles_gdf_filtered[ALGAE_COLUMNS].max(axis=1)
 
         # Print the identified classes to debug
         print("Identified classes:", classes)
 
-        # Create a new DataFrame to store the results
-        annotations_tiles_from_binary_fine_scale = pd.DataFrame(columns=['FileName'] + classes)
-        annotations_tiles_from_probs_fine_scale = pd.DataFrame(columns=['FileName'] + classes)
-
-        # Compute tiles annotations based on binary fine scale predictions
-        for file_name, group in binary_annotation_df.groupby('FileName'):
-            probabilities = {class_name: calculate_probability_from_binary_fine_scale(group, class_name) for class_name in classes}
-            probabilities['FileName'] = file_name 
-            probabilities['GPSLatitude'] = group['GPSLatitude'].iloc[0]
-            probabilities['GPSLongitude'] = group['GPSLongitude'].iloc[0]
-            annotations_tiles_from_binary_fine_scale = pd.concat([annotations_tiles_from_binary_fine_scale, pd.DataFrame([probabilities])], ignore_index=True)
-     
-        # clean probabilities dict
-        probabilities = {class_name: 0.0 for class_name in classes}
-
-        # Compute tiles annotations based on probability fine scale predictions
-        for file_name, group in annotation_tiles_gdf_filtered.groupby('FileName'):
-            probabilities = {class_name: calculate_probability_from_probs_fine_scale(group, class_name) for class_name in classes}
-            probabilities['FileName'] = file_name
-            probabilities['GPSLatitude'] = group['GPSLatitude'].iloc[0]
-            probabilities['GPSLongitude'] = group['GPSLongitude'].iloc[0]
-            annotations_tiles_from_probs_fine_scale = pd.concat([annotations_tiles_from_probs_fine_scale, pd.DataFrame([probabilities])], ignore_index=True)
-    
+        # Compute tiles annotations based on binary and probability fine scale predictions
+        annotations_tiles_from_binary_fine_scale = calculate_probabilities_fine_scale(binary_annotation_df, classes).reset_index()
+        annotations_tiles_from_probs_fine_scale = calculate_probabilities_fine_scale(annotation_tiles_gdf_filtered, classes).reset_index()
+
         # order class columns by alphabetic order in annotations_tiles_from_probs_fine_scale
-        annotations_tiles_from_probs_fine_scale = annotations_tiles_from_probs_fine_scale[['FileName', 'GPSLatitude', 'GPSLongitude'] + sorted(classes)]
-        annotations_tiles_from_binary_fine_scale = annotations_tiles_from_binary_fine_scale[['FileName', 'GPSLatitude', 'GPSLongitude'] + sorted(classes)]
+        annotations_tiles_from_probs_fine_scale = annotations_tiles_from_probs_fine_scale[['FileName'] + sorted(classes)]
+        annotations_tiles_from_binary_fine_scale = annotations_tiles_from_binary_fine_scale[['FileName'] + sorted(classes)]
+
+        return annotations_tiles_from_probs_fine_scale, annotations_tiles_from_binary_fine_scale
+
+
+    @report_stage
+    def create_binary_annotations_sweep(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame, threshold_sets_path: Path) -> Path:
+        """ Binary fine scale annotations for K threshold sets in a single pass.
+
+        The (rows x classes) probabilities are compared to the (K x classes) thresholds by broadcasting,
+        then the K binary matrices are aggregated together. One csv is written by threshold set.
+        """
+        print("\n\n-- func: Create binary annotations for each threshold set.")
+
+        threshold_sets = self.load_threshold_sets(threshold_sets_path)
+        classes = self.get_classes(annotation_tiles_gdf_filtered)
+        other_classes = [class_name for class_name in classes if class_name != 'Algae']
+
+        # Classes without threshold keep their probability, as in create_binary_annotations_for_tiles.
+        is_thresholded = np.array([class_name in THRESHOLD_CLASSES for class_name in other_classes])
+
+        # (rows, classes) > (K, 1, classes) -> (K, rows, classes)
+        probabilities = annotation_tiles_gdf_filtered[other_classes].to_numpy()
+        algae_probabilities = annotation_tiles_gdf_filtered[ALGAE_COLUMNS].to_numpy()
+        # Thresholds take the probabilities dtype, as for a comparison between a column and a float.
+        thresholds = np.array([[threshold_set.get(class_name, THRESHOLD_CLASSES.get(class_name, 0)) for class_name in other_classes] for threshold_set in threshold_sets.values()], dtype=probabilities.dtype)
+        algae_thresholds = np.array([[threshold_set.get(class_name, THRESHOLD_CLASSES[class_name]) for class_name in ALGAE_COLUMNS] for threshold_set in threshold_sets.values()], dtype=algae_probabilities.dtype)
+        binary = np.where(is_thresholded, probabilities[np.newaxis] > thresholds[:, np.newaxis], probabilities[np.newaxis])
+        binary_algae = (algae_probabilities[np.newaxis] > algae_thresholds[:, np.newaxis]).any(axis=2, keepdims=True)
+
+        # Merge algae classes and lay the K sets side by side: (rows, K * classes).
+        binary_classes = np.concatenate([binary, binary_algae], axis=2)
+        binary_classes = binary_classes.transpose(1, 0, 2).reshape(len(annotation_tiles_gdf_filtered), -1)
+
+        tiles_names, tiles_probabilities = aggregate_probabilities_fine_scale(
+            binary_classes.astype(np.float64),
+            (annotation_tiles_gdf_filtered['IntersectionArea'] / annotation_tiles_gdf_filtered['UnderwaterImageArea']).to_numpy(dtype=np.float64),
+            annotation_tiles_gdf_filtered['FileName'].to_numpy()
+        )
+
+        sweep_folder = Path(self.output_folder, "threshold_sweep")
+        sweep_folder.mkdir(exist_ok=True, parents=True)
+        centroids_df = self.get_tiles_centroids(annotation_tiles_gdf_filtered)
+
+        for k, set_name in enumerate(threshold_sets):
+            annotations_tiles = pd.DataFrame(tiles_probabilities[:, k * len(classes):(k + 1) * len(classes)], columns=other_classes + ['Algae'])
+            annotations_tiles.insert(0, 'FileName', tiles_names)
+            annotations_tiles = annotations_tiles[['FileName'] + sorted(classes)]
+            annotations_tiles = pd.merge(annotations_tiles, centroids_df, on='FileName', how='left')
+            annotations_tiles.to_csv(Path(sweep_folder, f"annotations_tiles_from_binary_fine_scale_{set_name}.csv"), index=False)
+
+        with open(Path(sweep_folder, "threshold_sets.json"), "w") as threshold_sets_file:
+            json.dump(threshold_sets, threshold_sets_file, indent=4)
+
+        print(f"-- func: {len(threshold_sets)} threshold sets saved to: {sweep_folder}")
+        return sweep_folder
+
+
+    def footprint_sweep_folder(self, footprint_threshold: float) -> Path:
+        """ Output folder of one footprint threshold of the sweep. """
+        return Path(self.output_folder, "footprint_sweep", f"footprint_threshold_{footprint_threshold:g}")
+
+
+    def load_footprint_sweep(self, footprint_thresholds: list[float]) -> Path | None:
+        """ Footprint sweep folder of a previous run, None if an output is missing. """
+        for footprint_threshold in footprint_thresholds:
+            for annotations_type in ["probs", "binary"]:
+                if not Path(self.footprint_sweep_folder(footprint_threshold), f"annotations_tiles_from_{annotations_type}_fine_scale.csv").exists():
+                    return None
+        return Path(self.output_folder, "footprint_sweep")
+
+
+    @report_stage
+    def create_footprint_sweep(self, annotation_tiles_by_threshold: list[gpd.GeoDataFrame], footprint_thresholds: list[float]) -> Path:
+        """ Probability and binary fine scale annotations of the tiles kept by each footprint threshold, side by side. """
+        print("\n\n-- func: Create annotations for each footprint threshold.")
+
+        summary = {}
+        for annotation_tiles_gdf_filtered, footprint_threshold in zip(annotation_tiles_by_threshold, footprint_thresholds):
+            threshold_folder = self.footprint_sweep_folder(footprint_threshold)
+            threshold_folder.mkdir(exist_ok=True, parents=True)
+
+            if len(annotation_tiles_gdf_filtered) == 0:
+                print(f"[WARNING] No tile with footprint threshold {footprint_threshold:g}")
+                annotations_by_type = {annotations_type: pd.DataFrame(columns=['FileName']) for annotations_type in ["probs", "binary"]}
+            else:
+                binary_annotation_df = self.create_binary_annotations_for_tiles(annotation_tiles_gdf_filtered)
+                probs_df, binary_df = self.compute_tiles_annotations(annotation_tiles_gdf_filtered, binary_annotation_df)
+                centroids_df = self.get_tiles_centroids(annotation_tiles_gdf_filtered)
+                annotations_by_type = {
+                    "probs": pd.merge(probs_df, centroids_df, on='FileName', how='left'),
+                    "binary": pd.merge(binary_df, centroids_df, on='FileName', how='left')
+                }
+
+            for annotations_type, annotations_tiles in annotations_by_type.items():
+                annotations_tiles.to_csv(Path(threshold_folder, f"annotations_tiles_from_{annotations_type}_fine_scale.csv"), index=False)
+            summary[f"{footprint_threshold:g}"] = {"tiles": len(annotations_by_type["probs"]), "annotation_rows": len(annotation_tiles_gdf_filtered)}
+
+        sweep_folder = Path(self.output_folder, "footprint_sweep")
+        with open(Path(sweep_folder, "footprint_sweep.json"), "w") as summary_file:
+            json.dump(summary, summary_file, indent=4)
 
-        # Calculate centroids for each FileName
-        centroids = annotation_tiles_gdf_filtered.dissolve(by='FileName').centroid
-        # Create a DataFrame from centroids with latitude and longitude extracted
-        centroids_df = centroids.to_frame(name='geometry').reset_index()
-        centroids_df['GPSLatitude'] = centroids_df['geometry'].y
-        centroids_df['GPSLongitude'] = centroids_df['geometry'].x
+        print(f"-- func: {len(footprint_thresholds)} footprint thresholds saved to: {sweep_folder}")
+        return sweep_folder
+
+
+    def load_threshold_sets(self, threshold_sets_path: Path) -> dict[str, dict[str, float]]:
+        """ Load threshold sets from a json file, either {name: {class: threshold}} or a list of {class: threshold}.
+        
+        Classes missing from a set keep their default threshold.
+        """
+        if not threshold_sets_path.exists() or not threshold_sets_path.is_file():
+            raise NameError(f"Threshold sets file not found at path {threshold_sets_path}")
 
-        #columns_to_drop = ["GPSTrack", "GPSRoll", "GPSPitch", 'GPSLatitude', 'GPSLongitude', 'geometry', 'PlanchaFileName', 'tile_bounds', 'TileArea', 'UnderwaterImageFootprint', 'UnderwaterImageArea', 'IntersectionArea', 'Intersection']
-        columns_to_drop = ['GPSLatitude', 'GPSLongitude']
-        annotations_tiles_from_probs_fine_scale = annotations_tiles_from_probs_fine_scale.drop(columns=columns_to_drop)
-        annotations_tiles_from_binary_fine_scale = annotations_tiles_from_binary_fine_scale.drop(columns=columns_to_drop)
+        with open(threshold_sets_path, "r") as threshold_sets_file:
+            threshold_sets = json.load(threshold_sets_file)
 
-        # Merging centroid information
-        annotations_tiles_from_probs_fine_scale = pd.merge(annotations_tiles_from_probs_fine_scale, centroids_df[['FileName', 'GPSLatitude', 'GPSLongitude']], on='FileName', how='left')
-        annotations_tiles_from_binary_fine_scale = pd.merge(annotations_tiles_from_binary_fine_scale, centroids_df[['FileName', 'GPSLatitude', 'GPSLongitude']], on='FileName', how='left')
+        if isinstance(threshold_sets, list):
+            threshold_sets = {f"set_{k}": threshold_set for k, threshold_set in enumerate(threshold_sets)}
 
-        # Initialize a Transformer object for converting UTM Zone 40S (EPSG:32740) to WGS84
-        transformer = Transformer.from_crs("epsg:32740", "epsg:4326", always_xy=True)
+        for set_name, threshold_set in threshold_sets.items():
+            unknown_classes = set(threshold_set) - set(THRESHOLD_CLASSES)
+            if unknown_classes:
+                raise NameError(f"Unknown classes {sorted(unknown_classes)} in threshold set {set_name}")
 
-        def utm_to_wgs84(row):
-            lon, lat = transformer.transform(row['GPSLongitude'], row['GPSLatitude'])
-            return pd.Series([lat, lon])
+        return threshold_sets
 
-        # Apply the conversion to each row in the DataFrame
-        annotations_tiles_from_probs_fine_scale[['GPSLatitude', 'GPSLongitude']] = annotations_tiles_from_probs_fine_scale.apply(utm_to_wgs84, axis=1)
-        annotations_tiles_from_binary_fine_scale[['GPSLatitude', 'GPSLongitude']] = annotations_tiles_from_binary_fine_scale.apply(utm_to_wgs84, axis=1)
 
-        annotations_tiles_from_probs_fine_scale_path = Path(self.output_folder, "annotations_tiles_from_probs_fine_scale.csv")
-        annotations_tiles_from_binary_fine_scale_path = Path(self.output_folder, "annotations_tiles_from_binary_fine_scale.csv")
-        annotations_tiles_from_probs_fine_scale.to_csv(annotations_tiles_from_probs_fine_scale_path, index=False)
-        annotations_tiles_from_binary_fine_scale.to_csv(annotations_tiles_from_binary_fine_scale_path, index=False)
+    def get_classes(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame) -> list[str]:
+        """ Class columns with algae classes merged into Algae. Text columns of the ASV csv are not classes. """
+        classes = [
+            col for col in annotation_tiles_gdf_filtered.columns
+            if col not in NON_CLASS_COLUMNS + ALGAE_COLUMNS + ['Algae'] and pd.api.types.is_numeric_dtype(annotation_tiles_gdf_filtered[col])
+        ]
+        classes.append('Algae')
+        return classes
+
+
+    def get_tiles_centroids(self, annotation_tiles_gdf_filtered: gpd.GeoDataFrame) -> pd.DataFrame:
+        """ WGS84 centroid of each tile as FileName, GPSLatitude, GPSLongitude. """
+        # Calculate centroids for each FileName
+        centroids = annotation_tiles_gdf_filtered[['FileName', annotation_tiles_gdf_filtered.geometry.name]].dissolve(by='FileName').centroid
+
+        # Convert tiles centroids from the project crs to WGS84 in one call.
+        transformer = get_transformer(f"epsg:{self.args.matching_crs}", "epsg:4326")
+        lon, lat = transformer.transform(centroids.x.to_numpy(), centroids.y.to_numpy())
 
-        return annotations_tiles_from_binary_fine_scale
\ No newline at end of file
+        return pd.DataFrame({'FileName': centroids.index.to_numpy(), 'GPSLatitude': lat, 'GPSLongitude': lon})
@@ -4,37 +4,66 @@ from argparse import Namespace
 
 
 from ..utils.tools import get_config_env
+from .RunReport import RunReport
+from .TileEncoder import TILE_FORMATS
+
+# Export modes writing all tiles in a single file read by windows, with a tile index, instead of a file by tile.
+SINGLE_FILE_EXPORT_MODES = ["vrt", "cog"]
 
 class BaseManager:
 
-    needSetup = True
-    def __init__(self, args: Namespace) -> None:
+    def __init__(self, args: Namespace, report: RunReport | None = None, dry_run: bool = False) -> None:
 
         self.args = args
         self.config_env = get_config_env(self.args.config_path)
-        
-        self.base_setup()
+
+        # Dry run managers only read inputs, no folder or file is created.
+        self.dry_run = dry_run
+
+        self.base_setup(report)
     
-    # Warning Call this function only one time
-    def base_setup(self) -> None:
 
+    @staticmethod
+    def clear_output(args: Namespace) -> None:
+        """ Remove the output folder of a mission. Call it before creating the managers of the mission. """
+        output_folder = Path(get_config_env(args.config_path)["OUTPUT_DIR_PATH"])
+        if output_folder.exists():
+            shutil.rmtree(output_folder)
+
+
+    def base_setup(self, report: RunReport | None) -> None:
+
+        # Each tile size of a multi-scale run has its own output folder.
         self.output_folder = Path(self.config_env["OUTPUT_DIR_PATH"])
-        if BaseManager.needSetup and self.output_folder.exists() and self.args.clear_all:
-            shutil.rmtree(self.output_folder)
-        self.output_folder.mkdir(exist_ok=True, parents=True)
+        if self.args.scale_folder:
+            self.output_folder = Path(self.output_folder, self.args.scale_folder)
 
         # Create tiles_folder for tif.
         tiles_folder_name = "drone_tiles" 
         if self.args.h_shift != 0 and self.args.v_shift != 0:
             tiles_folder_name = f"{tiles_folder_name}_overlap{self.args.h_shift}"
-        if self.args.footprint_threshold != 1.0:
-            tiles_folder_name = f"{tiles_folder_name}_footprint{self.args.footprint_threshold}"
 
         self.tiles_folder = Path(self.output_folder, tiles_folder_name)
-        self.tiles_folder.mkdir(exist_ok=True, parents=True)
 
         # Create tiles_folder for png.
         self.tiles_png_folder = Path(self.output_folder, f"{tiles_folder_name}_png")
-        self.tiles_png_folder.mkdir(exist_ok=True, parents=True)
 
-        BaseManager.needSetup = False
+        if not self.dry_run:
+            for folder in [self.output_folder, self.tiles_folder, self.tiles_png_folder]:
+                folder.mkdir(exist_ok=True, parents=True)
+
+        # Managers of a mission share the report given by the caller.
+        self.report = report if report is not None else RunReport(self.output_folder, self.args.profile_stages)
+
+        # Suffix of tiles files, png unless another tile format is asked.
+        self.tile_suffix = TILE_FORMATS[self.args.tile_format]["suffix"]
+
+        # Final folders of png tiles, created when tiles are moved.
+        self.annotated_folder = Path(self.output_folder, "annotated_images_png")
+        self.unlabeled_folder = Path(self.output_folder, "unlabeled_images_png")
+
+
+    def intermediate_path(self, name: str, text_suffix: str = ".csv") -> Path:
+        """ Path of an intermediate file in the output folder, with the suffix of the intermediate format. """
+        suffix = ".parquet" if self.args.intermediate_format == "parquet" else text_suffix
+        return Path(self.output_folder, f"{name}{suffix}")
@@ -0,0 +1,68 @@
+import numpy as np
+from typing import Iterator
+from rasterio.io import DatasetReader
+
+from .StripReader import StripReader
+
+
+class MultiScaleStripReader(StripReader):
+    """ Read the tile grids of several tile sizes in a single pass over a raster.
+
+    Raster rows are read once, top to bottom, in strips appended to a rolling buffer. A tile row of any grid is cut
+    from the buffer as soon as the buffer reaches its last row, and buffer rows are dropped once no pending tile row
+    needs them. The buffer holds the tallest pending tile row plus one strip of about max_strip_bytes.
+    Only the columns spanned by tiles of the tile masks are read. Strips are read and counted like StripReader.
+    """
+
+    def __init__(self, src: DatasetReader, grids: list[tuple[int, list[int], list[int], np.ndarray]], max_strip_bytes: int, indexes: tuple[int, ...] = (1, 2, 3)) -> None:
+        # Tile size and columns are by grid.
+        super().__init__(src, 0, [], max_strip_bytes, indexes)
+        self.grids = grids
+
+
+    def iter_tiles(self) -> Iterator[tuple[int, int, int, np.ndarray]]:
+        """ Yield (grid, i, j, tile) for each tile set in the tile mask of its grid.
+
+        grids are (tile_size, rows, cols, tile_mask) with tile_mask a (len(rows), len(cols)) boolean array.
+        Tile rows come in order of their last raster row, tiles of a row in column order.
+        """
+        # Tile rows with at least one tile to read, as (end, start, grid, row position), and the columns to read.
+        tile_rows, col_start, col_end = [], self.src.width, 0
+        for grid, (tile_size, rows, cols, tile_mask) in enumerate(self.grids):
+            for row_position in np.flatnonzero(tile_mask.any(axis=1)):
+                tile_rows.append((min(rows[row_position] + tile_size, self.src.height), rows[row_position], grid, int(row_position)))
+
+            col_positions = np.flatnonzero(tile_mask.any(axis=0))
+            if len(col_positions):
+                col_start = min(col_start, cols[col_positions[0]])
+                col_end = max(col_end, min(cols[col_positions[-1]] + tile_size, self.src.width))
+        if not tile_rows: return
+
+        tile_rows.sort()
+        # First raster row still needed by the tile rows from each position on.
+        pending_starts = np.minimum.accumulate(np.array([start for _, start, _, _ in tile_rows])[::-1])[::-1]
+        last_row = tile_rows[-1][0]
+        strip_height = max(1, self.max_strip_bytes // ((col_end - col_start) * self.pixel_bytes))
+
+        buffer, buffer_start = np.empty((len(self.indexes), 0, col_end - col_start), dtype=self.src.dtypes[self.indexes[0] - 1]), 0
+        for position, (end, start, grid, row_position) in enumerate(tile_rows):
+            buffer_end = buffer_start + buffer.shape[1]
+            if end > buffer_end:
+                # Rows between the buffer and the pending tile rows are not needed.
+                read_start = max(buffer_end, int(pending_starts[position]))
+                read_end = min(last_row, max(end, read_start + strip_height))
+                strip = self.read_strip(read_start, col_start, read_end - read_start, col_end - col_start)
+                if read_start > buffer_end:
+                    buffer, buffer_start = strip, read_start
+                else:
+                    buffer = np.concatenate([buffer, strip], axis=1)
+
+            tile_size, rows, cols, tile_mask = self.grids[grid]
+            i = rows[row_position]
+            for col_position in np.flatnonzero(tile_mask[row_position]):
+                j = cols[col_position]
+                yield grid, i, j, buffer[:, i - buffer_start:i - buffer_start + tile_size, j - col_start:j - col_start + tile_size]
+
+            if position + 1 < len(tile_rows) and pending_starts[position + 1] > buffer_start:
+                buffer = buffer[:, pending_starts[position + 1] - buffer_start:]
+                buffer_start = int(pending_starts[position + 1])
@@ -1,25 +1,35 @@
+import os
 import json
+import math
 import shutil
+import shapely
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from osgeo import gdal
 import geopandas as gpd
 from pathlib import Path
+from functools import partial
+from contextlib import nullcontext
 from argparse import Namespace
-from pyproj import Transformer
-from shapely.geometry import box
+from shapely.geometry import box, Polygon
+from concurrent.futures import ProcessPoolExecutor
 
 import rasterio
+import rasterio.shutil
+from rasterio.enums import MaskFlags
 from rasterio.windows import Window
 
-from .tools import check_crs
-from .BaseManager import BaseManager
+from .tools import check_crs, get_tile_name, get_transformer, read_intermediate, tile_rejection, write_intermediate, write_world_file
+from .StripReader import StripReader
+from .TileEncoder import TileEncoder, TILE_FORMATS
+from .MultiScaleStripReader import MultiScaleStripReader
+from .RunReport import RunReport, report_stage
+from .BaseManager import BaseManager, SINGLE_FILE_EXPORT_MODES
 
 class Orthophoto(BaseManager):
 
-    def __init__(self, args: Namespace) -> None:
-        BaseManager.__init__(self, args)
+    def __init__(self, args: Namespace, report: RunReport | None = None, dry_run: bool = False) -> None:
+        BaseManager.__init__(self, args, report, dry_run)
         
         # All path variable not defined in constructor are defined in setup and nowhere else.
         self.setup()
@@ -53,45 +63,183 @@ class Orthophoto(BaseManager):
                 raise NameError(f"Orthophoto crs doesn't match with desired args {self.args.matching_crs}")
     
     
+    @report_stage
     def setup_ortho_tiles(self) -> pd.DataFrame:
-        csv_path = Path(self.output_folder, 'filtered_bounds_on_manual_boundary_df.csv')
+        self.clear_sorted_tiles()
         bounds = self.split_tif_into_tiles()
+        return self.setup_tiles_from_bounds(bounds)
+
+
+    @staticmethod
+    def setup_multiscale_ortho_tiles(orthoManagers: list["Orthophoto"]) -> list[pd.DataFrame]:
+        """ setup_ortho_tiles of managers of the same orthophoto with different tile sizes, the orthophoto is read once. """
+        for orthoManager in orthoManagers:
+            orthoManager.clear_sorted_tiles()
+
+        with orthoManagers[0].report.stage("split_tif_into_multiscale_tiles"):
+            bounds_by_scale = Orthophoto.split_tif_into_multiscale_tiles(orthoManagers)
+
+        return [orthoManager.setup_tiles_from_bounds(bounds) for orthoManager, bounds in zip(orthoManagers, bounds_by_scale)]
+
+
+    def clear_sorted_tiles(self) -> None:
+        """ Png tiles sorted by a previous run belong to the previous tile grid. """
+        for folder in [self.annotated_folder, self.unlabeled_folder]:
+            if folder.exists():
+                shutil.rmtree(folder)
+
+
+    def setup_tiles_from_bounds(self, bounds: pd.DataFrame) -> pd.DataFrame:
+        """ Keep split tiles inside the manual boundary, finish their export and write the tile index. """
+        tiles_index_path = self.intermediate_path('filtered_bounds_on_manual_boundary_df')
+
         filtered_bounds_on_manual_boundary_df = self.filter_tiles_based_on_manual_boundary(bounds)
-        self.convert_tif_to_png(filtered_bounds_on_manual_boundary_df)
-        filtered_bounds_on_manual_boundary_df.to_csv(csv_path, index=False)
+        if self.args.export_mode == "tif_png":
+            self.convert_tif_to_png(filtered_bounds_on_manual_boundary_df)
+        elif self.args.export_mode in SINGLE_FILE_EXPORT_MODES:
+            self.write_tiled_orthophoto()
+            # No tile file goes through the tiles folders.
+            for folder in [self.tiles_folder, self.tiles_png_folder]:
+                if folder.exists() and not any(folder.iterdir()):
+                    folder.rmdir()
+        write_intermediate(filtered_bounds_on_manual_boundary_df.assign(tile_filename=filtered_bounds_on_manual_boundary_df["tile_filename"].astype(str)),
+                           tiles_index_path, ["bounds_polygon"], self.args.matching_crs)
         return filtered_bounds_on_manual_boundary_df
     
 
-    def convert_tif_to_png(self, filtered_bounds_on_manual_boundary_df: pd.DataFrame) -> None:
-        print("\n\n-- func: Convert TIF Files to png files.")
-        
-        # Mandatory by gdal warning.
-        gdal.DontUseExceptions()
+    def load_ortho_tiles(self) -> pd.DataFrame | None:
+        """ Tiles bounds of a previous run, None if the tile index or a png tile is missing. """
+        filtered_bounds_on_manual_boundary_df = read_intermediate(self.intermediate_path('filtered_bounds_on_manual_boundary_df'), ["bounds_polygon"], crs=self.args.matching_crs)
+        if filtered_bounds_on_manual_boundary_df is None: return None
 
-        # Convert each tif image in the input directory to png format.
-        for i, row in tqdm(filtered_bounds_on_manual_boundary_df.iterrows(), total=len(filtered_bounds_on_manual_boundary_df)):
-            # Rename tif file to match png filename
-            input_path = Path(row["tile_filename"].parent, f'{row["tile_png"]}.tif')
-            output_path = Path(self.tiles_png_folder, f'{row["tile_png"]}.png')
+        filtered_bounds_on_manual_boundary_df["tile_filename"] = filtered_bounds_on_manual_boundary_df["tile_filename"].apply(Path)
 
-            shutil.move(row["tile_filename"], input_path)
+        if self.args.export_mode in SINGLE_FILE_EXPORT_MODES:
+            return filtered_bounds_on_manual_boundary_df if self.tiled_orthophoto_path().exists() else None
 
-            with gdal.Open(str(input_path)) as src_ds:
-                gdal.Translate(output_path, src_ds, format='PNG')
-        
-        print("-- func: Conversion to PNG completed.")
+        # Png tiles can already be sorted in annotated and unlabeled folders.
+        tiles_png = {file_png.name for folder in [self.tiles_png_folder, self.annotated_folder, self.unlabeled_folder] if folder.exists() for file_png in folder.iterdir()}
+        if not all(f"{tile_png}{self.tile_suffix}" in tiles_png for tile_png in filtered_bounds_on_manual_boundary_df["tile_png"]):
+            return None
 
-        # After all the conversions are done, remove the .aux.xml files.
-        for aux_file in self.tiles_png_folder.iterdir():
-            if ".aux.xml" in aux_file.name.lower():
-                aux_file.unlink()
-        
-        print("-- func: All auxiliary .aux.xml files have been removed.")
+        return filtered_bounds_on_manual_boundary_df
 
 
-    def filter_tiles_based_on_manual_boundary(self, bounds_df: pd.DataFrame) -> pd.DataFrame:
-        print("\n\n-- func: Filter tiles based on manual boundary.")
-        
+    def grid_signature(self) -> tuple[dict[str, Path], dict]:
+        """ Input files and arguments the planned tile grid depends on. """
+        inputs = {
+            "orthophoto": self.orthophoto_filepath,
+            "stats": self.stats_filepath,
+            "manual_boundary": Path(self.config_env["MANUEL_BOUNDARY_PATH"])
+        }
+        params = {arg: getattr(self.args, arg) for arg in ["matching_crs", "tiles_size_meters", "h_shift", "v_shift", "prescreen"]}
+        return inputs, params
+
+
+    def stage_signature(self) -> tuple[dict[str, Path], dict]:
+        """ Input files and arguments the tiles depend on. """
+        inputs, params = self.grid_signature()
+        params.update({arg: getattr(self.args, arg) for arg in [
+            "black_pixels_threshold_percentage", "white_pixels_threshold_percentage", "export_mode", "world_file", "route_tiles", "unlabeled",
+            "tile_format", "compression_level"
+        ]})
+        return inputs, params
+
+
+    def tiles_destination(self) -> Path:
+        """ Folder split tiles are written to, or the single file they are read from. """
+        return {"tif_png": self.tiles_folder, "png": self.tiles_png_folder}.get(self.args.export_mode, self.tiled_orthophoto_path())
+
+
+    def tiled_orthophoto_path(self) -> Path:
+        """ Single file of the tiles with export modes vrt and cog. """
+        return Path(self.output_folder, "tiles.vrt" if self.args.export_mode == "vrt" else "tiles_cog.tif")
+
+
+    @report_stage
+    def write_tiled_orthophoto(self) -> Path:
+        """ Write the single file tiles are read from, with the tile windows of the orthophoto.
+
+        vrt: a VRT pointing into the orthophoto, no pixel is copied.
+        cog: a lossless Cloud-Optimized GeoTIFF of the orthophoto. Its blocks are the tiles when the tile size is a multiple
+        of 16, as GeoTIFF blocks must be, and tiles don't overlap. Otherwise blocks are the closest multiple of 16.
+        """
+        print("\n\n-- func: Write tiled orthophoto.")
+        tiled_orthophoto_path = self.tiled_orthophoto_path()
+        tiled_orthophoto_path.unlink(missing_ok=True)
+
+        if self.args.export_mode == "vrt":
+            rasterio.shutil.copy(self.orthophoto_filepath, tiled_orthophoto_path, driver="VRT")
+        else:
+            tile_size = self.get_tile_size()
+            block_size = max(16, round(tile_size / 16) * 16)
+            if block_size != tile_size or self.args.h_shift != 0 or self.args.v_shift != 0:
+                print(f"[WARNING] Blocks of {block_size} pixels are not aligned on tiles of {tile_size} pixels, a tile read can cover several blocks.")
+
+            gdal_env = {"GDAL_CACHEMAX": self.args.gdal_cache_mb} if self.args.gdal_cache_mb else {}
+            with rasterio.Env(**gdal_env):
+                rasterio.shutil.copy(self.orthophoto_filepath, tiled_orthophoto_path, driver="COG", BLOCKSIZE=block_size,
+                                     COMPRESS="DEFLATE", PREDICTOR="YES", NUM_THREADS=max(1, self.args.workers), BIGTIFF="IF_SAFER")
+
+        self.report.count("bytes_written", tiled_orthophoto_path.stat().st_size)
+        print(f"Tiled orthophoto saved to: {tiled_orthophoto_path}")
+        return tiled_orthophoto_path
+
+
+    @report_stage
+    def write_tiles_index(self, tiles_bounds_df: pd.DataFrame, annotated_tiles: np.ndarray) -> pd.DataFrame:
+        """ Tile index of the single file: name, window, bounds and annotated flag of each tile.
+
+        A tile is read with one windowed read of the single file, windows are the same as in the orthophoto.
+        """
+        print("\n\n-- func: Write tile index.")
+
+        tiles_index_df = tiles_bounds_df[["tile_png", "row_off", "col_off", "height", "width", "bounds_polygon"]].copy()
+        tiles_index_df["annotated"] = tiles_index_df["tile_png"].isin(annotated_tiles)
+        tiles_index_path = write_intermediate(tiles_index_df, self.intermediate_path("tiles_index"), ["bounds_polygon"], self.args.matching_crs)
+
+        print(f"Annotated tiles: {tiles_index_df['annotated'].sum()} / {len(tiles_index_df)}, tile index saved to: {tiles_index_path}")
+        return tiles_index_df
+
+
+    @report_stage
+    def convert_tif_to_png(self, filtered_bounds_on_manual_boundary_df: pd.DataFrame, png_folders: np.ndarray | None = None) -> None:
+        """ Encode GeoTIFF tiles to the tile format, png by default, on the encoding pool. """
+        print(f"\n\n-- func: Convert TIF Files to {self.args.tile_format} files.")
+
+        # Png are written in the tiles png folder, or in the folder of each tile if given.
+        if png_folders is None:
+            png_folders = np.full(len(filtered_bounds_on_manual_boundary_df), self.tiles_png_folder, dtype=object)
+
+        # Convert each tif image in the input directory to the tile format.
+        with TileEncoder(**self.encoding_options()) as encoder:
+            for (i, row), png_folder in tqdm(zip(filtered_bounds_on_manual_boundary_df.iterrows(), png_folders), total=len(filtered_bounds_on_manual_boundary_df)):
+                # Rename tif file to match png filename
+                input_path = Path(row["tile_filename"].parent, f'{row["tile_png"]}.tif')
+                output_path = Path(png_folder, f'{row["tile_png"]}{encoder.suffix}')
+
+                shutil.move(row["tile_filename"], input_path)
+                encoder.submit(output_path, input_path)
+            counters = encoder.close()
+
+        for counter, value in counters.items():
+            self.report.count(counter, value)
+        print(f"-- func: Conversion to {self.args.tile_format} completed. {encoder.summary()}")
+
+
+    def encoding_options(self) -> dict:
+        """ TileEncoder arguments. """
+        return {
+            "tile_format": self.args.tile_format,
+            "compression_level": self.args.compression_level,
+            "workers": self.args.encoding_workers,
+            "pool": self.args.encoding_pool,
+            "max_pending": self.args.encoding_queue
+        }
+
+
+    def get_manual_boundary(self) -> Polygon:
+        """ Load the manual boundary polygon. """
         manual_boundary_path = Path(self.config_env["MANUEL_BOUNDARY_PATH"])
         if not manual_boundary_path.exists():
             raise NameError(f"Manual boundary file not found at path {manual_boundary_path}")
@@ -99,69 +247,167 @@ class Orthophoto(BaseManager):
         polygon_df = gpd.read_file(manual_boundary_path)
 
         # Assuming there's only one polygon in the GeoJSON
-        polygon = polygon_df.geometry.iloc[0]
+        return polygon_df.geometry.iloc[0]
 
-        # Assuming tile_bounds is a list of tuples/lists in the format [(minx, miny, maxx, maxy), ...]
-        def is_bounds_in_polygon(row):
-            """ If bounds in polygon, convert tif name to png name else return '' """
-            
-            if polygon.contains(row["bounds_polygon"].centroid):
-                return f"odm_orthophoto_{int(row["bounds_polygon"].centroid.x)}_{int(row["bounds_polygon"].centroid.y)}"
-            return ""
 
-        bounds_df["tile_png"] = bounds_df.apply(is_bounds_in_polygon, axis=1)
+    @report_stage
+    def filter_tiles_based_on_manual_boundary(self, bounds_df: pd.DataFrame) -> pd.DataFrame:
+        print("\n\n-- func: Filter tiles based on manual boundary.")
         
-        return bounds_df[bounds_df["tile_png"] != ""].reset_index()
+        polygon = self.get_manual_boundary()
 
+        # Keep tiles with their centroid in the polygon and convert tif name to png name.
+        centroids = shapely.centroid(bounds_df["bounds_polygon"].to_numpy())
+        inside = shapely.contains_xy(polygon, shapely.get_x(centroids), shapely.get_y(centroids))
 
-    def split_tif_into_tiles(self) -> pd.DataFrame:
-        print("\n\n-- func: Split tif into tiles.")
+        bounds_df["tile_png"] = ""
+        bounds_df.loc[inside, "tile_png"] = [get_tile_name(tile_bounds) for tile_bounds in bounds_df.loc[inside, "bounds_polygon"]]
         
-        tile_size = int(self.args.tiles_size_meters // (self.GSD_mean / 100))
-        size_inline_tile = tile_size**2
+        self.report.count("tiles_inside_boundary", int(inside.sum()))
+        return bounds_df[bounds_df["tile_png"] != ""].reset_index()
+
+
+    def tiles_inside_manual_boundary(self, src: rasterio.io.DatasetReader, rows: list[int], cols: list[int], tile_size: int) -> np.ndarray:
+        """ Flag tiles of the grid with their centroid inside the manual boundary, from geometry only.
+
+        Tiles are clipped to the raster extent like the windows read later.
+        Returns a (len(rows), len(cols)) boolean array.
+        """
+        t = src.transform
+        if t.b != 0 or t.d != 0:
+            raise NameError("Rotated orthophoto are not supported")
+
+        rows, cols = np.asarray(rows, dtype=np.float64), np.asarray(cols, dtype=np.float64)
+        rows_end = np.minimum(rows + tile_size, src.height)
+        cols_end = np.minimum(cols + tile_size, src.width)
+
+        # Pixel to crs coordinates of the upper left and lower right corners of each tile.
+        x_start, x_end = cols * t.a + t.c, cols_end * t.a + t.c
+        y_start, y_end = rows * t.e + t.f, rows_end * t.e + t.f
+
+        centroid_x = (x_start + x_end) / 2
+        centroid_y = (y_start + y_end) / 2
+        grid_x, grid_y = np.meshgrid(centroid_x, centroid_y)
+
+        return shapely.contains_xy(self.get_manual_boundary(), grid_x, grid_y)
+
+
+    def prescreen_blank_tiles(self, src: rasterio.io.DatasetReader, rows: list[int], cols: list[int], tile_size: int) -> np.ndarray:
+        """ Flag tiles without any valid pixel in the dataset mask, without reading the color bands.
+
+        The mask (alpha band or nodata) is read at low resolution, from an overview when one is available,
+        and a tile is flagged blank when no mask pixel around it, one pixel margin included, is valid.
+        Returns a (len(rows), len(cols)) boolean array.
+        """
+        blank_tiles = np.zeros((len(rows), len(cols)), dtype=bool)
+        if src.mask_flag_enums[0] == [MaskFlags.all_valid]:
+            print("No mask or alpha band on orthophoto, prescreen skipped.")
+            return blank_tiles
+
+        # Keep a few mask pixels by tile, use the coarsest overview matching this constraint.
+        max_factor = max(1, tile_size // 4)
+        overview_factors = [factor for factor in src.overviews(1) if factor <= max_factor]
+        factor = max(overview_factors) if overview_factors else max_factor
+
+        mask = src.dataset_mask(out_shape=(math.ceil(src.height / factor), math.ceil(src.width / factor))) > 0
+
+        # Count valid mask pixels of each tile with a summed area table.
+        summed_area = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+        summed_area[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        r0 = np.clip(rows // factor - 1, 0, mask.shape[0])
+        r1 = np.clip(-(-(rows + tile_size) // factor) + 1, 0, mask.shape[0])
+        c0 = np.clip(cols // factor - 1, 0, mask.shape[1])
+        c1 = np.clip(-(-(cols + tile_size) // factor) + 1, 0, mask.shape[1])
+
+        valid_pixels = summed_area[np.ix_(r1, c1)] - summed_area[np.ix_(r0, c1)] - summed_area[np.ix_(r1, c0)] + summed_area[np.ix_(r0, c0)]
+        blank_tiles[:] = valid_pixels == 0
+        return blank_tiles
+
+
+    def get_tile_size(self) -> int:
+        """ Tile size in pixels. """
+        return int(self.args.tiles_size_meters // (self.GSD_mean / 100))
+
+
+    def plan_tile_grid(self) -> tuple[int, list[int], list[int], np.ndarray]:
+        """ Tile size, rows and columns offsets of the tile grid and the (len(rows), len(cols)) mask of tiles to read. """
+        tile_size = self.get_tile_size()
         x_overlap = int(tile_size * self.args.h_shift)
         y_overlap = int(tile_size * self.args.v_shift)
- 
-        bounds_list = []
+
         with rasterio.open(self.orthophoto_filepath) as src:
+            rows = list(range(0, src.height, tile_size - y_overlap))
+            cols = list(range(0, src.width, tile_size - x_overlap))
+
+            # Only read tiles inside the manual boundary.
+            tile_mask = self.tiles_inside_manual_boundary(src, rows, cols, tile_size)
+            print(f"Tiles inside manual boundary: {tile_mask.sum()} / {tile_mask.size}")
+
+            if self.args.prescreen:
+                blank_tiles = tile_mask & self.prescreen_blank_tiles(src, rows, cols, tile_size)
+                tile_mask &= ~blank_tiles
+                print(f"Tiles skipped by prescreen: {blank_tiles.sum()} / {blank_tiles.size}")
+
+        return tile_size, rows, cols, tile_mask
 
-            for i in tqdm(range(0, src.height, tile_size - y_overlap)):
-                for j in range(0, src.width, tile_size - x_overlap):
-                    window = Window(j, i, tile_size, tile_size)
-
-                    transform_window = src.window_transform(window)
-                    
-                    tile = src.read(window=window, indexes=[1, 2, 3])
-
-                    # Apply threshold to avoid keep useless image.                    
-                    greyscale_tile = np.sum(tile, axis=0) / 3
-                    
-                    # Black threshold.
-                    percentage_black_pixel = np.sum(greyscale_tile == 0) * 100 / size_inline_tile
-                    if percentage_black_pixel > self.args.black_pixels_threshold_percentage:
-                        continue
-
-                    # White threshold.
-                    percentage_white_pixel = np.sum(greyscale_tile == 255) * 100 / size_inline_tile
-                    if percentage_white_pixel > self.args.white_pixels_threshold_percentage:
-                        continue
-
-                    tile_filename = Path(self.tiles_folder / f"tile_{i}_{j}.tif")
-                    
-                    with rasterio.open(
-                        tile_filename, "w",
-                        driver="GTiff",
-                        height=tile.shape[1],
-                        width=tile.shape[2],
-                        count=3,
-                        dtype=tile.dtype,
-                        crs=src.crs,
-                        transform=transform_window
-                    ) as dst:
-                        dst.write(tile)
-                        bounds_list.append((tile_filename, box(*dst.bounds)))
-
-        bounds_df = pd.DataFrame(bounds_list, columns=["tile_filename", "bounds_polygon"])
+
+    @report_stage
+    def split_tif_into_tiles(self) -> pd.DataFrame:
+        print("\n\n-- func: Split tif into tiles.")
+        
+        tile_size, rows, cols, tile_mask = self.plan_tile_grid()
+        return self.read_and_write_tiles(tile_size, rows, cols, tile_mask)
+
+
+    def read_and_write_tiles(self, tile_size: int, rows: list[int], cols: list[int], tile_mask: np.ndarray, tile_folders: np.ndarray | None = None) -> pd.DataFrame:
+        """ Read the tiles set in tile_mask, drop tiles above pixels thresholds and write the others.
+
+        tile_folders is an optional (len(rows), len(cols)) array of png destination folders used with png export mode.
+        """
+        split_band = partial(
+            split_rows_into_tiles,
+            self.orthophoto_filepath,
+            self.tiles_destination(),
+            cols=cols,
+            tile_size=tile_size,
+            black_pixels_threshold_percentage=self.args.black_pixels_threshold_percentage,
+            white_pixels_threshold_percentage=self.args.white_pixels_threshold_percentage,
+            max_strip_bytes=int(self.args.strip_memory_mb * 1024 * 1024),
+            gdal_cache_mb=self.args.gdal_cache_mb,
+            export_mode=self.args.export_mode,
+            world_file=self.args.world_file,
+            encoding=self.encoding_options()
+        )
+
+        if self.args.workers <= 1:
+            bounds_list, strip_stats, counters = split_band(rows, tile_mask, tile_folders=tile_folders)
+        else:
+            bounds_list, strip_stats, counters = [], [], {}
+            # Row bands are processed by workers with their own dataset handle and merged back in grid order.
+            bands = np.array_split(np.arange(len(rows)), min(len(rows), self.args.workers * 4))
+            bands_rows = [[rows[k] for k in band] for band in bands]
+            bands_tile_mask = [tile_mask[band] for band in bands]
+            bands_tile_folders = [None if tile_folders is None else tile_folders[band] for band in bands]
+            with ProcessPoolExecutor(max_workers=self.args.workers) as executor:
+                futures = [executor.submit(split_band, band_rows, band_tile_mask, tile_folders=band_tile_folders, show_progress=False)
+                           for band_rows, band_tile_mask, band_tile_folders in zip(bands_rows, bands_tile_mask, bands_tile_folders)]
+                for band_bounds, band_strip_stats, band_counters in tqdm((future.result() for future in futures), total=len(bands)):
+                    bounds_list.extend(band_bounds)
+                    strip_stats.extend(band_strip_stats)
+                    for counter, value in band_counters.items():
+                        counters[counter] = counters.get(counter, 0) + value
+
+        self.strip_stats = strip_stats
+        print(f"Strips read: {len(strip_stats)}, MB read: {sum(stat['bytes'] for stat in strip_stats) / 1024**2:.1f}")
+
+        self.report.count("strips_read", len(strip_stats))
+        self.report.count("bytes_read", sum(stat["bytes"] for stat in strip_stats))
+        for counter, value in counters.items():
+            self.report.count(counter, value)
+
+        bounds_df = pd.DataFrame(bounds_list, columns=["tile_filename", "bounds_polygon", "row_off", "col_off", "height", "width"])
         print(f"Tiles generated: {len(bounds_df)}")
         
         if len(bounds_df) == 0: 
@@ -169,43 +415,347 @@ class Orthophoto(BaseManager):
 
         return bounds_df
 
-    def create_unlabeled_csv(self, unlabeled_folder: Path, tiles_bound_df: pd.DataFrame):
-        print("\n\n-- func: Create unlabeled CSV.")
-        transformer = Transformer.from_crs("epsg:32740", "epsg:4326", always_xy=True)  # Adjust the EPSG codes as needed
 
-        # Prepare CSV for GPS information
-        csv_path = Path(self.output_folder, 'unlabeled_images_geolocations.csv')
-        geolocations = []  # List to hold the geolocation data
+    @staticmethod
+    def split_tif_into_multiscale_tiles(orthoManagers: list["Orthophoto"]) -> list[pd.DataFrame]:
+        """ read_and_write_tiles of every manager from one pass over the orthophoto. Returns the tiles of each manager. """
+        print("\n\n-- func: Split tif into tiles of every scale.")
+        first = orthoManagers[0]
+        args, report = first.args, first.report
+
+        grids = [orthoManager.plan_tile_grid() for orthoManager in orthoManagers]
+        split_scales = partial(
+            split_multiscale_rows_into_tiles,
+            first.orthophoto_filepath,
+            tiles_folders=[orthoManager.tiles_destination() for orthoManager in orthoManagers],
+            black_pixels_threshold_percentage=args.black_pixels_threshold_percentage,
+            white_pixels_threshold_percentage=args.white_pixels_threshold_percentage,
+            max_strip_bytes=int(args.strip_memory_mb * 1024 * 1024),
+            gdal_cache_mb=args.gdal_cache_mb,
+            export_mode=args.export_mode,
+            world_file=args.world_file,
+            encoding=first.encoding_options()
+        )
+
+        if args.workers <= 1:
+            bounds_by_scale, strip_stats, counters = split_scales(grids)
+        else:
+            bounds_by_scale, strip_stats, counters = [[] for _ in grids], [], {}
+            # Workers take the tile rows starting in their band of raster rows, tiles crossing a band limit are read twice.
+            with rasterio.open(first.orthophoto_filepath) as src:
+                band_limits = np.linspace(0, src.height, args.workers * 4 + 1).astype(int)
+            bands_grids = []
+            for band_start, band_end in zip(band_limits[:-1], band_limits[1:]):
+                band_grids = []
+                for tile_size, rows, cols, tile_mask in grids:
+                    band = np.flatnonzero((np.asarray(rows) >= band_start) & (np.asarray(rows) < band_end))
+                    band_grids.append((tile_size, [rows[k] for k in band], cols, tile_mask[band]))
+                bands_grids.append(band_grids)
+
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                futures = [executor.submit(split_scales, band_grids, show_progress=False) for band_grids in bands_grids]
+                for band_bounds_by_scale, band_strip_stats, band_counters in tqdm((future.result() for future in futures), total=len(bands_grids)):
+                    for bounds_list, band_bounds in zip(bounds_by_scale, band_bounds_by_scale):
+                        bounds_list.extend(band_bounds)
+                    strip_stats.extend(band_strip_stats)
+                    for counter, value in band_counters.items():
+                        counters[counter] = counters.get(counter, 0) + value
+
+        print(f"Strips read: {len(strip_stats)}, MB read: {sum(stat['bytes'] for stat in strip_stats) / 1024**2:.1f}")
+        report.count("strips_read", len(strip_stats))
+        report.count("bytes_read", sum(stat["bytes"] for stat in strip_stats))
+        for counter, value in counters.items():
+            report.count(counter, value)
+
+        bounds_dfs = []
+        for orthoManager, bounds_list in zip(orthoManagers, bounds_by_scale):
+            # Tile rows are read in order of their last row, sort back in grid order like a single scale run.
+            bounds_df = pd.DataFrame(bounds_list, columns=["tile_filename", "bounds_polygon", "row_off", "col_off", "height", "width"])
+            bounds_df = bounds_df.sort_values(["row_off", "col_off"], kind="stable").reset_index(drop=True)
+            print(f"Tiles generated for {orthoManager.args.tiles_size_meters:g}m tiles: {len(bounds_df)}")
+
+            if len(bounds_df) == 0:
+                raise NameError(f"Not enough tiles to continue for {orthoManager.args.tiles_size_meters:g}m tiles")
+            bounds_dfs.append(bounds_df)
+
+        return bounds_dfs
+
+
+    @report_stage
+    def plan_tiles(self, tile_grid: tuple[int, list[int], list[int], np.ndarray] | None = None) -> pd.DataFrame:
+        """ Candidate tiles of the grid from geometry only, no pixel is read.
+
+        Candidates are the tiles which would be read by split_tif_into_tiles, with the same name and bounds.
+        Pixels thresholds are applied later, when tiles are exported. tile_grid is planned if not given.
+        """
+        print("\n\n-- func: Plan tiles from the tile grid.")
+
+        tile_size, rows, cols, tile_mask = tile_grid if tile_grid is not None else self.plan_tile_grid()
+        rows_positions, cols_positions = np.nonzero(tile_mask)
+        row_off, col_off = np.asarray(rows)[rows_positions], np.asarray(cols)[cols_positions]
+
+        with rasterio.open(self.orthophoto_filepath) as src:
+            height = np.minimum(row_off + tile_size, src.height) - row_off
+            width = np.minimum(col_off + tile_size, src.width) - col_off
+            bounds_polygons = [box(*rasterio.windows.bounds(Window(j, i, w, h), src.transform)) for i, j, h, w in zip(row_off, col_off, height, width)]
+
+        tiles_plan_df = pd.DataFrame({
+            "bounds_polygon": bounds_polygons,
+            "row_off": row_off,
+            "col_off": col_off,
+            "height": height,
+            "width": width,
+            "tile_png": [get_tile_name(tile_bounds) for tile_bounds in bounds_polygons]
+        })
+        print(f"Tiles planned: {len(tiles_plan_df)}")
+
+        return tiles_plan_df
+
+
+    def export_planned_tiles(self, tiles_plan_df: pd.DataFrame, png_folders: np.ndarray) -> pd.DataFrame:
+        """ Read and write planned tiles, each one directly to its png folder. Returns the tile index of written tiles. """
+        tile_size = self.get_tile_size()
+        rows = sorted(set(tiles_plan_df["row_off"].tolist()))
+        cols = sorted(set(tiles_plan_df["col_off"].tolist()))
+        rows_positions = np.searchsorted(rows, tiles_plan_df["row_off"].to_numpy())
+        cols_positions = np.searchsorted(cols, tiles_plan_df["col_off"].to_numpy())
+
+        tile_mask = np.zeros((len(rows), len(cols)), dtype=bool)
+        tile_mask[rows_positions, cols_positions] = True
+        tile_folders = np.empty((len(rows), len(cols)), dtype=object)
+        tile_folders[rows_positions, cols_positions] = png_folders
+
+        for folder in set(png_folders):
+            folder.mkdir(exist_ok=True, parents=True)
+
+        if self.args.export_mode == "png":
+            bounds_df = self.read_and_write_tiles(tile_size, rows, cols, tile_mask, tile_folders)
+            bounds_df["tile_png"] = [get_tile_name(tile_bounds) for tile_bounds in bounds_df["bounds_polygon"]]
+        else:
+            bounds_df = self.read_and_write_tiles(tile_size, rows, cols, tile_mask)
+            bounds_df["tile_png"] = [get_tile_name(tile_bounds) for tile_bounds in bounds_df["bounds_polygon"]]
+            self.convert_tif_to_png(bounds_df, tile_folders[np.searchsorted(rows, bounds_df["row_off"]), np.searchsorted(cols, bounds_df["col_off"])])
+
+        return bounds_df
+
+
+    @report_stage
+    def setup_routed_tiles(self, tiles_plan_df: pd.DataFrame, annotated_tiles: np.ndarray) -> pd.DataFrame:
+        """ Export planned tiles straight to the annotated or unlabeled folder.
+
+        Annotated tiles are known from geometry before export. Unlabeled tiles are written with --unlabeled write,
+        not exported with skip, and saved in the unlabeled tiles plan to be exported later with lazy.
+        """
+        print("\n\n-- func: Export tiles to annotated and unlabeled folders.")
+        tiles_index_path = self.intermediate_path('filtered_bounds_on_manual_boundary_df')
+
+        for folder in [self.annotated_folder, self.unlabeled_folder]:
+            if folder.exists():
+                shutil.rmtree(folder)
+            folder.mkdir(parents=True)
+
+        is_annotated = tiles_plan_df["tile_png"].isin(annotated_tiles).to_numpy()
+        print(f"Annotated tiles planned: {is_annotated.sum()} / {len(tiles_plan_df)}")
+
+        unlabeled_plan_path = self.intermediate_path('unlabeled_tiles_plan')
+        unlabeled_plan_path.unlink(missing_ok=True)
+        if self.args.unlabeled == "lazy":
+            write_intermediate(tiles_plan_df[~is_annotated], unlabeled_plan_path, ["bounds_polygon"], self.args.matching_crs)
+
+        tiles_to_export = tiles_plan_df if self.args.unlabeled == "write" else tiles_plan_df[is_annotated]
+        png_folders = np.where(tiles_to_export["tile_png"].isin(annotated_tiles), self.annotated_folder, self.unlabeled_folder)
+        # Same columns as the tile index of setup_ortho_tiles.
+        tiles_index_df = self.export_planned_tiles(tiles_to_export, png_folders).reset_index()
 
-        tiles_bound_df.set_index("tile_png", inplace=True)
+        # Nothing goes through the tiles png folder.
+        if self.tiles_png_folder.exists() and not any(self.tiles_png_folder.iterdir()):
+            self.tiles_png_folder.rmdir()
 
-        # Convert TIFF to PNG and extract GPS information
-        for filename in tqdm(unlabeled_folder.iterdir()):
-            if filename.suffix.lower() != ".png": continue
+        write_intermediate(tiles_index_df.assign(tile_filename=tiles_index_df["tile_filename"].astype(str)),
+                           tiles_index_path, ["bounds_polygon"], self.args.matching_crs)
+        return tiles_index_df
 
-            file_tif = Path(tiles_bound_df.loc[filename.stem]["tile_filename"].parent, f'{filename.stem}.tif')
-            # Open the input file and retrieve geotransform data
-            with gdal.Open(file_tif) as src_ds:
-                gt = src_ds.GetGeoTransform()
-                width = src_ds.RasterXSize
-                height = src_ds.RasterYSize
 
-                # Calculate the coordinates of the image centroid
-                centroid_x = gt[0] + (width * gt[1] / 2) + (height * gt[2] / 2)
-                centroid_y = gt[3] + (width * gt[4] / 2) + (height * gt[5] / 2)
+    @report_stage
+    def export_unlabeled_plan(self) -> Path:
+        """ Export the unlabeled tiles saved by a run with --unlabeled lazy. """
+        unlabeled_plan_df = read_intermediate(self.intermediate_path('unlabeled_tiles_plan'), ["bounds_polygon"], crs=self.args.matching_crs)
+        if unlabeled_plan_df is None:
+            raise NameError("No unlabeled tiles plan found, run with --route_tiles --unlabeled lazy first.")
 
-                # Convert from projected coordinates (UTM) to geographic coordinates (lat, lon)
-                lon, lat = transformer.transform(centroid_x, centroid_y)
+        print("\n\n-- func: Export unlabeled tiles from plan.")
+        if unlabeled_plan_df.empty:
+            print("No unlabeled tiles planned, nothing to export.")
+            return self.unlabeled_folder
 
-                # Append the data to the list
-                geolocations.append({
-                    'FileName': filename.name,
-                    'GPSLatitude': lat,
-                    'GPSLongitude': lon
-                })
+        unlabeled_index_df = self.export_planned_tiles(unlabeled_plan_df, np.full(len(unlabeled_plan_df), self.unlabeled_folder, dtype=object))
+        self.create_unlabeled_csv(self.unlabeled_folder, unlabeled_index_df)
+        return self.unlabeled_folder
+
+
+    @report_stage
+    def create_unlabeled_csv(self, unlabeled_folder: Path, tiles_bound_df: pd.DataFrame, unlabeled_tiles: np.ndarray | None = None):
+        """ Geolocation of unlabeled tiles, listed from the unlabeled folder or given by name when tiles are in a single file. """
+        print("\n\n-- func: Create unlabeled CSV.")
+
+        # Prepare CSV for GPS information
+        csv_path = Path(self.output_folder, 'unlabeled_images_geolocations.csv')
+
+        if unlabeled_tiles is None:
+            with os.scandir(unlabeled_folder) as entries:
+                unlabeled_files = sorted(entry.name for entry in entries if entry.name.lower().endswith(self.tile_suffix))
+            tiles_names = [filename[:-len(self.tile_suffix)] for filename in unlabeled_files]
+        else:
+            unlabeled_files = tiles_names = sorted(unlabeled_tiles)
+
+        # Tile bounds are stored in the tile index, centroids of all tiles are computed at once.
+        # With overlap, tiles can share a name, the first one is kept.
+        tiles_bound_df = tiles_bound_df.drop_duplicates("tile_png")
+        tiles_positions = pd.Index(tiles_bound_df["tile_png"]).get_indexer(tiles_names)
+        if (tiles_positions < 0).any():
+            raise NameError(f"Unlabeled tiles not found in the tile index: {np.asarray(tiles_names)[tiles_positions < 0][:5].tolist()}")
+        bounds_polygons = np.asarray(tiles_bound_df["bounds_polygon"].to_numpy(), dtype=object)[tiles_positions]
+        centroids = shapely.centroid(bounds_polygons)
+
+        # Convert from projected coordinates to geographic coordinates (lat, lon) in one call.
+        transformer = get_transformer(f"epsg:{self.args.matching_crs}", "epsg:4326")
+        lon, lat = transformer.transform(shapely.get_x(centroids), shapely.get_y(centroids))
 
         # Save geolocation data to CSV
-        df_geo = pd.DataFrame(geolocations)
+        df_geo = pd.DataFrame({'FileName': unlabeled_files, 'GPSLatitude': lat, 'GPSLongitude': lon})
         df_geo.to_csv(csv_path, index=False)
+        self.report.count("tiles_unlabeled", len(df_geo))
 
         print("-- func: Geolocation extraction completed. Data saved to:", csv_path)
+
+
+def split_rows_into_tiles(orthophoto_filepath: Path, tiles_folder: Path, rows: list[int], tile_mask: np.ndarray, cols: list[int], tile_size: int,
+                          black_pixels_threshold_percentage: float, white_pixels_threshold_percentage: float,
+                          max_strip_bytes: int, gdal_cache_mb: int | None = None, export_mode: str = "tif_png",
+                          world_file: bool = False, tile_folders: np.ndarray | None = None, show_progress: bool = True,
+                          encoding: dict | None = None) -> tuple[list[tuple], list[dict], dict[str, int]]:
+    """ Read, threshold and write the tiles of the given rows. Top-level to be usable by worker processes.
+
+    Only tiles set in tile_mask, a (len(rows), len(cols)) boolean array, are read.
+
+    With export_mode tif_png, tiles are written as GeoTIFF to be converted later.
+    With export_mode png, tiles are directly encoded to their final png name, georeferencing stays in the tile index.
+    They are encoded by a TileEncoder built from the encoding arguments, in the tile format it sets.
+    With single file export modes, tiles are only thresholded and tiles_folder is the single file they are read from.
+    A (len(rows), len(cols)) tile_folders array routes each png to its own folder instead of tiles_folder.
+    
+    Returns the kept tiles (filename, bounds, row_off, col_off, height, width), the I/O counters of each strip read
+    and the tiles counters.
+    """
+    bounds_list = []
+    counters = {"tiles_read": 0, "tiles_skipped_black": 0, "tiles_skipped_white": 0, "tiles_kept": 0, "bytes_written": 0}
+    gdal_env = {"GDAL_CACHEMAX": gdal_cache_mb} if gdal_cache_mb else {}
+    with rasterio.Env(**gdal_env), rasterio.open(orthophoto_filepath) as src, tile_encoder(export_mode, encoding) as encoder:
+
+        reader = StripReader(src, tile_size, cols, max_strip_bytes)
+        rows_positions = {i: position for position, i in enumerate(rows)}
+        cols_positions = {j: position for position, j in enumerate(cols)}
+        for i, j, tile in tqdm(reader.iter_tiles(rows, tile_mask), total=int(tile_mask.sum()), disable=not show_progress):
+            counters["tiles_read"] += 1
+
+            # Apply threshold to avoid keep useless image.
+            rejection = tile_rejection(tile, tile_size, black_pixels_threshold_percentage, white_pixels_threshold_percentage)
+            if rejection is not None:
+                counters[f"tiles_skipped_{rejection}"] += 1
+                continue
+
+            tile_folder = tiles_folder if tile_folders is None else tile_folders[rows_positions[i], cols_positions[j]]
+            tile_filename, tile_bounds = export_tile(src, tile, i, j, tile_folder, export_mode, world_file, encoder)
+
+            bounds_list.append((tile_filename, tile_bounds, i, j, tile.shape[1], tile.shape[2]))
+            counters["tiles_kept"] += 1
+            if export_mode == "tif_png":
+                counters["bytes_written"] += tile_filename.stat().st_size
+
+        if encoder is not None:
+            for counter, value in encoder.close().items():
+                counters[counter] = counters.get(counter, 0) + value
+            if show_progress:
+                print(encoder.summary())
+
+    return bounds_list, reader.strip_stats, counters
+
+
+def split_multiscale_rows_into_tiles(orthophoto_filepath: Path, grids: list[tuple[int, list[int], list[int], np.ndarray]], tiles_folders: list[Path],
+                                     black_pixels_threshold_percentage: float, white_pixels_threshold_percentage: float,
+                                     max_strip_bytes: int, gdal_cache_mb: int | None = None, export_mode: str = "tif_png",
+                                     world_file: bool = False, show_progress: bool = True, encoding: dict | None = None) -> tuple[list[list[tuple]], list[dict], dict[str, int]]:
+    """ split_rows_into_tiles for several tile grids, tiles of every grid are cut from the same strips of the orthophoto.
+
+    grids are (tile_size, rows, cols, tile_mask) and tiles_folders the folder of each grid.
+
+    Returns the kept tiles of each grid, the I/O counters of each strip read and the tiles counters of all grids.
+    """
+    bounds_by_grid = [[] for _ in grids]
+    counters = {"tiles_read": 0, "tiles_skipped_black": 0, "tiles_skipped_white": 0, "tiles_kept": 0, "bytes_written": 0}
+    gdal_env = {"GDAL_CACHEMAX": gdal_cache_mb} if gdal_cache_mb else {}
+    with rasterio.Env(**gdal_env), rasterio.open(orthophoto_filepath) as src, tile_encoder(export_mode, encoding) as encoder:
+
+        reader = MultiScaleStripReader(src, grids, max_strip_bytes)
+        total = sum(int(tile_mask.sum()) for _, _, _, tile_mask in grids)
+        for grid, i, j, tile in tqdm(reader.iter_tiles(), total=total, disable=not show_progress):
+            counters["tiles_read"] += 1
+
+            rejection = tile_rejection(tile, grids[grid][0], black_pixels_threshold_percentage, white_pixels_threshold_percentage)
+            if rejection is not None:
+                counters[f"tiles_skipped_{rejection}"] += 1
+                continue
+
+            tile_filename, tile_bounds = export_tile(src, tile, i, j, tiles_folders[grid], export_mode, world_file, encoder)
+
+            bounds_by_grid[grid].append((tile_filename, tile_bounds, i, j, tile.shape[1], tile.shape[2]))
+            counters["tiles_kept"] += 1
+            if export_mode == "tif_png":
+                counters["bytes_written"] += tile_filename.stat().st_size
+
+        if encoder is not None:
+            for counter, value in encoder.close().items():
+                counters[counter] = counters.get(counter, 0) + value
+            if show_progress:
+                print(encoder.summary())
+
+    return bounds_by_grid, reader.strip_stats, counters
+
+
+def tile_encoder(export_mode: str, encoding: dict | None) -> TileEncoder | nullcontext:
+    """ TileEncoder of the split, only export_mode png encodes tiles while splitting. """
+    return TileEncoder(**(encoding or {})) if export_mode == "png" else nullcontext()
+
+
+def export_tile(src: rasterio.io.DatasetReader, tile: np.ndarray, i: int, j: int, tiles_folder: Path, export_mode: str, world_file: bool, encoder: TileEncoder | None) -> tuple[Path, Polygon]:
+    """ Write a kept tile of the orthophoto src at row i and column j with the export mode. Returns the tile file and bounds.
+
+    With export_mode png, the tile is queued to the encoder and its file is written later.
+    """
+    window = Window(j, i, tile.shape[2], tile.shape[1])
+    transform_window = src.window_transform(window)
+    tile_bounds = box(*rasterio.windows.bounds(window, src.transform))
+
+    if export_mode == "png":
+        tile_filename = Path(tiles_folder, f"{get_tile_name(tile_bounds)}{encoder.suffix}")
+        encoder.submit(tile_filename, tile)
+        if world_file:
+            write_world_file(tile_filename.with_suffix(TILE_FORMATS[encoder.tile_format]["world_file_suffix"]), transform_window)
+    elif export_mode == "tif_png":
+        tile_filename = Path(tiles_folder / f"tile_{i}_{j}.tif")
+        with rasterio.open(
+            tile_filename, "w",
+            driver="GTiff",
+            height=tile.shape[1],
+            width=tile.shape[2],
+            count=3,
+            dtype=tile.dtype,
+            crs=src.crs,
+            transform=transform_window
+        ) as dst:
+            dst.write(tile)
+    else:
+        # Single file export modes keep the tile window only.
+        tile_filename = tiles_folder
+
+    return tile_filename, tile_bounds
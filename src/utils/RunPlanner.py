@@ -0,0 +1,194 @@
+import json
+import time
+import rasterio
+import numpy as np
+from pathlib import Path
+from argparse import Namespace
+
+from .tools import get_config_env
+from .Orthophoto import Orthophoto
+from .ASVManager import ASVManager
+from .RunReport import RunReport
+from .TileEncoder import TILE_FORMATS
+from .BaseManager import SINGLE_FILE_EXPORT_MODES
+
+# Bytes added to each npy tile by its header.
+NPY_HEADER_BYTES = 128
+
+
+class RunPlanner:
+    """ Estimate the tiles, annotations, work and disk of a run from geometry only, no pixel is read.
+
+    The tile grid comes from the GSD of stats.json and the raster dimensions, boundary membership from tile centroids
+    and annotations from ASV positions and footprints, like the grid and asv stages of --route_tiles.
+    Tiles are not thresholded on black and white pixels, --prescreen is ignored: tile counts are upper bounds.
+    Encoded bytes use the compression ratio of the tile format measured by the previous run of the mission, raw
+    bytes as an upper bound when there is none.
+    """
+
+    PLAN_NAME = "run_plan.json"
+
+    def __init__(self, scales_args: list[Namespace]) -> None:
+        # Plan the grid of every tile size without reading the mask of the orthophoto.
+        self.scales_args = [Namespace(**{**vars(args), "prescreen": False}) for args in scales_args]
+        self.args = self.scales_args[0]
+        self.output_folder = Path(get_config_env(self.args.config_path)["OUTPUT_DIR_PATH"])
+
+        # Counters of the managers, the report of the previous run is kept.
+        self.report = RunReport(self.output_folder)
+
+
+    def plan(self) -> Path:
+        """ Plan each tile size, print the estimates and save them. Returns the plan path. """
+        start = time.perf_counter()
+        compression_ratio = self.previous_compression_ratio()
+
+        scales, previous_asvManager = [], None
+        for args in self.scales_args:
+            orthoManager = Orthophoto(args, self.report, dry_run=True)
+            asvManager = ASVManager(args, self.report, dry_run=True)
+
+            # Frames are loaded once for all tile sizes.
+            if previous_asvManager is None:
+                asvManager.load_frames_in_boundary()
+            else:
+                asvManager.share_frames(previous_asvManager)
+            previous_asvManager = asvManager
+
+            scales.append(self.plan_scale(orthoManager, asvManager, compression_ratio))
+
+        plan = {
+            "args": vars(self.args),
+            "frames_read": self.report.totals.get("frames_read", 0),
+            "frames_in_boundary": self.report.totals.get("frames_in_boundary", 0),
+            "compression_ratio": compression_ratio,
+            "plan_seconds": time.perf_counter() - start,
+            "scales": scales
+        }
+        self.print_plan(plan)
+
+        # The plan is the only file written.
+        self.output_folder.mkdir(exist_ok=True, parents=True)
+        plan_path = Path(self.output_folder, self.PLAN_NAME)
+        with open(plan_path, "w") as plan_file:
+            json.dump(plan, plan_file, indent=4, default=str)
+        print(f"\n\n-- Run plan saved to: {plan_path}")
+        return plan_path
+
+
+    def plan_scale(self, orthoManager: Orthophoto, asvManager: ASVManager, compression_ratio: float | None) -> dict:
+        """ Tiles, annotations, work and bytes of one tile size. """
+        args = orthoManager.args
+        tile_grid = orthoManager.plan_tile_grid()
+        tile_size, _, _, tile_mask = tile_grid
+        tiles_plan_df = orthoManager.plan_tiles(tile_grid)
+
+        annotations_tiles = asvManager.match_asv_annotations_with_tiles(tiles_plan_df)
+        annotation_tiles_gdf = asvManager.compute_footprint(annotations_tiles)
+        footprint_thresholds = sorted({args.footprint_threshold, *(args.footprint_thresholds or [])})
+        annotated_tiles_by_threshold = {
+            footprint_threshold: annotation_tiles_gdf_filtered["FileName"].unique()
+            for footprint_threshold, annotation_tiles_gdf_filtered in zip(footprint_thresholds, asvManager.filter_tiles_by_coverage(annotation_tiles_gdf, footprint_thresholds))
+        }
+        is_annotated = tiles_plan_df["tile_png"].isin(annotated_tiles_by_threshold[args.footprint_threshold]).to_numpy()
+
+        # Overlapping tiles can share a name, the last one written is kept on disk.
+        is_kept = ~tiles_plan_df["tile_png"].duplicated(keep="last").to_numpy()
+
+        with rasterio.open(orthoManager.orthophoto_filepath) as src:
+            pixel_bytes = 3 * np.dtype(src.dtypes[0]).itemsize
+            orthophoto_bytes = src.width * src.height * pixel_bytes
+
+        # Tile rows spanned by planned tiles, read once each, on the columns spanned by planned tiles.
+        rows_read = np.zeros(int((tiles_plan_df["row_off"] + tiles_plan_df["height"]).max()) if len(tiles_plan_df) else 0, dtype=bool)
+        for row_off, height in zip(tiles_plan_df["row_off"], tiles_plan_df["height"]):
+            rows_read[row_off:row_off + height] = True
+        cols_read = int((tiles_plan_df["col_off"] + tiles_plan_df["width"]).max() - tiles_plan_df["col_off"].min()) if len(tiles_plan_df) else 0
+
+        # Only annotated tiles are exported when unlabeled tiles are skipped.
+        is_exported = is_annotated if args.route_tiles and args.unlabeled != "write" else np.ones(len(tiles_plan_df), dtype=bool)
+        tiles_bytes = (tiles_plan_df["height"] * tiles_plan_df["width"]).to_numpy() * pixel_bytes
+
+        return {
+            "tiles_size_meters": args.tiles_size_meters,
+            "tile_size_pixels": tile_size,
+            "grid_tiles": int(tile_mask.size),
+            "tiles_inside_boundary": int(tile_mask.sum()),
+            "frames_matched": int(annotations_tiles["PlanchaFileName"].nunique()),
+            "annotation_rows_matched": len(annotations_tiles),
+            "tiles_with_frames": int(annotations_tiles["FileName"].nunique()),
+            "annotated_tiles": int((is_annotated & is_kept).sum()),
+            "unlabeled_tiles": int((~is_annotated & is_kept).sum()),
+            "annotated_tiles_by_footprint_threshold": {footprint_threshold: len(tiles) for footprint_threshold, tiles in annotated_tiles_by_threshold.items()},
+            "work": {
+                "pixel_bytes_read": int(rows_read.sum()) * cols_read * pixel_bytes,
+                "tiles_thresholded": len(tiles_plan_df),
+                "tiles_encoded": 0 if args.export_mode in SINGLE_FILE_EXPORT_MODES else int(is_exported.sum()),
+                "frames_footprinted": int(annotations_tiles["PlanchaFileName"].nunique()),
+                "footprint_intersections": len(annotations_tiles)
+            },
+            "estimated_bytes": self.estimate_bytes(args, int(tiles_bytes[is_exported].sum()), int(tiles_bytes[is_exported & is_kept].sum()),
+                                                  int((is_exported & is_kept).sum()), orthophoto_bytes, compression_ratio)
+        }
+
+
+    def estimate_bytes(self, args: Namespace, exported_bytes: int, kept_bytes: int, kept_tiles: int, orthophoto_bytes: int, compression_ratio: float | None) -> dict:
+        """ Intermediate and output bytes of the tiles with the export mode.
+
+        Exported tiles are every tile written, kept tiles the ones left on disk when tiles share a name.
+        """
+        if args.export_mode == "vrt":
+            return {"intermediate": 0, "output": 0}
+        if args.export_mode == "cog":
+            # Whole orthophoto, deflate compression is not estimated.
+            return {"intermediate": 0, "output": orthophoto_bytes}
+
+        if args.tile_format == "npy":
+            output_bytes = kept_bytes + kept_tiles * NPY_HEADER_BYTES
+        else:
+            output_bytes = int(kept_bytes * (compression_ratio or 1))
+
+        # tif_png writes an uncompressed GeoTIFF by tile before encoding it.
+        return {"intermediate": exported_bytes if args.export_mode == "tif_png" else 0, "output": output_bytes}
+
+
+    def previous_compression_ratio(self) -> float | None:
+        """ Encoded bytes by tile array byte of the tile format in the previous run report, None if unknown. """
+        report_path = Path(self.output_folder, RunReport.REPORT_NAME)
+        if not report_path.exists(): return None
+
+        with open(report_path) as report_file:
+            totals = json.load(report_file).get("totals", {})
+        input_bytes = totals.get(f"input_bytes_{self.args.tile_format}", 0)
+        return totals.get(f"bytes_encoded_{self.args.tile_format}", 0) / input_bytes if input_bytes else None
+
+
+    def print_plan(self, plan: dict) -> None:
+        """ Print the estimates, one column by tile size. """
+        scales = plan["scales"]
+        ratio = "unknown, raw bytes" if plan["compression_ratio"] is None else f"{plan['compression_ratio']:.2f} from previous run"
+        print(f"\n\n-- Run plan: {plan['frames_in_boundary']} / {plan['frames_read']} ASV frames inside boundary, "
+              f"{TILE_FORMATS[self.args.tile_format]['suffix']} compression ratio {ratio}.")
+
+        lines = [
+            ("tile size (pixels)", [scale["tile_size_pixels"] for scale in scales]),
+            ("grid tiles", [scale["grid_tiles"] for scale in scales]),
+            ("tiles inside boundary", [scale["tiles_inside_boundary"] for scale in scales]),
+            ("frames matched", [scale["frames_matched"] for scale in scales]),
+            ("tiles with frames", [scale["tiles_with_frames"] for scale in scales]),
+            ("annotated tiles", [scale["annotated_tiles"] for scale in scales]),
+            ("unlabeled tiles", [scale["unlabeled_tiles"] for scale in scales]),
+            ("pixels read (MB)", [f"{scale['work']['pixel_bytes_read'] / 1024**2:.1f}" for scale in scales]),
+            ("tiles encoded", [scale["work"]["tiles_encoded"] for scale in scales]),
+            ("intermediate (MB)", [f"{scale['estimated_bytes']['intermediate'] / 1024**2:.1f}" for scale in scales]),
+            ("output (MB)", [f"{scale['estimated_bytes']['output'] / 1024**2:.1f}" for scale in scales]),
+        ]
+        print(f"{'':<25}" + "".join(f"{scale['tiles_size_meters']:>12g} m" for scale in scales))
+        for name, values in lines:
+            print(f"{name:<25}" + "".join(f"{value:>14}" for value in values))
+
+        for scale in scales:
+            if len(scale["annotated_tiles_by_footprint_threshold"]) > 1:
+                print(f"Annotated tiles by footprint threshold at {scale['tiles_size_meters']:g} m: " +
+                      ", ".join(f"{threshold:g}: {tiles}" for threshold, tiles in scale["annotated_tiles_by_footprint_threshold"].items()))
+        print(f"Planned in {plan['plan_seconds']:.1f}s, pixels thresholds are applied at export: tile counts are upper bounds.")
@@ -0,0 +1,108 @@
+import json
+import time
+import cProfile
+import resource
+import functools
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+
+class RunReport:
+    """ Wall time, cpu time, memory and counters of each pipeline stage, saved as json in the output folder.
+
+    One report is shared by all managers of a mission. Stages can be nested, counters are added
+    to the innermost running stage and to the run totals. Stages listed in profile_stages are run under cProfile.
+    """
+
+    REPORT_NAME = "run_report.json"
+
+    def __init__(self, output_folder: Path, profile_stages: list[str] | None = None) -> None:
+        self.output_folder = output_folder
+        self.profile_stages = set(profile_stages or [])
+        self.started_at = datetime.now().isoformat()
+
+        self.stages: list[dict] = []
+        self.running: list[dict] = []
+        self.totals: dict[str, float] = {}
+        self.metadata: dict[str, Any] = {}
+        self.profiling = False
+
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """ Measure a stage. """
+        path = "/".join([running["name"] for running in self.running] + [name])
+        record = {"name": name, "path": path, "counters": {}}
+        self.running.append(record)
+        self.stages.append(record)
+
+        # Only one profiler can run, a profiled stage includes its sub stages.
+        profiler = cProfile.Profile() if {"all", name} & self.profile_stages and not self.profiling else None
+        self.profiling |= profiler is not None
+        usage_self, usage_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiler: profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profiling = False
+            end_self, end_children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            record.update({
+                "wall_seconds": time.perf_counter() - start_wall,
+                "cpu_seconds": time.process_time() - start_cpu,
+                # Workers are accounted once they exited, at the end of the stage which used them.
+                "children_cpu_seconds": (end_children.ru_utime + end_children.ru_stime) - (usage_children.ru_utime + usage_children.ru_stime),
+                # ru_maxrss is a high water mark: the peak since the process start, reached during this stage if it grew.
+                "max_rss_mb": end_self.ru_maxrss / 1024,
+                "max_rss_growth_mb": (end_self.ru_maxrss - usage_self.ru_maxrss) / 1024,
+                "children_max_rss_mb": end_children.ru_maxrss / 1024,
+            })
+            record["throughput_by_second"] = {
+                counter: value / record["wall_seconds"] for counter, value in record["counters"].items() if record["wall_seconds"] > 0
+            }
+
+            if profiler:
+                profile_folder = Path(self.output_folder, "profiles")
+                profile_folder.mkdir(exist_ok=True, parents=True)
+                profile_path = Path(profile_folder, f"{path.replace('/', '__')}.prof")
+                profiler.dump_stats(profile_path)
+                record["profile"] = str(profile_path)
+
+            self.running.pop()
+
+
+    def count(self, counter: str, value: float = 1) -> None:
+        """ Add value to a counter of the running stage and of the run. """
+        if self.running:
+            counters = self.running[-1]["counters"]
+            counters[counter] = counters.get(counter, 0) + value
+        self.totals[counter] = self.totals.get(counter, 0) + value
+
+
+    def save(self) -> Path:
+        """ Write the report, stages are in start order. """
+        report_path = Path(self.output_folder, self.REPORT_NAME)
+        report_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(report_path, "w") as report_file:
+            json.dump({
+                "started_at": self.started_at,
+                "saved_at": datetime.now().isoformat(),
+                "metadata": self.metadata,
+                "totals": self.totals,
+                "stages": self.stages
+            }, report_file, indent=4, default=str)
+        return report_path
+
+
+def report_stage(func: Callable) -> Callable:
+    """ Decorator of manager methods, measure the method as a stage of the manager report. """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.report.stage(func.__name__):
+            return func(self, *args, **kwargs)
+    return wrapper
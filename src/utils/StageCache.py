@@ -0,0 +1,117 @@
+import json
+import hashlib
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Callable
+
+from .RunReport import RunReport
+
+
+class StageCache:
+    """ Manifest of completed pipeline stages stored in the output folder.
+
+    Each stage is keyed on a hash of its input files, its parameters and the keys of upstream stages.
+    A stage whose key matches the manifest is loaded from its outputs instead of being recomputed,
+    so an unchanged stage is skipped and an interrupted run resumes after the last completed stage.
+    """
+
+    MANIFEST_NAME = "stage_manifest.json"
+
+    # Files bigger than this are fingerprinted with their size, mtime and first/last chunks instead of a full hash.
+    FULL_HASH_MAX_BYTES = 64 * 1024 * 1024
+    CHUNK_BYTES = 1024 * 1024
+
+    def __init__(self, output_folder: Path, enabled: bool = True, report: RunReport | None = None) -> None:
+        self.manifest_path = Path(output_folder, self.MANIFEST_NAME)
+        self.enabled = enabled
+        self.report = report
+        self.keys: dict[str, str] = {}
+
+        self.manifest: dict[str, dict] = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+
+    def run(self, stage: str, inputs: dict[str, Path], params: dict[str, Any], upstream: list[str], compute: Callable[[], Any], load: Callable[[], Any]) -> Any:
+        """ Load the stage outputs when the stage key is unchanged, else compute the stage and record it.
+
+        load must return None when outputs are missing or incomplete.
+        """
+        if self.report is not None:
+            with self.report.stage(stage):
+                return self.run_stage(stage, inputs, params, upstream, compute, load)
+        return self.run_stage(stage, inputs, params, upstream, compute, load)
+
+
+    def run_stage(self, stage: str, inputs: dict[str, Path], params: dict[str, Any], upstream: list[str], compute: Callable[[], Any], load: Callable[[], Any]) -> Any:
+        if self.is_unchanged(stage, inputs, params, upstream):
+            result = load()
+            if result is not None:
+                print(f"\n\n-- Stage {stage} unchanged, loaded from previous run.")
+                if self.report is not None:
+                    self.report.count("loaded_from_cache")
+                return result
+
+        # Invalidate before computing, a crash during the stage must not leave a stale entry.
+        self.invalidate(stage)
+        result = compute()
+        self.record(stage)
+        return result
+
+
+    def is_unchanged(self, stage: str, inputs: dict[str, Path], params: dict[str, Any], upstream: list[str]) -> bool:
+        """ Compute the stage key, True if the manifest has the same key for the stage. """
+        key = self.stage_key(inputs, params, upstream)
+        self.keys[stage] = key
+        return self.enabled and self.manifest.get(stage, {}).get("key") == key
+
+
+    def invalidate(self, stage: str) -> None:
+        """ Remove the stage from the manifest. """
+        self.manifest.pop(stage, None)
+        self.save()
+
+
+    def record(self, stage: str) -> None:
+        """ Record the stage as completed with the key of its last is_unchanged. """
+        self.manifest[stage] = {"key": self.keys[stage], "completed_at": datetime.now().isoformat()}
+        self.save()
+
+
+    def stage_key(self, inputs: dict[str, Path], params: dict[str, Any], upstream: list[str]) -> str:
+        """ Hash of input files, parameters and upstream stage keys. """
+        signature = {
+            "inputs": {name: self.fingerprint(Path(path)) for name, path in inputs.items()},
+            "params": params,
+            "upstream": [self.keys[stage] for stage in upstream]
+        }
+        return hashlib.sha256(json.dumps(signature, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def fingerprint(self, path: Path) -> str:
+        """ Content hash of a file. Large files only hash their size, mtime and first and last chunks. """
+        if not path.exists():
+            return ""
+
+        stat = path.stat()
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            if stat.st_size <= self.FULL_HASH_MAX_BYTES:
+                for chunk in iter(lambda: file.read(self.CHUNK_BYTES), b""):
+                    digest.update(chunk)
+            else:
+                digest.update(f"{stat.st_size}-{stat.st_mtime_ns}".encode())
+                digest.update(file.read(self.CHUNK_BYTES))
+                file.seek(-self.CHUNK_BYTES, 2)
+                digest.update(file.read(self.CHUNK_BYTES))
+        return digest.hexdigest()
+
+
+    def save(self) -> None:
+        """ Write the manifest atomically. """
+        self.manifest_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4)
+        tmp_path.replace(self.manifest_path)
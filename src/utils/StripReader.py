@@ -0,0 +1,100 @@
+import time
+import numpy as np
+from typing import Iterator
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+
+
+class StripReader:
+    """ Read the tile grid of a raster strip by strip.
+
+    A strip covers consecutive tile rows over the full raster width, so each internal block
+    is decompressed once per strip instead of once per tile. Tiles are numpy views of the strip.
+    When a single tile row does not fit in max_strip_bytes, the strip is split in column chunks.
+    Tiles excluded by a tile mask are not read: empty rows are skipped and strips are cut around gaps.
+    """
+
+    def __init__(self, src: DatasetReader, tile_size: int, cols: list[int], max_strip_bytes: int, indexes: tuple[int, ...] = (1, 2, 3)) -> None:
+        self.src = src
+        self.tile_size = tile_size
+        self.cols = cols
+        self.max_strip_bytes = max_strip_bytes
+        self.indexes = list(indexes)
+
+        self.pixel_bytes = len(indexes) * np.dtype(src.dtypes[indexes[0] - 1]).itemsize
+
+        # One record by strip read: row_off, col_off, height, width, bytes, seconds.
+        self.strip_stats: list[dict] = []
+
+
+    def iter_tiles(self, rows: list[int], tile_mask: np.ndarray | None = None) -> Iterator[tuple[int, int, np.ndarray]]:
+        """ Yield (i, j, tile) for each tile of the given rows, in row then column order.
+
+        tile_mask is an optional (len(rows), len(cols)) boolean array, only True tiles are read and yielded.
+        """
+        if tile_mask is None:
+            tile_mask = np.ones((len(rows), len(self.cols)), dtype=bool)
+
+        row_positions = np.flatnonzero(tile_mask.any(axis=1))
+        for strip_positions in self.group_positions(rows, row_positions, self.src.height, self.src.width):
+            row_off = rows[strip_positions[0]]
+            row_end = min(rows[strip_positions[-1]] + self.tile_size, self.src.height)
+
+            col_positions = np.flatnonzero(tile_mask[strip_positions].any(axis=0))
+            strip_chunks = []
+            for chunk_positions in self.group_positions(self.cols, col_positions, self.src.width, row_end - row_off):
+                col_off = self.cols[chunk_positions[0]]
+                col_end = min(self.cols[chunk_positions[-1]] + self.tile_size, self.src.width)
+                strip_chunks.append((chunk_positions, col_off, self.read_strip(row_off, col_off, row_end - row_off, col_end - col_off)))
+
+            for row_position in strip_positions:
+                i = rows[row_position]
+                for chunk_positions, col_off, strip in strip_chunks:
+                    for col_position in chunk_positions:
+                        if not tile_mask[row_position, col_position]: continue
+                        j = self.cols[col_position]
+                        yield i, j, strip[:, i - row_off:i - row_off + self.tile_size, j - col_off:j - col_off + self.tile_size]
+
+
+    def read_strip(self, row_off: int, col_off: int, height: int, width: int) -> np.ndarray:
+        """ Read one strip and record its I/O counters. """
+        start = time.perf_counter()
+        strip = self.src.read(window=Window(col_off, row_off, width, height), indexes=self.indexes)
+        self.strip_stats.append({
+            "row_off": row_off,
+            "col_off": col_off,
+            "height": height,
+            "width": width,
+            "bytes": strip.nbytes,
+            "seconds": time.perf_counter() - start
+        })
+        return strip
+
+
+    def group_positions(self, offsets: list[int], positions: np.ndarray, limit: int, other_side: int) -> list[list[int]]:
+        """ Group tile positions in spans fitting in memory, at least one tile by span.
+
+        offsets are the pixel offsets of the tiles on this axis, limit the raster size on this axis
+        and other_side the size of the span on the other axis. A gap between two tiles starts a new span.
+        """
+        groups, current = [], []
+        for position in positions:
+            offset = offsets[position]
+            if current:
+                span = min(offset + self.tile_size, limit) - offsets[current[0]]
+                if offset > offsets[current[-1]] + self.tile_size or span * other_side * self.pixel_bytes > self.max_strip_bytes:
+                    groups.append(current)
+                    current = []
+            current.append(int(position))
+        if current:
+            groups.append(current)
+        return groups
+
+
+    def summary(self) -> dict:
+        """ Aggregated I/O counters of all strips read so far. """
+        return {
+            "strips_read": len(self.strip_stats),
+            "bytes_read": sum(stat["bytes"] for stat in self.strip_stats),
+            "seconds": sum(stat["seconds"] for stat in self.strip_stats)
+        }
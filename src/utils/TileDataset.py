@@ -0,0 +1,163 @@
+import queue
+import rasterio
+import threading
+import numpy as np
+import pandas as pd
+from argparse import Namespace
+from typing import Iterator
+from shapely.geometry import Polygon
+
+from .tools import tile_rejection
+from .StripReader import StripReader
+from .Orthophoto import Orthophoto
+from .ASVManager import ASVManager
+from .AnnotationMaker import AnnotationMaker
+from .RunReport import RunReport
+
+# Last item queued by the reader thread when every tile was read.
+END_OF_TILES = object()
+
+
+class TileDataset:
+    """ Iterable of (tile, bounds, annotation) streamed from the orthophoto, no tile file is written.
+
+    Tiles are planned from geometry and annotated like with --route_tiles, in memory: the intermediate files
+    and stage cache of the mission are left untouched. Pixels are read strip by strip in a
+    background thread which stays at most prefetch tiles ahead of the consumer. Tiles above pixels
+    thresholds are dropped, like at export.
+
+    tile is a (3, height, width) uint8 array, bounds the tile polygon in matching_crs and annotation the
+    (classes,) float32 fine scale annotation, None for unlabeled tiles when include_unlabeled is set.
+    """
+
+    def __init__(self, args: Namespace, annotation_type: str = "probs", include_unlabeled: bool = False, prefetch: int = 64, report: RunReport | None = None) -> None:
+        if annotation_type not in ["probs", "binary"]:
+            raise NameError(f"Unknown annotation type {annotation_type}, expected probs or binary")
+        if isinstance(args.tiles_size_meters, list):
+            raise NameError("TileDataset streams a single tile size, create one dataset by tile size")
+        if prefetch < 1:
+            raise NameError(f"Prefetch must be at least 1, got {prefetch}")
+
+        self.args = args
+        self.annotation_type = annotation_type
+        self.include_unlabeled = include_unlabeled
+        self.prefetch = prefetch
+
+        # Nothing is written in the mission folders.
+        self.orthoManager = Orthophoto(args, report, dry_run=True)
+        self.report = self.orthoManager.report
+        self.asvManager = ASVManager(args, self.report, dry_run=True)
+        self.annotationMaker = AnnotationMaker(args, self.report, dry_run=True)
+
+        # Set by prepare, tiles are in reading order and annotations is aligned with tiles_df.
+        self.tiles_df: pd.DataFrame | None = None
+        self.annotations = np.empty((0, 0), dtype=np.float32)
+        self.is_annotated = np.empty(0, dtype=bool)
+        self.classes: list[str] = []
+
+        # Counters and strips of the last iteration, filled by the reader thread.
+        self.counters: dict[str, int] = {}
+        self.strip_stats: list[dict] = []
+
+
+    def prepare(self) -> None:
+        """ Plan the tiles and compute their annotations, once. """
+        if self.tiles_df is not None: return
+
+        tiles_plan_df = self.orthoManager.plan_tiles()
+        annotation_tiles_gdf = self.asvManager.annotate_tiles(tiles_plan_df)
+        if len(annotation_tiles_gdf) == 0:
+            raise NameError("No annotated tiles, nothing to stream")
+
+        binary_annotation_df = self.annotationMaker.create_binary_annotations_for_tiles(annotation_tiles_gdf)
+        probs_df, binary_df = self.annotationMaker.compute_tiles_annotations(annotation_tiles_gdf, binary_annotation_df)
+        annotations_df = (probs_df if self.annotation_type == "probs" else binary_df).set_index("FileName")
+        self.classes = annotations_df.columns.tolist()
+
+        is_annotated = tiles_plan_df["tile_png"].isin(annotations_df.index).to_numpy()
+        tiles_df = tiles_plan_df if self.include_unlabeled else tiles_plan_df[is_annotated]
+        self.tiles_df = tiles_df.sort_values(["row_off", "col_off"]).reset_index(drop=True)
+
+        # Unlabeled tiles get a row of NaN, never returned.
+        self.is_annotated = self.tiles_df["tile_png"].isin(annotations_df.index).to_numpy()
+        self.annotations = annotations_df.reindex(self.tiles_df["tile_png"]).to_numpy(dtype=np.float32)
+        print(f"Tiles to stream: {len(self.tiles_df)}, annotated: {self.is_annotated.sum()}")
+
+
+    def __len__(self) -> int:
+        """ Number of planned tiles, an upper bound: tiles above pixels thresholds are dropped while streaming. """
+        self.prepare()
+        return len(self.tiles_df)
+
+
+    def __iter__(self) -> Iterator[tuple[np.ndarray, Polygon, np.ndarray | None]]:
+        self.prepare()
+
+        tiles_queue = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self.read_tiles, args=(tiles_queue, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = tiles_queue.get()
+                if item is END_OF_TILES: return
+                if isinstance(item, BaseException): raise item
+                yield item
+        finally:
+            # The consumer can stop early, the reader must not stay blocked on a full queue.
+            stop.set()
+            reader.join()
+
+
+    def read_tiles(self, tiles_queue: queue.Queue, stop: threading.Event) -> None:
+        """ Reader thread: read the planned tiles strip by strip and queue the kept ones, then END_OF_TILES or the raised error. """
+        self.counters = {"tiles_read": 0, "tiles_skipped_black": 0, "tiles_skipped_white": 0, "tiles_yielded": 0}
+        last_item = END_OF_TILES
+        try:
+            tile_size = self.orthoManager.get_tile_size()
+            rows = sorted(set(self.tiles_df["row_off"].tolist()))
+            cols = sorted(set(self.tiles_df["col_off"].tolist()))
+            rows_positions = np.searchsorted(rows, self.tiles_df["row_off"].to_numpy())
+            cols_positions = np.searchsorted(cols, self.tiles_df["col_off"].to_numpy())
+
+            tile_mask = np.zeros((len(rows), len(cols)), dtype=bool)
+            tile_mask[rows_positions, cols_positions] = True
+            tile_positions = np.full((len(rows), len(cols)), -1, dtype=np.int64)
+            tile_positions[rows_positions, cols_positions] = np.arange(len(self.tiles_df))
+            rows_index = {i: position for position, i in enumerate(rows)}
+            cols_index = {j: position for position, j in enumerate(cols)}
+            bounds_polygons = self.tiles_df["bounds_polygon"].to_numpy()
+
+            gdal_env = {"GDAL_CACHEMAX": self.args.gdal_cache_mb} if self.args.gdal_cache_mb else {}
+            with rasterio.Env(**gdal_env), rasterio.open(self.orthoManager.orthophoto_filepath) as src:
+                reader = StripReader(src, tile_size, cols, int(self.args.strip_memory_mb * 1024 * 1024))
+                self.strip_stats = reader.strip_stats
+
+                for i, j, tile in reader.iter_tiles(rows, tile_mask):
+                    self.counters["tiles_read"] += 1
+                    rejection = tile_rejection(tile, tile_size, self.args.black_pixels_threshold_percentage, self.args.white_pixels_threshold_percentage)
+                    if rejection is not None:
+                        self.counters[f"tiles_skipped_{rejection}"] += 1
+                        continue
+
+                    # Tiles are views of the strip, copy them to free the strip once its tiles are consumed.
+                    k = tile_positions[rows_index[i], cols_index[j]]
+                    annotation = self.annotations[k].copy() if self.is_annotated[k] else None
+                    if not self.put(tiles_queue, stop, (tile.copy(), bounds_polygons[k], annotation)):
+                        return
+                    self.counters["tiles_yielded"] += 1
+        except BaseException as error:
+            last_item = error
+
+        self.put(tiles_queue, stop, last_item)
+
+
+    def put(self, tiles_queue: queue.Queue, stop: threading.Event, item: object) -> bool:
+        """ Put item in the queue, waiting for room. False if the consumer stopped first. """
+        while not stop.is_set():
+            try:
+                tiles_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
@@ -0,0 +1,137 @@
+import time
+import rasterio
+import numpy as np
+from pathlib import Path
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+from .tools import write_image
+
+# File suffix, GDAL driver and world file suffix of each tile format, npy tiles are raw (bands, height, width) arrays.
+TILE_FORMATS = {
+    "png": {"suffix": ".png", "driver": "PNG", "world_file_suffix": ".pgw"},
+    "webp": {"suffix": ".webp", "driver": "WEBP", "world_file_suffix": ".wpw"},
+    "npy": {"suffix": ".npy", "driver": None, "world_file_suffix": None},
+}
+
+# Valid compression levels: zlib level for png, lossless effort for webp.
+COMPRESSION_LEVELS = {"png": range(1, 10), "webp": range(1, 101), "npy": range(0)}
+
+
+def creation_options(tile_format: str, compression_level: int | None) -> dict:
+    """ GDAL creation options of a tile format. Webp is always lossless. """
+    if tile_format == "png":
+        return {} if compression_level is None else {"ZLEVEL": compression_level}
+    if tile_format == "webp":
+        return {"LOSSLESS": "YES"} if compression_level is None else {"LOSSLESS": "YES", "QUALITY": compression_level}
+    return {}
+
+
+def encode_tile(tile_path: Path, tile: np.ndarray | Path, tile_format: str, compression_level: int | None) -> tuple[int, int, float]:
+    """ Encode a (bands, height, width) tile, or the GeoTIFF tile at this path, to tile_path. Top-level to be usable by worker processes.
+
+    Returns the bytes written, the bytes of the tile array and the encoding seconds.
+    """
+    start = time.perf_counter()
+    if isinstance(tile, Path):
+        with rasterio.open(tile) as src:
+            tile = src.read()
+
+    if tile_format == "npy":
+        np.save(tile_path, tile)
+    else:
+        write_image(tile_path, tile, TILE_FORMATS[tile_format]["driver"], **creation_options(tile_format, compression_level))
+
+    return tile_path.stat().st_size, tile.nbytes, time.perf_counter() - start
+
+
+class TileEncoder:
+    """ Encode tiles to files on a thread or process pool fed by a bounded queue.
+
+    At most max_pending tiles wait to be encoded, submit blocks on the oldest one when the queue is full so the
+    tile reader never runs far ahead of the encoders. With no worker, tiles are encoded by the caller.
+    Overlapping tiles can share a name, a tile waits for the pending tile of the same path so the last one submitted is kept.
+    Counters are named after the tile format to compare the throughput and size of each format.
+    """
+
+    def __init__(self, tile_format: str = "png", compression_level: int | None = None, workers: int = 0, pool: str = "thread", max_pending: int | None = None) -> None:
+        if tile_format not in TILE_FORMATS:
+            raise NameError(f"Unknown tile format {tile_format}, expected one of {list(TILE_FORMATS)}")
+
+        self.tile_format = tile_format
+        self.compression_level = compression_level
+        self.suffix = TILE_FORMATS[tile_format]["suffix"]
+        self.max_pending = max_pending or 4 * max(1, workers)
+
+        self.executor: Executor | None = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers) if pool == "thread" else ProcessPoolExecutor(max_workers=workers)
+        self.pending: deque[tuple[Path, Future]] = deque()
+        self.pending_paths: dict[Path, int] = {}
+
+        self.start = time.perf_counter()
+        self.counters = {f"tiles_encoded_{tile_format}": 0, f"bytes_encoded_{tile_format}": 0, f"input_bytes_{tile_format}": 0, f"encode_seconds_{tile_format}": 0.0}
+
+
+    def __enter__(self) -> "TileEncoder":
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+    def submit(self, tile_path: Path, tile: np.ndarray | Path) -> None:
+        """ Queue a tile, or the path of a GeoTIFF tile, to be encoded to tile_path. """
+        if self.executor is None:
+            self.collect(encode_tile(tile_path, tile, self.tile_format, self.compression_level))
+            return
+
+        while len(self.pending) >= self.max_pending or tile_path in self.pending_paths:
+            self.wait_oldest()
+        self.pending.append((tile_path, self.executor.submit(encode_tile, tile_path, tile, self.tile_format, self.compression_level)))
+        self.pending_paths[tile_path] = self.pending_paths.get(tile_path, 0) + 1
+
+
+    def wait_oldest(self) -> None:
+        """ Wait for the oldest queued tile. """
+        tile_path, future = self.pending.popleft()
+        self.pending_paths[tile_path] -= 1
+        if self.pending_paths[tile_path] == 0:
+            del self.pending_paths[tile_path]
+        self.collect(future.result())
+
+
+    def collect(self, result: tuple[int, int, float]) -> None:
+        """ Add the result of an encoded tile to the counters. """
+        bytes_written, input_bytes, seconds = result
+        self.counters[f"tiles_encoded_{self.tile_format}"] += 1
+        self.counters[f"bytes_encoded_{self.tile_format}"] += bytes_written
+        self.counters[f"input_bytes_{self.tile_format}"] += input_bytes
+        self.counters[f"encode_seconds_{self.tile_format}"] += seconds
+
+
+    def close(self) -> dict[str, float]:
+        """ Wait for queued tiles and return the counters, bytes_written included. """
+        while self.pending:
+            self.wait_oldest()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        self.counters["bytes_written"] = self.counters[f"bytes_encoded_{self.tile_format}"]
+        return self.counters
+
+
+    def summary(self) -> str:
+        """ Throughput and size of encoded tiles. """
+        tiles = self.counters[f"tiles_encoded_{self.tile_format}"]
+        megabytes = self.counters[f"bytes_encoded_{self.tile_format}"] / 1024**2
+        input_megabytes = self.counters[f"input_bytes_{self.tile_format}"] / 1024**2
+        seconds = time.perf_counter() - self.start
+        level = "" if self.compression_level is None else f" level {self.compression_level}"
+        return (f"Encoded {tiles} {self.tile_format}{level} tiles in {seconds:.1f}s: {tiles / seconds if seconds else 0:.1f} tiles/s, "
+                f"{megabytes:.1f} MB, {megabytes * 1024 / tiles if tiles else 0:.1f} KB by tile, ratio {megabytes / input_megabytes if input_megabytes else 0:.2f}")
@@ -1,14 +1,18 @@
 import json
+import shapely
+import warnings
 import rasterio
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyarrow.parquet as pq
 from pathlib import Path
-from functools import partial
+from functools import lru_cache
+from affine import Affine
 from pyproj import Transformer
-from shapely.ops import transform
-from shapely.geometry import Point, Polygon
-from math import radians, atan2, pi, asin, sin, cos, degrees
+from shapely.geometry import Polygon
+from math import radians, pi
+from rasterio.errors import NotGeoreferencedWarning
 
 from ..lib.CameraCalculator import CameraCalculator
 
@@ -38,111 +42,253 @@ def check_crs(obj: gpd.GeoDataFrame | rasterio.io.DatasetReader, crs_code: str):
     return obj.crs == rasterio.crs.CRS.from_epsg(crs_code)
 
 
+def get_tile_name(tile_bounds: Polygon) -> str:
+    """ Name of a tile, without extension, built from the centroid of its bounds. """
+    centroid = tile_bounds.centroid
+    return f"odm_orthophoto_{int(centroid.x)}_{int(centroid.y)}"
+
+
+def count_greyscale_pixels(tile: np.ndarray, value: int) -> int:
+    """ Count pixels of a (bands, height, width) tile whose greyscale (mean of bands) equals value.
+
+    On uint8 tiles, a mean of 0 or 255 means every band equals the value, so the count is done
+    with band comparisons and no float temporaries.
+    """
+    if tile.dtype == np.uint8 and value in (0, 255):
+        match = tile[0] == value
+        for band in tile[1:]:
+            match &= band == value
+        return int(np.count_nonzero(match))
+
+    return int(np.sum(np.sum(tile, axis=0) / tile.shape[0] == value))
+
+
+def tile_rejection(tile: np.ndarray, tile_size: int, black_pixels_threshold_percentage: float, white_pixels_threshold_percentage: float) -> str | None:
+    """ Reason to drop a tile, "black" or "white", None if the tile is kept.
+
+    Percentages are computed on the full tile size, so a clipped tile on the orthophoto edge counts its missing pixels as kept pixels.
+    """
+    size_inline_tile = tile_size**2
+
+    percentage_black_pixel = count_greyscale_pixels(tile, 0) * 100 / size_inline_tile
+    if percentage_black_pixel > black_pixels_threshold_percentage:
+        return "black"
+
+    percentage_white_pixel = count_greyscale_pixels(tile, 255) * 100 / size_inline_tile
+    if percentage_white_pixel > white_pixels_threshold_percentage:
+        return "white"
+
+    return None
+
+
+def write_image(tile_path: Path, tile: np.ndarray, driver: str = "PNG", **creation_options) -> None:
+    """ Encode a (bands, height, width) array to an image without georeferencing, png by default. """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(tile_path, "w", driver=driver, height=tile.shape[1], width=tile.shape[2], count=tile.shape[0], dtype=tile.dtype, **creation_options) as dst:
+            dst.write(tile)
+
+
+def write_world_file(world_file_path: Path, transform: Affine) -> None:
+    """ Write an ESRI world file. Coordinates are the center of the upper left pixel. """
+    center = transform * (0.5, 0.5)
+    with open(world_file_path, "w") as world_file:
+        world_file.write("\n".join(str(v) for v in [transform.a, transform.d, transform.b, transform.e, center[0], center[1]]) + "\n")
+
+
+def write_intermediate(df: pd.DataFrame, path: Path, geometry_columns: list[str], crs: str) -> Path:
+    """ Write an intermediate table, the format is given by the path suffix.
+
+    Args:
+        df (pd.DataFrame): Table with shapely geometries in geometry_columns, the first one is the primary geometry.
+        path (Path): .parquet for GeoParquet with WKB geometries and typed columns, .geojson or .csv with WKT geometries.
+        geometry_columns (list[str]): Columns holding shapely geometries.
+        crs (str): Crs of the geometries.
+
+    Returns:
+        The written path.
+    """
+    if path.suffix == ".csv":
+        df.to_csv(path, index=False)
+        return path
+
+    gdf = gpd.GeoDataFrame(df, geometry=geometry_columns[0], crs=crs)
+    for geometry_column in geometry_columns[1:]:
+        gdf[geometry_column] = gpd.GeoSeries(gdf[geometry_column].to_numpy(), index=gdf.index, crs=crs)
+
+    if path.suffix == ".parquet":
+        gdf.to_parquet(path, index=False)
+    else:
+        gdf.to_file(path, driver="GeoJSON")
+    return path
+
+
+def read_intermediate(path: Path, geometry_columns: list[str] | None = None, columns: list[str] | None = None, crs: str | None = None) -> pd.DataFrame | None:
+    """ Read an intermediate table written by write_intermediate, None if missing.
+
+    Args:
+        path (Path): .parquet, .geojson or .csv file.
+        geometry_columns (list[str] | None): Csv columns to parse from WKT. GeoParquet and GeoJSON store it already.
+        columns (list[str] | None): Only read these columns. GeoParquet only reads the needed column chunks.
+        crs (str | None): Crs of csv geometries.
+
+    Returns:
+        A GeoDataFrame when a geometry column is read, else a DataFrame.
+    """
+    if not path.exists(): return None
+
+    if path.suffix == ".parquet":
+        geo_metadata = json.loads(pq.read_schema(path).metadata.get(b"geo", b"{}"))
+        if columns is not None and not set(columns) & set(geo_metadata.get("columns", {})):
+            return pd.read_parquet(path, columns=columns)
+        return gpd.read_parquet(path, columns=columns)
+
+    if path.suffix == ".geojson":
+        gdf = gpd.read_file(path)
+        return gdf if columns is None else gdf[columns]
+
+    df = pd.read_csv(path, usecols=columns)
+    geometry_columns = [geometry_column for geometry_column in geometry_columns or [] if geometry_column in df.columns]
+    if not geometry_columns:
+        return df
+    for geometry_column in geometry_columns:
+        df[geometry_column] = shapely.from_wkt(df[geometry_column].to_numpy())
+    return gpd.GeoDataFrame(df, geometry=geometry_columns[0], crs=crs)
+
+
+@lru_cache(maxsize=None)
+def get_transformer(crs_from: str, crs_to: str) -> Transformer:
+    """ Build a Transformer only once for each couple of crs. """
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
+
+
 def dest_from_start(lat1, lon1, d, bearing) :
     # Inputs :
     # 1.lat1 = latitude of the starting point in degrees
     # 2.lon1 = longitude of the starting point in degrees
     # 3.d = distance from the starting point in m
     # 4.bearing = direction from one place to another in degrees
+    # All inputs can be scalars or numpy arrays broadcastable together.
     
     # Outputs :
     # 1.lat2 = latitude of the destination point in degrees
     # 2.lon2 = longitude of the destination point in degrees
     
     # we'll do all the computations in KM for a sake of simplicity
-    d = d * 1e-3
+    d = np.asarray(d) * 1e-3
     R = 6378.137 # Radius of earth in KM
     ang_dist = d/R
     # CAVEAT : we'll do all the computations in radians for a sake of simplicity
-    lat1 = radians(lat1)
-    lon1 = radians(lon1)
-    bearing = radians(bearing)
+    lat1 = np.radians(lat1)
+    lon1 = np.radians(lon1)
+    bearing = np.radians(bearing)
     
-    lat2 = asin( sin(lat1) * cos(ang_dist) + cos(lat1) * sin(ang_dist) * cos(bearing) )
+    lat2 = np.arcsin( np.sin(lat1) * np.cos(ang_dist) + np.cos(lat1) * np.sin(ang_dist) * np.cos(bearing) )
     # Python reverses the arguments of ATAN2 wrt the function "Destination point given distance 
     # and bearing from start point" in :
     # https://www.movable-type.co.uk/scripts/latlong.html
-    lon2 = lon1 + atan2(  sin(bearing) * sin(ang_dist) * cos(lat1) , cos(ang_dist) - sin(lat1) * sin(lat2))
+    lon2 = lon1 + np.arctan2(  np.sin(bearing) * np.sin(ang_dist) * np.cos(lat1) , np.cos(ang_dist) - np.sin(lat1) * np.sin(lat2))
     #
-    lat2 = degrees(lat2)
-    lon2 = degrees(lon2)
+    lat2 = np.degrees(lat2)
+    lon2 = np.degrees(lon2)
     return lat2, lon2
     
 
-def get_dist_and_angle(p, q):
-    # Check if either point is empty
-    if p.is_empty or q.is_empty:
-        return None, None
-
-    try:
-        angle = atan2(q.y - p.y, q.x - p.x) * 180 / pi
-        d = ((((q.x - p.x)**2) + ((q.y - p.y)**2) )**0.5)
-        return d, angle
-    except Exception as e:
-        print(f"Error processing points {p} and {q}: {e}")
-        return None, None
-
-
-# Example usage of the calculate_footprint function
-def calculate_footprint(row, fov_x, fov_y, target_crs):
-    c = CameraCalculator()
-    lat1 = row['GPSLatitude']
-    lon1 = row['GPSLongitude']
-    bbox = c.getBoundingPolygon(radians(fov_x), radians(fov_y),
-                                row['GPSAltitude'], radians(row['GPSRoll']),
-                                radians(row['GPSPitch']), radians(row['GPSTrack']))
-
-    lat_vec = []
-    lon_vec = []
-    p1 = Point(0, 0)
-
-    for i, p in enumerate(bbox):
-        if p.x is None or p.y is None:
-            continue  # Skip invalid points
-        p2 = Point(p.x, p.y)
-        if p2.is_empty:
-            continue  # Skip empty points
-
-        d, angle = get_dist_and_angle(p1, p2)
-        if d is None or angle is None:
-            continue  # Skip if unable to calculate distance or angle
-
-        lat2, lon2 = dest_from_start(lat1, lon1, d, angle)
-        lat_vec.append(lat2)
-        lon_vec.append(lon2)
-
-    footprint_geo = Polygon(zip(lon_vec, lat_vec))
-    transformer = Transformer.from_crs("EPSG:4326", target_crs, always_xy=True)
-    footprint_projected = transform(partial(transformer.transform), footprint_geo)
-
-    return footprint_projected
-
-# Function to calculate the probability for a single class
-def calculate_probability_from_binary_fine_scale(df, class_name):
-    # Filter rows where the class is True
-    df_class = df[df[class_name]]
-    if df_class.empty:
-        return 0.0
-    
-    # Calculate the product term for the given class
-    product_term = np.prod([
-        (row['UnderwaterImageArea'] - row['IntersectionArea']) / row['UnderwaterImageArea']
-        for _, row in df_class.iterrows()
-        if not pd.isna(row['UnderwaterImageArea']) and not pd.isna(row['IntersectionArea'])
-    ])
-    
-    # Calculate the final probability
-    P_presence = 1 - product_term
-    return P_presence
-
-def calculate_probability_from_probs_fine_scale(df, class_name):
-    # Calculate the product term for the given class, incorporating probabilities
-    product_term = np.prod([
-        1 - (row[class_name] * row['IntersectionArea'] / row['UnderwaterImageArea'])
-        for _, row in df.iterrows()
-        if not pd.isna(row['UnderwaterImageArea']) and not pd.isna(row['IntersectionArea']) and not pd.isna(row[class_name])
-    ])
-    
-    # Calculate the final probability
-    P_presence = 1 - product_term
-    return P_presence
\ No newline at end of file
+def calculate_footprints(asv_metadata_df: pd.DataFrame, fov_x: float, fov_y: float, target_crs: str) -> np.ndarray:
+    """ Compute the ground footprint of every ASV frame in one vectorized pass.
+
+    Args:
+        asv_metadata_df (pd.DataFrame): ASV frames with GPSLatitude, GPSLongitude, GPSAltitude, GPSRoll, GPSPitch and GPSTrack columns.
+        fov_x (float): Camera horizontal field of view in degrees.
+        fov_y (float): Camera vertical field of view in degrees.
+        target_crs (str): Crs of the returned polygons.
+
+    Returns:
+        Array of shapely polygons in target_crs, None when the footprint cannot be computed.
+    """
+    lat1 = asv_metadata_df['GPSLatitude'].to_numpy(dtype=np.float64)
+    lon1 = asv_metadata_df['GPSLongitude'].to_numpy(dtype=np.float64)
+
+    corners = CameraCalculator.getBoundingPolygons(radians(fov_x), radians(fov_y),
+                                                   asv_metadata_df['GPSAltitude'].to_numpy(dtype=np.float64),
+                                                   np.radians(asv_metadata_df['GPSRoll'].to_numpy(dtype=np.float64)),
+                                                   np.radians(asv_metadata_df['GPSPitch'].to_numpy(dtype=np.float64)),
+                                                   np.radians(asv_metadata_df['GPSTrack'].to_numpy(dtype=np.float64)))
+
+    # Distance and angle of each corner from the camera position.
+    x, y = corners[:, :, 0], corners[:, :, 1]
+    d = np.hypot(x, y)
+    angle = np.arctan2(y, x) * 180 / pi
+
+    lat2, lon2 = dest_from_start(lat1[:, np.newaxis], lon1[:, np.newaxis], d, angle)
+
+    transformer = get_transformer("EPSG:4326", target_crs)
+    x_projected, y_projected = transformer.transform(lon2.ravel(), lat2.ravel())
+    coords = np.stack([x_projected, y_projected], axis=-1).reshape(len(asv_metadata_df), 4, 2)
+
+    footprints = np.full(len(asv_metadata_df), None, dtype=object)
+    valid = np.isfinite(coords).all(axis=(1, 2))
+    footprints[valid] = shapely.polygons(coords[valid])
+
+    return footprints
+
+
+def calculate_probabilities_fine_scale(df: pd.DataFrame, classes: list[str]) -> pd.DataFrame:
+    """ Probability of presence of each class in each tile, from fine scale predictions.
+
+    For a tile and a class, P = 1 - prod(1 - p * IntersectionArea / UnderwaterImageArea) over the ASV frames of the tile,
+    with p the class probability or 1/0 for binary predictions. Rows with a NaN term are ignored.
+    All classes of all tiles are computed at once with a grouped sum of logs.
+
+    Args:
+        df (pd.DataFrame): One row by tile and ASV frame with FileName, IntersectionArea, UnderwaterImageArea and classes columns.
+        classes (list[str]): Class columns, probabilities or booleans.
+
+    Returns:
+        DataFrame indexed by sorted FileName with one column by class.
+    """
+    tiles_names, tiles_probabilities = aggregate_probabilities_fine_scale(
+        df[classes].to_numpy(dtype=np.float64),
+        (df['IntersectionArea'] / df['UnderwaterImageArea']).to_numpy(dtype=np.float64),
+        df['FileName'].to_numpy()
+    )
+    return pd.DataFrame(tiles_probabilities, index=pd.Index(tiles_names, name='FileName'), columns=classes)
+
+
+def aggregate_probabilities_fine_scale(probabilities: np.ndarray, area_ratio: np.ndarray, tiles_names: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Array version of calculate_probabilities_fine_scale.
+
+    Args:
+        probabilities (np.ndarray): (rows, columns) probabilities or booleans.
+        area_ratio (np.ndarray): (rows,) IntersectionArea / UnderwaterImageArea.
+        tiles_names (np.ndarray): (rows,) tile of each row.
+
+    Returns:
+        Sorted unique tiles names and the (tiles, columns) probabilities of presence.
+    """
+    if len(tiles_names) == 0:
+        return np.array([], dtype=object), np.empty((0, probabilities.shape[1]), dtype=np.float64)
+
+    terms = 1 - probabilities * area_ratio[:, np.newaxis]
+    terms[np.isnan(terms)] = 1.0
+
+    # Grouped sums by tile over rows sorted by tile.
+    tiles_codes, unique_tiles_names = pd.factorize(tiles_names, sort=True)
+    order = np.argsort(tiles_codes, kind='stable')
+    groups_start = np.flatnonzero(np.diff(tiles_codes[order], prepend=-1))
+    terms = np.ascontiguousarray(terms[order].T)
+
+    def grouped_sum(values: np.ndarray) -> np.ndarray:
+        return np.add.reduceat(values, groups_start, axis=1).T
+
+    # Product in log space, zero and negative terms are counted apart.
+    is_zero, is_negative = terms == 0, terms < 0
+    has_zero = grouped_sum(is_zero.astype(np.int64)) > 0 if is_zero.any() else False
+    sign = np.where(grouped_sum(is_negative.astype(np.int64)) % 2 == 1, -1.0, 1.0) if is_negative.any() else 1.0
+
+    with np.errstate(divide='ignore'):
+        sum_log = grouped_sum(np.log(np.abs(terms)))
+
+    product_term = np.where(has_zero, 0.0, sign * np.exp(sum_log))
+
+    return np.asarray(unique_tiles_names), 1 - product_term